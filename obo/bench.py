@@ -0,0 +1,406 @@
+'''
+Benchmarks obo against an S3 endpoint, by default a local stand-in.
+
+Each workload runs real obo commands (through OboCommand, so argument
+parsing and the OboBucket/OboObject code paths are all exercised) and
+records per operation timings. Results are written as JSON so that runs
+can be kept and compared:
+
+    python -m obo.bench [<args>] -o results.json
+    python -m obo.bench [<args>] --compare results.json
+
+Unless --endpoint is given, a stand-in (obo.standin) is started in a
+child process so that the peak RSS reported is obo's alone; with
+--in-process it runs on a thread instead. With --gateways it serves on
+several ports, which obo spreads its requests over. Request counts come
+from the stand-in and are left out for other endpoints.
+
+The startup workload instead runs obo as a process of its own, the way
+scripts and cron jobs do, and checks that --help stays within a startup
+budget; the exit status is 1 if it does not.
+'''
+from __future__ import absolute_import
+
+import sys
+import os
+import argparse
+import httplib
+import json
+import math
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+from obo import obo as obo_mod
+from obo import standin
+
+
+class NullOutput:
+    '''
+    Stands in for sys.stdout while commands run.
+    '''
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def percentile(values, p):
+    '''
+    Returns the nearest-rank p-th percentile of values.
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    i = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(i, 0)]
+
+
+def package_env():
+    '''
+    Returns the environment for a child process that imports obo from
+    this tree.
+    '''
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([root] + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
+
+
+def peak_rss_kb():
+    # ru_maxrss is in bytes on OS X and in kilobytes elsewhere
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss
+
+
+class StandinProcess:
+    '''
+    Runs the stand-in in a child process.
+    '''
+    def __init__(self, latency, jitter, error_rate, max_inflight, gateways):
+        env = package_env()
+        argv = [sys.executable, '-m', 'obo.standin', '--latency', str(latency), '--jitter', str(jitter),
+                '--error-rate', str(error_rate), '--gateways', str(gateways)]
+        if max_inflight:
+            argv += ['--max-inflight', str(max_inflight)]
+        self.proc = subprocess.Popen(argv, stdout=subprocess.PIPE, env=env)
+        line = self.proc.stdout.readline()
+        if not line.startswith('listening on '):
+            self.stop()
+            raise RuntimeError('stand-in failed to start')
+        self.endpoint = line.split()[-1]
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc.wait()
+
+
+# what the obo console script runs
+SPAWN_SCRIPT = 'from obo.obo import main; main()'
+
+class OboBench:
+    def __init__(self, obo, args, endpoint):
+        self.obo = obo
+        self.args = args
+        self.endpoint = endpoint
+        self.bucket = args.bucket or 'obo-bench-{p}'.format(p=os.getpid())
+        self.tmpdir = tempfile.mkdtemp(prefix='obo-bench-')
+        self.results = []
+        self.over_budget = False
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def make_file(self, name, size):
+        path = self.path(name)
+        with open(path, 'wb') as f:
+            block = os.urandom(min(size, 1 << 20))
+            left = size
+            while left > 0:
+                f.write(block[:left])
+                left -= len(block)
+        return path
+
+    def request_counts(self):
+        '''
+        Returns (and resets) the stand-in's request counts, or None if the
+        endpoint is not a stand-in.
+        '''
+        # the gateways of a stand-in share their counts
+        host, _, port = self.endpoint.split(',')[0].partition(':')
+        conn = httplib.HTTPConnection(host, int(port) if port else None)
+        try:
+            conn.request('GET', standin.COUNTS_PATH)
+            resp = conn.getresponse()
+            body = resp.read()
+            if resp.status != 200:
+                return None
+            return json.loads(body)
+        except (IOError, ValueError, httplib.HTTPException):
+            return None
+        finally:
+            conn.close()
+
+    def command(self, argv):
+        cmd = obo_mod.OboCommand(['obo'] + argv, self.obo)._parse()
+        stdout = sys.stdout
+        sys.stdout = NullOutput()
+        try:
+            cmd()
+        finally:
+            sys.stdout = stdout
+
+    def spawn(self, argv):
+        '''
+        Runs obo with argv in a process of its own, or just the Python
+        interpreter if argv is None.
+        '''
+        env = package_env()
+        env.update(S3_ACCESS_KEY_ID=self.obo.access_key, S3_SECRET_ACCESS_KEY=self.obo.secret_key,
+                   S3_HOSTNAME=self.endpoint)
+        script = SPAWN_SCRIPT if argv is not None else 'pass'
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([sys.executable, '-c', script] + (argv or []), stdout=devnull, env=env)
+
+    def measure(self, name, argvs, size=0, items=1, run=None):
+        '''
+        Runs each command line in argvs (with run, by default in this
+        process) and records the result as name. size is the number of
+        bytes and items the number of objects each command handles.
+        '''
+        run = run or self.command
+        argvs = list(argvs)
+        self.request_counts()
+        throttle = self.obo.throttle
+        retries, throttled = throttle.retries, throttle.throttled
+        latencies = []
+        start = time.time()
+        for argv in argvs:
+            t = time.time()
+            run(argv)
+            latencies.append(time.time() - t)
+        elapsed = time.time() - start
+        counts = self.request_counts()
+
+        n = len(argvs)
+        r = {
+            'name': name,
+            'ops': n,
+            'bytes': size * n,
+            'items': items * n,
+            'seconds': round(elapsed, 6),
+            'ops_per_sec': round(n / elapsed, 3) if elapsed else None,
+            'mb_per_sec': round(size * n / elapsed / (1 << 20), 3) if elapsed and size else None,
+            'items_per_sec': round(items * n / elapsed, 3) if elapsed else None,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'max_ms': round(max(latencies) * 1000, 3),
+            'requests': counts,
+            'requests_per_op': round(sum(counts.values()) / float(n), 3) if counts is not None else None,
+            'retries': throttle.retries - retries,
+            'throttled': throttle.throttled - throttled,
+            'peak_rss_kb': peak_rss_kb(),
+        }
+        self.results.append(r)
+        print >> sys.stderr, '{n:<16} {o:>6} ops {s:>9.3f}s {ops:>10.1f} ops/s {mb:>9} MB/s p50 {p50:>9.3f}ms p99 {p99:>9.3f}ms'.format(
+            n=name, o=n, s=elapsed, ops=r['ops_per_sec'] or 0, mb=r['mb_per_sec'] or '-',
+            p50=r['p50_ms'], p99=r['p99_ms'])
+        return r
+
+    def small(self):
+        a = self.args
+        b = self.bucket
+        src = self.make_file('small', a.small_size)
+        out = self.path('small.out')
+        keys = ['small/{i:06d}'.format(i=i) for i in xrange(a.small_count)]
+
+        self.measure('put-small', (['put', b + '/' + k, '-i', src] for k in keys), a.small_size)
+        self.measure('get-small', (['get', b + '/' + k, '-o', out] for k in keys), a.small_size)
+        self.measure('copy-small', (['copy', b + '/' + k, b + '/small-copy/' + k] for k in keys), a.small_size)
+        self.measure('delete-small', (['delete', b + '/' + k] for k in keys))
+        self.command(['delete', b, '--prefix', 'small-copy/'])
+
+    def large(self):
+        a = self.args
+        b = self.bucket
+        src = self.make_file('large', a.large_size)
+        out = self.path('large.out')
+        keys = ['large/{i:03d}'.format(i=i) for i in xrange(a.large_count)]
+        multipart = ['--multipart-threshold', str(a.part_size), '--part-size', str(a.part_size),
+                     '--concurrency', str(a.concurrency)]
+
+        self.measure('put-large', (['put', b + '/' + k, '-i', src] + multipart for k in keys), a.large_size)
+        self.measure('get-large', (['get', b + '/' + k, '-o', out, '--concurrency', str(a.concurrency),
+                                    '--range-size', str(a.part_size)] for k in keys), a.large_size)
+        self.measure('copy-large', (['copy', b + '/' + k, b + '/large-copy/' + k] + multipart
+                                    for k in keys), a.large_size)
+        self.command(['delete', b, '--prefix', 'large'])
+
+    def list(self):
+        a = self.args
+        b = self.bucket
+        keys = ['list/{d:03d}/{i:06d}'.format(d=i % 100, i=i) for i in xrange(a.list_count)]
+
+        # seeding is not measured
+        def put_empty(k):
+            self.obo.request(lambda: self.obo.get_bucket(b, validate=False).new_key(k).set_contents_from_string(''))
+        for _ in self.obo.engine.map(put_empty, keys, a.concurrency):
+            pass
+
+        page = ['--max-keys', str(a.page_size)]
+        self.measure('list', (['list', b, '--prefix', 'list/', '--all'] + page
+                              for _ in xrange(a.repeat)), items=a.list_count)
+        self.measure('list-parallel', (['list', b, '--prefix', 'list/', '--parallel', str(a.concurrency)] + page
+                                       for _ in xrange(a.repeat)), items=a.list_count)
+        self.measure('delete-bulk', [['delete', b, '--prefix', 'list/',
+                                      '--concurrency', str(a.concurrency)]], items=a.list_count)
+
+    def startup(self):
+        a = self.args
+        n = a.startup_count
+        self.measure('startup-python', [None] * n, run=self.spawn)
+        r = self.measure('startup-help', [['--help']] * n, run=self.spawn)
+        r['budget_ms'] = a.startup_budget_ms
+        if r['p50_ms'] > a.startup_budget_ms:
+            self.over_budget = True
+            print >> sys.stderr, 'WARNING: obo --help took {t:.1f}ms, over the startup budget of {b:.1f}ms'.format(
+                t=r['p50_ms'], b=a.startup_budget_ms)
+        self.measure('startup-stat', [['stat', self.bucket]] * n, run=self.spawn)
+
+    def run(self, workloads):
+        self.command(['create', self.bucket])
+        try:
+            for w in workloads:
+                getattr(self, w)()
+        finally:
+            self.command(['delete', self.bucket, '--prefix', ''])
+            self.command(['delete', self.bucket])
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+        return self.results
+
+
+WORKLOADS = ['small', 'large', 'list', 'startup']
+
+
+def compare(results, baseline):
+    '''
+    Prints the change in throughput and p99 latency of each result
+    against the same result in baseline.
+    '''
+    base = dict((r['name'], r) for r in baseline['results'])
+    for r in results:
+        b = base.get(r['name'])
+        if not b or not b['ops_per_sec'] or not b['p99_ms']:
+            continue
+        print >> sys.stderr, '{n:<16} ops/s {o:+7.1f}%  p99 {p:+7.1f}%'.format(
+            n=r['name'], o=(r['ops_per_sec'] / b['ops_per_sec'] - 1) * 100,
+            p=(r['p99_ms'] / b['p99_ms'] - 1) * 100)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark obo against a local S3 stand-in',
+        usage='python -m obo.bench [<args>]')
+    parser.add_argument('--workloads', default=','.join(WORKLOADS),
+                        help='Comma separated workloads to run: ' + ', '.join(WORKLOADS))
+    parser.add_argument('--endpoint',
+                        help='Use this <host>:<port>[,...] instead of starting a stand-in; '
+                             'credentials come from S3_ACCESS_KEY_ID/S3_SECRET_ACCESS_KEY')
+    parser.add_argument('--in-process', action='store_true',
+                        help='Run the stand-in on a thread of this process')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the stand-in adds to every request')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Up to this many seconds the stand-in adds to every request at random')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests the stand-in fails with 503 SlowDown')
+    parser.add_argument('--max-inflight', type=int,
+                        help='Requests in flight on a gateway beyond which the stand-in fails them with 503 SlowDown')
+    parser.add_argument('--gateways', type=int, default=1,
+                        help='Number of gateways (ports) the stand-in serves on')
+    parser.add_argument('--bucket', help='Bucket to create and remove (default: obo-bench-<pid>)')
+    parser.add_argument('--small-count', type=int, default=200)
+    parser.add_argument('--small-size', type=obo_mod.parse_size, default='4K')
+    parser.add_argument('--large-count', type=int, default=2)
+    parser.add_argument('--large-size', type=obo_mod.parse_size, default='64M')
+    parser.add_argument('--part-size', type=obo_mod.parse_size, default='8M')
+    parser.add_argument('--list-count', type=int, default=5000)
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='Keys per listing page')
+    parser.add_argument('--startup-count', type=int, default=20,
+                        help='Number of processes to start for each startup measurement')
+    parser.add_argument('--startup-budget-ms', type=float, default=50,
+                        help='Median milliseconds obo --help may take to run as a process of its own')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of times to repeat each listing')
+    parser.add_argument('-o', '--out-file', help='Write the JSON results here instead of stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    workloads = [w for w in args.workloads.split(',') if w]
+    for w in workloads:
+        if w not in WORKLOADS:
+            print 'ERROR: unknown workload:', w
+            sys.exit(1)
+
+    server = None
+    if args.endpoint:
+        endpoint = args.endpoint
+        access_key = os.environ['S3_ACCESS_KEY_ID']
+        secret_key = os.environ['S3_SECRET_ACCESS_KEY']
+    else:
+        if args.in_process:
+            server = standin.Standin(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                                     max_inflight=args.max_inflight, gateways=args.gateways).start()
+        else:
+            server = StandinProcess(args.latency, args.jitter, args.error_rate, args.max_inflight,
+                                    args.gateways)
+        endpoint = server.endpoint
+        access_key = secret_key = 'obo-bench'
+
+    started = time.time()
+    try:
+        o = obo_mod.OBO(access_key, secret_key, endpoint)
+        bench = OboBench(o, args, endpoint)
+        results = bench.run(workloads)
+    finally:
+        if server:
+            server.stop()
+
+    doc = {
+        'obo_bench': 1,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(started)),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'endpoint': 'standin' if server else endpoint,
+        'standin': 'in-process' if args.in_process else 'process' if server else None,
+        'config': dict((k, v) for k, v in vars(args).items() if k not in ('out_file', 'compare')),
+        'results': results,
+    }
+    s = json.dumps(doc, indent=4, sort_keys=True)
+    if args.out_file:
+        with open(args.out_file, 'w') as f:
+            f.write(s + '\n')
+    else:
+        print s
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    if bench.over_budget:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
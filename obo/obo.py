@@ -1,356 +1,3570 @@
 import sys
-import socket
 import os
-import boto
-import boto.s3.connection
+import stat
 import argparse
 import json
-from boto.s3.key import Key
+import shlex
+import random
+import re
+import base64
+import bisect
+import calendar
+import collections
+import hashlib
+import threading
+import time
+import Queue
+from StringIO import StringIO
 
 
+class LazyModule(object):
+    '''
+    Stands in for a module until one of its attributes is used, then
+    imports it (and the given submodules) and takes its place in this
+    module's globals. boto alone takes several times as long to import
+    as the rest of obo, and most invocations of --help or of commands
+    that fail argument parsing never need it.
+    '''
+    def __init__(self, name, *submodules):
+        self.__dict__['name'] = name
+        self.__dict__['submodules'] = submodules
+
+    def __getattr__(self, attr):
+        module = __import__(self.name)
+        for submodule in self.submodules:
+            __import__(submodule)
+        globals()[self.name] = module
+        return getattr(module, attr)
+
+boto = LazyModule('boto', 'boto.exception', 'boto.handler', 'boto.utils', 'boto.s3.connection',
+                  'boto.s3.bucket', 'boto.s3.key', 'boto.s3.prefix', 'boto.s3.deletemarker',
+                  'boto.s3.user', 'boto.s3.multipart', 'boto.s3.multidelete', 'boto.s3.lifecycle',
+                  'boto.s3.website')
+cProfile = LazyModule('cProfile')
+csv = LazyModule('csv')
+httplib = LazyModule('httplib')
+mmap = LazyModule('mmap')
+multiprocessing = LazyModule('multiprocessing')
+socket = LazyModule('socket')
+urllib = LazyModule('urllib')
+sqlite3 = LazyModule('sqlite3')
+xml = LazyModule('xml', 'xml.sax', 'xml.sax.saxutils', 'xml.etree.ElementTree')
+
+
+OboHTTPConnection = None
+
+def http_connection_class():
+    '''
+    Returns OboHTTPConnection, which is only defined on first use as it
+    derives from httplib's connection.
+    '''
+    global OboHTTPConnection
+    if OboHTTPConnection:
+        return OboHTTPConnection
+
+    class OboHTTPConnection(httplib.HTTPConnection):
+        '''
+        HTTP connection with Nagle's algorithm turned off. boto writes the
+        headers and the body of a request separately, which otherwise stalls
+        small uploads on the server's delayed ACK.
+
+        Server errors are raised straight from getresponse(), past boto's own
+        retry loop (which sleeps even when told not to retry); retrying is up
+        to OBO.request().
+
+        With STATS set, every request is timed from putrequest() to its
+        response headers and recorded there.
+        '''
+        trace = None
+
+        def connect(self):
+            start = time.time()
+            httplib.HTTPConnection.connect(self)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if STATS:
+                elapsed = time.time() - start
+                STATS.phase('connect', elapsed)
+                if self.trace:
+                    self.trace[4] += elapsed
+
+        def putrequest(self, method, url, *args, **kwargs):
+            if STATS:
+                # method, url, start, bytes sent, seconds spent connecting
+                self.trace = [method, url, time.time(), 0, 0.0]
+            httplib.HTTPConnection.putrequest(self, method, url, *args, **kwargs)
+
+        def send(self, data):
+            if self.trace:
+                self.trace[3] += len(data)
+            httplib.HTTPConnection.send(self, data)
+
+        def getresponse(self, *args, **kwargs):
+            try:
+                resp = httplib.HTTPConnection.getresponse(self, *args, **kwargs)
+            except Exception:
+                self.record(None)
+                raise
+            self.record(resp)
+            if resp.status in SERVER_ERROR_STATUSES:
+                raise boto.exception.S3ResponseError(resp.status, resp.reason, resp.read())
+            return resp
+
+        def record(self, resp):
+            if not self.trace:
+                return
+            method, url, start, sent, connecting = self.trace
+            self.trace = None
+            received = 0
+            if resp is not None and method != 'HEAD':
+                received = int(resp.getheader('content-length') or 0)
+            STATS.request(method, url, resp.status if resp is not None else None, sent, received,
+                          time.time() - start, connecting, '{h}:{p}'.format(h=self.host, p=self.port))
+    return OboHTTPConnection
+
 class OBO:
-    def __init__(self, access_key, secret_key, host):
-        host, port = (host.split(':') + [None])[:2]
-        if port:
-            port = int(port)
-
-        self.conn = boto.connect_s3(
-                aws_access_key_id = access_key,
-                aws_secret_access_key = secret_key,
-                host=host,
-                port=port,
+    def __init__(self, access_key, secret_key, host, concurrency = None, engine = None):
+        # host is a comma separated list of the gateways of one cluster
+        self.endpoints = OboEndpoints(host, os.environ.get('OBO_ENDPOINT_POLICY', ENDPOINT_POLICIES[0]))
+        host, port = self.endpoints.endpoints[0].host, self.endpoints.endpoints[0].port
+
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.host = host
+        self.port = port
+        # connections are made on first use, by each thread (see conn)
+        self.local = threading.local()
+        self.connection = OboConnection(self)
+
+        if not concurrency and os.environ.get('OBO_CONCURRENCY'):
+            concurrency = int(os.environ['OBO_CONCURRENCY'])
+        # the gateways share the load, so keep as many requests in flight
+        # on each of them as there would be on a single one
+        self.engine = engine or OboEngine(concurrency or DEFAULT_CONCURRENCY * len(self.endpoints.endpoints))
+        self.throttle = OboThrottle()
+        self.max_attempts = int(os.environ.get('OBO_MAX_ATTEMPTS', RETRY_MAX_ATTEMPTS))
+
+        cache_id = hashlib.sha1('{h}:{p}:{a}'.format(h=host, p=port, a=access_key)).hexdigest()[:16]
+        ttl = int(os.environ.get('OBO_BUCKET_CACHE_TTL', 0))
+        cache_path = None
+        if ttl > 0:
+            cache_dir = os.environ.get('OBO_BUCKET_CACHE_DIR', os.path.expanduser('~/.cache/obo'))
+            cache_path = os.path.join(cache_dir, 'buckets-{i}.json'.format(i=cache_id))
+        self.bucket_cache = OboBucketCache(cache_path, ttl)
+
+        self.journal_dir = os.path.join(os.environ.get('OBO_JOURNAL_DIR', os.path.expanduser('~/.cache/obo')),
+                                        'journal-{i}'.format(i=cache_id))
+        self.journal_ttl = int(os.environ.get('OBO_JOURNAL_TTL', JOURNAL_TTL))
+        self.index_path = os.path.join(os.environ.get('OBO_INDEX_DIR', os.path.expanduser('~/.cache/obo')),
+                                       'index-{i}.sqlite'.format(i=cache_id))
+
+    def connect(self, endpoint):
+        conn = boto.connect_s3(
+                aws_access_key_id = self.access_key,
+                aws_secret_access_key = self.secret_key,
+                host=endpoint.host,
+                port=endpoint.port,
                 is_secure=False,               # uncomment if you are not using ssl
                 calling_format = boto.s3.connection.OrdinaryCallingFormat(),
+                https_connection_factory = (http_connection_class(), ()),
                 )
+        # retries are up to request(), which knows what is safe to retry
+        # and backs off for everyone when throttled
+        conn.num_retries = 0
+        return conn
+
+    def request(self, func, idempotent = True):
+        '''
+        Calls func, which makes one request, and returns what it returns.
+        Throttled requests, and failed idempotent ones, are retried with
+        exponential backoff and full jitter, up to max_attempts in all.
+        Each attempt goes to the endpoint picked for it (see conn), so a
+        retry usually goes to another gateway than the one that failed.
+        '''
+        attempt = 1
+        while True:
+            self.throttle.acquire()
+            endpoint = self.endpoints.acquire()
+            outer = getattr(self.local, 'endpoint', None)
+            self.local.endpoint = endpoint
+            throttled = retry = False
+            error = None
+            try:
+                return func()
+            except Exception as e:
+                error = e
+                throttled = is_throttled(e)
+                retry = attempt < self.max_attempts and is_retryable(e, idempotent)
+                if not retry:
+                    raise
+            finally:
+                self.local.endpoint = outer
+                self.endpoints.release(endpoint, error)
+                self.throttle.release(throttled, retry)
+            time.sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+            attempt += 1
+
+    def for_host(self, host):
+        '''
+        Returns an OBO for another endpoint, with the same credentials,
+        whose requests run on the same engine. The same one if host is None.
+        '''
+        if not host:
+            return self
+        return OBO(self.access_key, self.secret_key, host, engine=self.engine)
+
+    @property
+    def conn(self):
+        '''
+        The calling thread's connection to the endpoint picked for the
+        request it is making, or outside of request() to the one that
+        would be picked next.
+        '''
+        endpoint = getattr(self.local, 'endpoint', None) or self.endpoints.select()
+        # worker threads get their own keep-alive connection to each endpoint
+        conns = getattr(self.local, 'conns', None)
+        if conns is None:
+            conns = self.local.conns = {}
+        conn = conns.get(endpoint)
+        if not conn:
+            conn = conns[endpoint] = self.connect(endpoint)
+        return conn
+
+    def get_bucket(self, bucket_name, validate = True):
+        '''
+        Returns a handle for the bucket, whose requests go out on the
+        connection of whichever thread makes them (see OboConnection).
+        With validate, checks that the bucket exists (and returns None if
+        it does not), unless it is already known to.
+        '''
+        if validate and not self.bucket_cache.get(bucket_name, 'exists'):
+            if not self.request(lambda: self.lookup(bucket_name)):
+                return None
+            self.bucket_cache.set(bucket_name, exists=True)
+        return boto.s3.bucket.Bucket(self.connection, bucket_name)
+
+    def lookup(self, bucket_name):
+        '''
+        Returns whether the bucket exists. Unlike boto's lookup(), which
+        takes any error for a missing bucket, server errors are raised so
+        that request() can retry them.
+        '''
+        try:
+            self.conn.get_bucket(bucket_name, validate=True)
+        except boto.exception.S3ResponseError as error:
+            if error.status in SERVER_ERROR_STATUSES:
+                raise
+            return False
+        return True
+
+    def get_versioning_status(self, bucket_name):
+        status = self.bucket_cache.get(bucket_name, 'versioning')
+        if status is None:
+            bucket = self.get_bucket(bucket_name, validate=False)
+            status = self.request(bucket.get_versioning_status)
+            self.bucket_cache.set(bucket_name, exists=True, versioning=status)
+        return status
+
+
+class OboConnection(object):
+    '''
+    Stands in for the boto connection of bucket and key handles, and
+    passes everything on to OBO.conn. Handles can then be made once and
+    used from any thread, and their requests still go to the endpoint
+    that request() picked for them.
+    '''
+    def __init__(self, obo):
+        self.obo = obo
+
+    def __getattr__(self, attr):
+        return getattr(self.obo.conn, attr)
+
+ENDPOINT_POLICIES = ['least-outstanding', 'round-robin']
+ENDPOINT_EJECT_FAILURES = 3
+ENDPOINT_EJECT_SECONDS = 5.0
+ENDPOINT_EJECT_MAX_SECONDS = 120.0
+
+class OboEndpoint:
+    def __init__(self, spec):
+        host, port = (spec.split(':') + [None])[:2]
+        self.host = host
+        self.port = int(port) if port else None
+        self.outstanding = 0
+        self.failures = 0
+        self.eject_seconds = ENDPOINT_EJECT_SECONDS
+        self.ejected_until = 0
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+
+    def __str__(self):
+        if self.port:
+            return '{h}:{p}'.format(h=self.host, p=self.port)
+        return self.host
+
+def is_endpoint_failure(e):
+    '''
+    Returns whether e says more about the gateway than about the request:
+    it could not be reached, dropped the connection or failed with a
+    server error. Being asked to slow down is left to OboThrottle.
+    '''
+    if isinstance(e, boto.exception.BotoServerError):
+        return e.status in SERVER_ERROR_STATUSES and not is_throttled(e)
+    return isinstance(e, (socket.error, httplib.HTTPException))
+
+class OboEndpoints:
+    '''
+    Spreads requests over the gateways of a cluster, given as a comma
+    separated list of <host>[:<port>]. Each request goes to the one with
+    the fewest requests outstanding (ties, and the round-robin policy,
+    take them in turn). Health is checked passively: a gateway that fails
+    ENDPOINT_EJECT_FAILURES requests in a row is left out for a while,
+    then given requests again; one that fails again straight away is left
+    out for twice as long, up to ENDPOINT_EJECT_MAX_SECONDS. If all of
+    them are out, the one due back first is used anyway.
+    '''
+    def __init__(self, hosts, policy = ENDPOINT_POLICIES[0]):
+        if policy not in ENDPOINT_POLICIES:
+            raise ValueError('unknown endpoint policy: ' + policy)
+        self.endpoints = [OboEndpoint(h.strip()) for h in hosts.split(',') if h.strip()]
+        if not self.endpoints:
+            raise ValueError('no endpoint given')
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def select(self):
+        '''
+        Returns the endpoint the next request should go to.
+        '''
+        if len(self.endpoints) == 1:
+            return self.endpoints[0]
+        with self.lock:
+            n = len(self.endpoints)
+            order = [self.endpoints[(self.next + i) % n] for i in xrange(n)]
+            self.next = (self.next + 1) % n
+            now = time.time()
+            healthy = [e for e in order if e.ejected_until <= now]
+            if not healthy:
+                return min(order, key=lambda e: e.ejected_until)
+            if self.policy == 'round-robin':
+                return healthy[0]
+            return min(healthy, key=lambda e: e.outstanding)
+
+    def acquire(self):
+        endpoint = self.select()
+        with self.lock:
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+        return endpoint
+
+    def release(self, endpoint, error = None):
+        with self.lock:
+            endpoint.outstanding -= 1
+            if error is None or not is_endpoint_failure(error):
+                endpoint.failures = 0
+                endpoint.eject_seconds = ENDPOINT_EJECT_SECONDS
+                return
+            endpoint.errors += 1
+            endpoint.failures += 1
+            now = time.time()
+            if len(self.endpoints) == 1 or endpoint.failures < ENDPOINT_EJECT_FAILURES or \
+                    endpoint.ejected_until > now:
+                return
+            if endpoint.failures > ENDPOINT_EJECT_FAILURES:
+                # failed again on its return
+                endpoint.eject_seconds = min(endpoint.eject_seconds * 2, ENDPOINT_EJECT_MAX_SECONDS)
+            endpoint.ejected_until = now + endpoint.eject_seconds
+            endpoint.ejections += 1
+        print >> sys.stderr, 'WARNING: leaving out endpoint %s for %ds after %d failed requests: %s' % (
+            endpoint, endpoint.eject_seconds, endpoint.failures, error)
+
+class OboBucketCache:
+    '''
+    Memo of what is known about buckets (whether they exist, their
+    versioning status), kept for the life of the process. If a path and a
+    ttl are given, it is also shared between runs through that file, and
+    entries are trusted for ttl seconds.
+    '''
+    def __init__(self, path = None, ttl = 0):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    entries = json.load(f)
+            except (IOError, ValueError):
+                entries = {}
+            now = time.time()
+            self.entries = dict((name, e) for name, e in entries.items() if e.get('time', 0) + ttl > now)
+
+    def get(self, bucket_name, field):
+        with self.lock:
+            return self.entries.get(bucket_name, {}).get(field)
+
+    def set(self, bucket_name, **fields):
+        with self.lock:
+            entry = self.entries.setdefault(bucket_name, {})
+            entry.update(fields)
+            entry['time'] = time.time()
+            self.save()
+
+    def invalidate(self, bucket_name):
+        with self.lock:
+            self.entries.pop(bucket_name, None)
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            cache_dir = os.path.dirname(self.path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = '{p}.{pid}'.format(p=self.path, pid=os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as error:
+            print >> sys.stderr, 'WARNING: could not write bucket cache %s: %s' % (self.path, error)
+
+JOURNAL_TTL = 7 * 24 * 3600
+
+class OboJournal:
+    '''
+    Checkpoint of a long transfer, so that one that was interrupted can
+    pick up where it left off. The journal is a file of JSON lines: the
+    first describes the transfer, each of the others records a piece of
+    it that is done. Lines are only ever appended, and a torn last line
+    is ignored, so the journal stays usable however the process died.
+    '''
+    def __init__(self, obo, op, bucket_name, key_name, local_path, **source):
+        self.obo = obo
+        self.transfer = { 'op': op, 'bucket': bucket_name, 'key': key_name,
+                          'file': os.path.abspath(local_path) }
+        self.source = source
+        name = hashlib.sha1(json.dumps(sorted(self.transfer.items()))).hexdigest()[:16]
+        self.path = os.path.join(obo.journal_dir, name + '.journal')
+        self.f = None
+        self.header, self.records = read_journal(self.path)
+
+    def matches(self):
+        '''
+        Returns whether the journal is of this transfer, from a source
+        that has not changed since.
+        '''
+        if not self.header:
+            return False
+        return all(self.header.get(k) == v for k, v in self.source.items())
+
+    def start(self, **fields):
+        if not os.path.isdir(self.obo.journal_dir):
+            os.makedirs(self.obo.journal_dir)
+        self.header = dict(self.transfer, time=time.time(), **dict(self.source, **fields))
+        self.records = []
+        self.f = open(self.path, 'w')
+        self.write(self.header)
+
+    def resume(self):
+        self.f = open(self.path, 'a')
+
+    def record(self, rec):
+        self.records.append(rec)
+        self.write(rec)
+
+    def write(self, rec):
+        self.f.write(json.dumps(rec) + '\n')
+        self.f.flush()
+
+    def remove(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.header = None
+        self.records = []
+
+def read_journal(path):
+    '''
+    Returns the header and records of the journal at path, or (None, [])
+    if there is none.
+    '''
+    header = None
+    records = []
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break
+                if header is None:
+                    header = rec
+                else:
+                    records.append(rec)
+    except IOError:
+        pass
+    return header, records
+
+def discard_journal(obo, header):
+    '''
+    Cleans up after the transfer a journal describes, which is not going
+    to be resumed: its multipart upload, if any, is aborted.
+    '''
+    if header.get('op') != 'put' or not header.get('upload_id'):
+        return
+    mpu = OboMultipartUpload(obo, header['bucket'], header['key'], query_args=header.get('query_args'))
+    mpu.upload_id = header['upload_id']
+    try:
+        mpu.abort()
+    except boto.exception.S3ResponseError as error:
+        if error.status != 404:
+            print >> sys.stderr, 'WARNING: could not abort multipart upload %s: %s' % (mpu.upload_id, error)
+
+def expire_journals(obo):
+    '''
+    Discards the journals of transfers that have not been resumed within
+    the journal ttl, so that their multipart uploads don't linger.
+    '''
+    if not os.path.isdir(obo.journal_dir):
+        return
+    now = time.time()
+    for name in os.listdir(obo.journal_dir):
+        path = os.path.join(obo.journal_dir, name)
+        try:
+            if os.path.getmtime(path) + obo.journal_ttl > now:
+                continue
+        except OSError:
+            continue
+        header, records = read_journal(path)
+        if header:
+            discard_journal(obo, header)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def append_attr_value(d, attr, attrv):
+    if attrv and len(str(attrv)) > 0:
+        d[attr] = attrv
+
+def append_query_arg(s, n, v):
+    if not v:
+        return s
+    nv = '{n}={v}'.format(n=n, v=v)
+    if not s:
+        return nv
+    return '{s}&{nv}'.format(s=s, nv=nv)
+
+def join_query_args(*args):
+    return '&'.join([a for a in args if a])
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def read_key_list(infile):
+    '''
+    Yields (key, version_id) from lines of <key>[<tab><version-id>].
+    '''
+    for line in infile:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        key, _, version_id = line.decode('utf-8').partition('\t')
+        yield key, version_id or None
+
+SIZE_SUFFIXES = { 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40 }
+
+def parse_size(s):
+    s = s.strip().upper().rstrip('B')
+    if s and s[-1] in SIZE_SUFFIXES:
+        return int(float(s[:-1]) * SIZE_SUFFIXES[s[-1]])
+    return int(s)
+
+TIME_SUFFIXES = { 's': 1, 'm': 60, 'h': 3600, 'd': 24 * 3600, 'w': 7 * 24 * 3600 }
+
+def parse_time(s):
+    '''
+    Parses a UTC date or time in ISO 8601, or an age like 7d or 12h, into
+    the ISO 8601 form that compares with the last_modified of listings.
+    '''
+    s = s.strip()
+    if s and s[-1] in TIME_SUFFIXES and s[:-1].replace('.', '', 1).isdigit():
+        t = time.gmtime(time.time() - float(s[:-1]) * TIME_SUFFIXES[s[-1]])
+        return time.strftime('%Y-%m-%dT%H:%M:%S', t)
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return time.strftime('%Y-%m-%dT%H:%M:%S', time.strptime(s.rstrip('Z'), fmt))
+        except ValueError:
+            pass
+    raise ValueError('invalid time: ' + s)
+
+def get_file_size(f):
+    try:
+        st = os.fstat(f.fileno())
+    except (AttributeError, OSError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return st.st_size
+
+DEFAULT_CONCURRENCY = 8
+
+class OboEngine:
+    '''
+    Runs the concurrent requests of all commands on long lived worker
+    threads. Each worker keeps its own keep-alive connection to each
+    endpoint (see OBO.conn), so connections are reused from one operation
+    to the next and there are never more of them per endpoint than
+    workers. Work submitted from a worker goes to a pool of its own, so
+    nested fan-outs (the parts of each key of a recursive copy, the
+    commands of a batch) cannot starve each other of workers.
+
+    Results are consumed as streams: map, map_ordered and chain are
+    generators that keep at most limit requests in flight.
+    '''
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY
+        self.pools = {}
+        # pool -> number of callers holding it
+        self.holds = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def limit(self, limit=None):
+        '''
+        Returns limit, or the engine wide concurrency if it is not set.
+        '''
+        return limit or self.concurrency
+
+    def init_worker(self, depth):
+        self.local.depth = depth
+
+    def pool(self, size):
+        '''
+        Returns the pool for the calling thread, with at least size workers,
+        held by the caller until it passes it to release(). Another caller
+        at the same depth that needs more workers gets a bigger pool, which
+        replaces this one for later callers; this one is only closed once
+        nothing holds it any more.
+        '''
+        depth = getattr(self.local, 'depth', 0)
+        with self.lock:
+            pool, pool_size = self.pools.get(depth, (None, 0))
+            if size > pool_size:
+                from multiprocessing.pool import ThreadPool
+                old = pool
+                pool = ThreadPool(size, self.init_worker, (depth + 1,))
+                self.pools[depth] = (pool, size)
+                if old and not self.holds.get(old):
+                    # let the old workers finish what they have and exit
+                    old.close()
+            self.holds[pool] = self.holds.get(pool, 0) + 1
+            return pool
+
+    def release(self, pool):
+        with self.lock:
+            self.holds[pool] -= 1
+            if self.holds[pool]:
+                return
+            del self.holds[pool]
+            if pool not in [p for p, _ in self.pools.values()]:
+                pool.close()
+
+    def submit(self, func, *args):
+        '''
+        Runs func(*args) on a worker, and returns its AsyncResult.
+        '''
+        pool = self.pool(self.concurrency)
+        try:
+            # a closed pool still runs what was queued before
+            return pool.apply_async(func, args)
+        finally:
+            self.release(pool)
+
+    def map(self, func, items, limit=None):
+        '''
+        Runs func on each of items, and yields (item, result) tuples in
+        completion order. No more than limit items are pulled from the
+        items iterator ahead of the consumer, so items can be a generator
+        over an arbitrarily large input. If the consumer stops early, the
+        requests in flight are waited for.
+        '''
+        limit = self.limit(limit)
+        pool = self.pool(limit)
+        done = Queue.Queue()
+
+        def run(item):
+            try:
+                done.put((item, func(item), None))
+            except:
+                done.put((item, None, sys.exc_info()))
+
+        inflight = [0]
+
+        def get_result():
+            item, result, exc_info = done.get()
+            inflight[0] -= 1
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            return item, result
+
+        try:
+            for item in items:
+                if inflight[0] >= limit:
+                    yield get_result()
+                pool.apply_async(run, (item,))
+                inflight[0] += 1
+
+            while inflight[0] > 0:
+                yield get_result()
+        finally:
+            while inflight[0] > 0:
+                done.get()
+                inflight[0] -= 1
+            self.release(pool)
+
+    def map_ordered(self, func, items, limit=None, window=None):
+        '''
+        Like map, but yields (item, result) tuples in the order of items.
+        At most window (by default twice limit) items are in flight or
+        waiting to be yielded, which bounds the memory held by completed
+        out-of-order results.
+        '''
+        limit = self.limit(limit)
+        window = window or limit * 2
+        pool = self.pool(limit)
+        pending = collections.deque()
+        try:
+            for item in items:
+                if len(pending) >= window:
+                    i, r = pending.popleft()
+                    yield i, r.get()
+                pending.append((item, pool.apply_async(func, (item,))))
+
+            while pending:
+                i, r = pending.popleft()
+                yield i, r.get()
+        finally:
+            for _, r in pending:
+                r.wait()
+            self.release(pool)
+
+    def chain(self, iterables, depth, limit=None):
+        '''
+        Yields the items of each of iterables in turn, like itertools.chain,
+        while up to limit of the iterables are consumed ahead on workers.
+        Each buffers at most depth items ahead of the caller.
+        '''
+        limit = self.limit(limit)
+        end = object()
+        stop = threading.Event()
+
+        def put(q, v):
+            while not stop.is_set():
+                try:
+                    q.put(v, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def drain(it, q):
+            try:
+                for item in it:
+                    if not put(q, (item, None)):
+                        return
+                put(q, (end, None))
+            except:
+                put(q, (end, sys.exc_info()))
+
+        iterables = list(iterables)
+        started = []
+        pool = self.pool(limit)
+
+        def start(i):
+            if i < len(iterables):
+                q = Queue.Queue(depth)
+                started.append((q, pool.apply_async(drain, (iterables[i], q))))
+
+        try:
+            for i in xrange(limit):
+                start(i)
+
+            for i in xrange(len(iterables)):
+                q = started[i][0]
+                while True:
+                    item, exc_info = q.get()
+                    if exc_info:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    if item is end:
+                        break
+                    yield item
+                start(i + limit)
+        finally:
+            stop.set()
+            for _, r in started:
+                r.wait()
+            self.release(pool)
+
+    def close(self):
+        with self.lock:
+            pools = self.pools.values()
+            self.pools = {}
+            self.holds = {}
+        for pool, _ in pools:
+            pool.close()
+            pool.join()
+
+RETRY_MAX_ATTEMPTS = 10
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 20.0
+THROTTLE_DECREASE_INTERVAL = 1.0
+SERVER_ERROR_STATUSES = (500, 502, 503, 504)
+THROTTLE_ERROR_CODES = ('SlowDown', 'ServiceUnavailable', 'TooManyRequests')
+
+def is_throttled(e):
+    '''
+    Returns whether e is the gateway asking to slow down. Such requests
+    were not carried out and can be retried whatever they were.
+    '''
+    return isinstance(e, boto.exception.BotoServerError) and \
+        (e.status == 503 or e.error_code in THROTTLE_ERROR_CODES)
+
+def is_retryable(e, idempotent):
+    '''
+    Returns whether a request that failed with e can be sent again.
+    Server errors and lost connections leave it unknown whether the
+    request was carried out, so only idempotent ones are retried.
+    '''
+    if is_throttled(e):
+        return True
+    if not idempotent:
+        return False
+    if isinstance(e, boto.exception.BotoServerError):
+        return e.status in SERVER_ERROR_STATUSES or e.error_code in ('RequestTimeout', 'InternalError')
+    return isinstance(e, (socket.error, httplib.HTTPException, boto.exception.S3DataError))
+
+class OboThrottle:
+    '''
+    Adapts the number of requests in flight to what the gateway takes,
+    AIMD style. The window is unlimited until a request is throttled;
+    then it is halved (at most once per THROTTLE_DECREASE_INTERVAL, so
+    that one overload counts once however many requests it fails), and
+    each request that goes through grows it by 1/window, i.e. by about
+    one per window's worth of requests.
+    '''
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.inflight = 0
+        self.window = None
+        self.last_decrease = 0
+        self.throttled = 0
+        self.retries = 0
+
+    def acquire(self):
+        with self.cond:
+            while self.window is not None and self.inflight >= int(self.window):
+                self.cond.wait(1.0)
+            self.inflight += 1
+
+    def release(self, throttled = False, retry = False):
+        with self.cond:
+            if retry:
+                self.retries += 1
+            if throttled:
+                self.throttled += 1
+                now = time.time()
+                if now - self.last_decrease >= THROTTLE_DECREASE_INTERVAL:
+                    # the window may have grown past what is actually in flight
+                    window = self.inflight if self.window is None else min(self.window, self.inflight)
+                    self.window = max(1.0, window / 2.0)
+                    self.last_decrease = now
+            elif self.window is not None:
+                self.window += 1.0 / self.window
+            self.inflight -= 1
+            self.cond.notify_all()
+
+class OboStatError(object):
+    '''
+    Takes the place of the key in the results of a batch stat when its
+    HEAD fails, e.g. with 404 if there is no such key.
+    '''
+    def __init__(self, name, version_id, status, error):
+        self.name = name
+        self.version_id = version_id
+        self.status = status
+        self.error = error
+
+STATS = None
+
+STATS_FORMATS = ['json', 'prometheus']
+# upper bounds of the request latency histogram, in seconds
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+PHASES = ['parse', 'connect', 'request', 'encode']
+
+def request_op(method, url):
+    '''
+    Returns the bucket a request is for, and what it is, e.g. "GET
+    object" or "GET bucket?versions".
+    '''
+    path, _, query = url.partition('?')
+    parts = path.lstrip('/').split('/', 1)
+    bucket = urllib.unquote(parts[0])
+    op = '{m} {t}'.format(m=method, t='service' if not bucket else 'object' if len(parts) == 2 and parts[1]
+                          else 'bucket')
+    sub = query.split('&', 1)[0].split('=', 1)[0]
+    if sub and not sub.startswith('rgwx-') and sub not in ('prefix', 'marker', 'max-keys', 'delimiter',
+                                                            'versionId', 'partNumber'):
+        op += '?' + sub
+    return bucket, op
+
+class OboStats:
+    '''
+    Instrumentation of a run, with --stats, --stats-file or $OBO_TRACE:
+    every HTTP request made is counted by operation and status, with
+    the bytes it sent and received and its latency (up to the response
+    headers) in a histogram, and the time spent in each of PHASES is
+    totalled. Phases are summed over threads, so with concurrency they
+    add up to more than the run took; request time leaves out the time
+    spent connecting. With trace, each request is also written to
+    stderr as a JSON line when its response comes in.
+    '''
+    def __init__(self, trace = False):
+        self.started = time.time()
+        self.trace = trace
+        # stderr may be replaced later on, e.g. by batch
+        self.out = sys.stderr
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.phases = dict((p, 0.0) for p in PHASES)
+        self.parsed = False
+
+    def phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] += seconds
+
+    def parse_done(self):
+        '''
+        Records the time up to now as parsing, the first time it is called.
+        '''
+        with self.lock:
+            if not self.parsed:
+                self.phases['parse'] += time.time() - self.started
+                self.parsed = True
+
+    def request(self, method, url, status, sent, received, seconds, connecting, endpoint):
+        bucket, op = request_op(method, url)
+        with self.lock:
+            acc = self.requests.get((op, status))
+            if acc is None:
+                acc = self.requests[op, status] = [0, 0, 0, 0.0]
+            acc[0] += 1
+            acc[1] += sent
+            acc[2] += received
+            acc[3] += seconds
+            self.histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.latency_sum += seconds
+            self.phases['request'] += seconds - connecting
+            if self.trace:
+                self.out.write(json.dumps(collections.OrderedDict([
+                    ('method', method), ('op', op), ('bucket', bucket), ('status', status),
+                    ('sent', sent), ('received', received), ('seconds', round(seconds, 6)),
+                    ('endpoint', endpoint)]), separators=(',', ':')) + '\n')
+
+    def totals(self, obo = None):
+        '''
+        Returns the stats as a dict, with the retries of obo and its
+        requests per endpoint if it is given.
+        '''
+        with self.lock:
+            requests = sorted(self.requests.items(), key=lambda r: (r[0][0], r[0][1] or 0))
+            d = collections.OrderedDict([
+                ('seconds', round(time.time() - self.started, 6)),
+                ('requests', [collections.OrderedDict([('op', op), ('status', status), ('count', n),
+                                                       ('sent', sent), ('received', received),
+                                                       ('seconds', round(t, 6))])
+                              for (op, status), (n, sent, received, t) in requests]),
+                ('latency', collections.OrderedDict([
+                    ('buckets', [[le, n] for le, n in zip(LATENCY_BUCKETS + ['+Inf'], self.histogram)]),
+                    ('sum', round(self.latency_sum, 6)),
+                    ('count', sum(self.histogram))])),
+                ('phases', collections.OrderedDict((p, round(self.phases[p], 6)) for p in PHASES)),
+            ])
+        if obo:
+            d['retries'] = obo.throttle.retries
+            d['throttled'] = obo.throttle.throttled
+            d['endpoints'] = [collections.OrderedDict([('endpoint', str(e)), ('requests', e.requests),
+                                                       ('errors', e.errors), ('ejections', e.ejections)])
+                              for e in obo.endpoints.endpoints]
+        return d
+
+    def summary(self, obo = None):
+        d = self.totals(obo)
+        out = self.out
+        n = d['latency']['count']
+        print >> out, 'obo: {n} requests in {s:.3f}s, {o} bytes sent, {i} bytes received'.format(
+            n=n, s=d['seconds'], o=sum(r['sent'] for r in d['requests']),
+            i=sum(r['received'] for r in d['requests']))
+        if 'retries' in d:
+            print >> out, '  {r} retries, {t} throttled'.format(r=d['retries'], t=d['throttled'])
+        for r in d['requests']:
+            print >> out, '  {op:<28} {st:>5} {n:>8} {ms:>10.3f}ms avg'.format(
+                op=r['op'], st=r['status'] or 'error', n=r['count'], ms=r['seconds'] * 1000 / r['count'])
+        if n:
+            print >> out, '  latency:'
+            # the empty buckets either side are left out
+            buckets = d['latency']['buckets']
+            used = [i for i, (_, count) in enumerate(buckets) if count]
+            for le, count in buckets[used[0]:used[-1] + 1]:
+                bound = '<= {ms:g}ms'.format(ms=le * 1000) if le != '+Inf' else '>  {ms:g}ms'.format(
+                    ms=LATENCY_BUCKETS[-1] * 1000)
+                print >> out, '    {b:<12} {c:>8} {bar}'.format(b=bound, c=count, bar='#' * int(round(40.0 * count / n)))
+        if len(d.get('endpoints', [])) > 1:
+            print >> out, '  endpoints:'
+            for e in d['endpoints']:
+                print >> out, '    {e:<26} {n:>8} requests {x:>6} errors {j:>4} ejections'.format(
+                    e=e['endpoint'], n=e['requests'], x=e['errors'], j=e['ejections'])
+        print >> out, '  phases (summed over threads):'
+        for p, t in d['phases'].items():
+            print >> out, '    {p:<12} {t:>10.3f}s'.format(p=p, t=t)
+
+    def prometheus(self, d, command):
+        '''
+        Returns d (see totals) in the Prometheus text format, for the
+        textfile collector.
+        '''
+        def labels(**kv):
+            kv['command'] = command
+            return '{' + ','.join('{k}="{v}"'.format(k=k, v=str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for k, v in sorted(kv.items())) + '}'
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append('# HELP {n} {h}'.format(n=name, h=help))
+            lines.append('# TYPE {n} {k}'.format(n=name, k=kind))
+            for suffix, l, v in samples:
+                lines.append('{n}{s}{l} {v}'.format(n=name, s=suffix, l=l, v=v))
+
+        r = d['requests']
+        metric('obo_requests_total', 'counter', 'HTTP requests made, by operation and status.',
+               [('', labels(op=x['op'], status=x['status'] or 'error'), x['count']) for x in r])
+        metric('obo_request_bytes_total', 'counter', 'Bytes of HTTP requests and responses.',
+               [('', labels(direction='sent'), sum(x['sent'] for x in r)),
+                ('', labels(direction='received'), sum(x['received'] for x in r))])
+        buckets = []
+        count = 0
+        for le, n in d['latency']['buckets']:
+            count += n
+            buckets.append(('_bucket', labels(le=le), count))
+        metric('obo_request_duration_seconds', 'histogram', 'Time from sending a request to its response headers.',
+               buckets + [('_sum', labels(), d['latency']['sum']), ('_count', labels(), d['latency']['count'])])
+        metric('obo_phase_seconds', 'gauge', 'Seconds spent in each phase of the run, summed over threads.',
+               [('', labels(phase=p), t) for p, t in d['phases'].items()])
+        if 'retries' in d:
+            metric('obo_retries_total', 'counter', 'Requests retried.', [('', labels(), d['retries'])])
+            metric('obo_throttled_total', 'counter', 'Requests throttled by the gateway.',
+                   [('', labels(), d['throttled'])])
+        metric('obo_run_seconds', 'gauge', 'Seconds the run took.', [('', labels(), d['seconds'])])
+        metric('obo_last_run_timestamp_seconds', 'gauge', 'When the run ended.',
+               [('', labels(), int(time.time()))])
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path, fmt, command, obo = None):
+        '''
+        Writes the stats to path, replacing it at once so that a
+        collector never reads a partial file.
+        '''
+        d = self.totals(obo)
+        if fmt == 'prometheus':
+            data = self.prometheus(d, command)
+        else:
+            d['command'] = command
+            data = json.dumps(d, indent=4) + '\n'
+        tmp_path = '{p}.{pid}'.format(p=path, pid=os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as error:
+            print >> self.out, 'WARNING: could not write stats to %s: %s' % (path, error)
+
+def encode_key_extra(k, d, versioned, fields):
+    if k.etag and (fields is None or 'etag' in fields):
+        d['etag'] = k.etag[1:-1]
+    if versioned and (fields is None or 'is_latest' in fields):
+        d['is_latest'] = k.is_latest
+
+def encode_delete_marker_extra(k, d, versioned, fields):
+    if fields is None or 'delete_marker' in fields:
+        d['delete_marker'] = True
+    if fields is None or 'is_latest' in fields:
+        d['is_latest'] = k.is_latest
+
+def encode_prefix_extra(k, d, versioned, fields):
+    if fields is None or 'prefix' in fields:
+        d['prefix'] = k.name
+
+# type -> (attributes, extra attributes, hook filling in the extras),
+# see encoders()
+ENCODERS = None
+
+def encoders():
+    '''
+    Returns ENCODERS, which is only built on first use as its keys are
+    boto types.
+    '''
+    global ENCODERS
+    if ENCODERS is not None:
+        return ENCODERS
+    ENCODERS = {
+        boto.s3.key.Key: (
+            ['name', 'size', 'last_modified', 'metadata', 'cache_control',
+             'content_type', 'content_disposition', 'content_language',
+             'owner', 'storage_class', 'md5', 'version_id', 'encrypted',
+             'delete_marker', 'expiry_date', 'VersionedEpoch'],
+            ['etag', 'is_latest'], encode_key_extra),
+        boto.s3.deletemarker.DeleteMarker: (
+            ['name', 'version_id', 'last_modified', 'owner'],
+            ['delete_marker', 'is_latest'], encode_delete_marker_extra),
+        boto.s3.prefix.Prefix: ([], ['prefix'], encode_prefix_extra),
+        OboStatError: (['name', 'version_id', 'status', 'error'], [], None),
+        boto.s3.user.User: (['id', 'display_name'], [], None),
+        boto.s3.bucket.Bucket: (['name', 'creation_date'], [], None),
+        boto.s3.lifecycle.Rule: (['id', 'prefix', 'status', 'expiration', 'transition'], [], None),
+        boto.s3.lifecycle.Expiration: (['days', 'date'], [], None),
+        boto.s3.lifecycle.Transition: (['days', 'date', 'storage_class'], [], None),
+        boto.s3.website.Redirect: (['hostname', 'protocol', 'replace_key', 'replace_key_prefix',
+                                    'http_redirect_code'], [], None),
+        boto.s3.website.Condition: (['key_prefix', 'http_error_code'], [], None),
+        boto.s3.website.RedirectLocation: (['hostname', 'protocol'], [], None),
+        boto.s3.website.RoutingRule: (['condition', 'redirect'], [], None),
+        boto.s3.website.WebsiteConfiguration: (['suffix', 'error_key', 'redirect_all_requests_to',
+                                                'routing_rules'], [], None),
+    }
+    return ENCODERS
+
+def find_encoder(t):
+    '''
+    Returns the ENCODERS entry for type t, or for its nearest registered
+    base class.
+    '''
+    for base in getattr(t, '__mro__', (t,)):
+        e = encoders().get(base)
+        if e:
+            return e
+    return None
+
+def make_extractor(t, fields=None, versioned=False):
+    '''
+    Builds the function that turns an object of type t into a dict. Only
+    the attributes named in fields are read, all of them if it is None.
+    Empty attributes are left out. Returns None for unregistered types.
+    '''
+    e = find_encoder(t)
+    if not e:
+        return None
+    attrs, _, extra = e
+    attrs = tuple(a for a in attrs if fields is None or a in fields)
+
+    def extract(o):
+        d = {}
+        for a in attrs:
+            v = getattr(o, a, None)
+            if v:
+                d[a] = v
+        if extra:
+            extra(o, d, versioned, fields)
+        return d
+    return extract
+
+def encoder_columns(t, versioned=False):
+    '''
+    Returns the names of the attributes an object of type t is encoded to.
+    '''
+    attrs, extras, _ = find_encoder(t)
+    return attrs + [x for x in extras if versioned or x != 'is_latest']
+
+class BotoJSONEncoder(json.JSONEncoder):
+    '''
+    Encodes boto objects by looking up an extractor keyed on their type,
+    built on first use.
+    '''
+    def __init__(self, versioned=False, fields=None, **kwargs):
+        json.JSONEncoder.__init__(self, **kwargs)
+        self.versioned = versioned
+        self.fields = fields
+        self.extractors = {}
+
+    def extractor(self, t, fields):
+        try:
+            return self.extractors[t, fields]
+        except KeyError:
+            f = self.extractors[t, fields] = make_extractor(t, fields, self.versioned)
+            return f
+
+    def entry(self, obj):
+        '''
+        Encodes a top level result, projected onto the requested fields.
+        '''
+        if isinstance(obj, dict):
+            if self.fields is None:
+                return obj
+            return dict((k, v) for k, v in obj.iteritems() if k in self.fields)
+        f = self.extractor(type(obj), self.fields)
+        if f is None:
+            return obj
+        return f(obj)
+
+    def default(self, obj):
+        f = self.extractor(type(obj), None)
+        if f is None:
+            return json.JSONEncoder.default(self, obj)
+        return f(obj)
+
+def dump_json_line(o):
+    return json.dumps(o, cls=BotoJSONEncoder, separators=(',', ':'))
+
+OUTPUT_FORMATS = ['json', 'ndjson', 'csv', 'tsv']
+
+class OboOutput:
+    '''
+    Writes command results in one of OUTPUT_FORMATS. A result is a single
+    entry or a list of them. JSON is indented on a terminal and compact
+    otherwise; streamed listings default to NDJSON. CSV and TSV columns
+    are the union of those of entry_types, or of the first entry's type.
+    '''
+    def __init__(self, fmt=None, fields=None, versioned=False, stream=False,
+                 entry_types=None, out=None):
+        self.out = out or sys.stdout
+        if not fmt:
+            fmt = 'ndjson' if stream else 'json'
+        self.fmt = fmt
+        if fields:
+            fields = tuple(f.strip() for f in fields.split(',') if f.strip())
+        self.fields = fields or None
+        self.versioned = versioned
+        self.entry_types = entry_types
+        isatty = getattr(self.out, 'isatty', None)
+        if fmt == 'json' and isatty and isatty():
+            kwargs = { 'indent': 4 }
+        else:
+            kwargs = { 'separators': (',', ':') }
+        self.encoder = BotoJSONEncoder(versioned=versioned, fields=self.fields, **kwargs)
+        self.writer = None
+        self.columns = None
+        self.started = False
+
+    def write(self, o):
+        '''
+        Writes a complete result.
+        '''
+        start = time.time()
+        if self.fmt == 'json':
+            if isinstance(o, list):
+                o = [self.encoder.entry(e) for e in o]
+            else:
+                o = self.encoder.entry(o)
+            self.out.write(self.encoder.encode(o) + '\n')
+        else:
+            self.write_entries(o if isinstance(o, list) else [o])
+            self.end()
+        self.out.flush()
+        if STATS:
+            STATS.phase('encode', time.time() - start)
+
+    def write_pages(self, pages):
+        '''
+        Writes a result that arrives as a sequence of lists of entries,
+        flushing after each one.
+        '''
+        for page in pages:
+            start = time.time()
+            self.write_entries(page)
+            self.out.flush()
+            if STATS:
+                STATS.phase('encode', time.time() - start)
+        self.end()
+
+    def write_entries(self, entries):
+        chunks = []
+        for e in entries:
+            if self.fmt == 'ndjson':
+                chunks.append(self.encoder.encode(self.encoder.entry(e)) + '\n')
+            elif self.fmt == 'json':
+                chunks.append((',\n' if self.started else '[\n') +
+                              self.encoder.encode(self.encoder.entry(e)))
+                self.started = True
+            else:
+                self.write_row(e)
+        if chunks:
+            self.out.write(''.join(chunks))
+
+    def write_header(self, e = None):
+        '''
+        Writes the header row, with the columns of the first entry e, or
+        without one those of --fields or entry_types. Returns whether it
+        could tell the columns.
+        '''
+        if self.fields:
+            columns = list(self.fields)
+        elif isinstance(e, collections.OrderedDict):
+            columns = list(e)
+        elif isinstance(e, dict):
+            columns = sorted(e)
+        elif e is not None or self.entry_types:
+            columns = []
+            for t in self.entry_types or [type(e)]:
+                columns += [c for c in encoder_columns(t, self.versioned) if c not in columns]
+        else:
+            return False
+        delimiter = ',' if self.fmt == 'csv' else '\t'
+        self.writer = csv.writer(self.out, delimiter=delimiter, lineterminator='\n')
+        self.columns = columns
+        self.writer.writerow(self.columns)
+        return True
+
+    def write_row(self, e):
+        if self.writer is None:
+            self.write_header(e)
+        d = self.encoder.entry(e)
+        self.writer.writerow([self.cell(d.get(c)) for c in self.columns])
+
+    def cell(self, v):
+        if v is None:
+            return ''
+        if isinstance(v, bool):
+            return 'true' if v else 'false'
+        if isinstance(v, unicode):
+            return v.encode('utf-8')
+        if isinstance(v, (str, int, long, float)):
+            return v
+        return self.encoder.encode(v)
+
+    def end(self):
+        '''
+        Finishes a streamed result.
+        '''
+        if self.fmt == 'json':
+            self.out.write('\n]\n' if self.started else '[]\n')
+            self.out.flush()
+        elif self.fmt in ('csv', 'tsv') and self.writer is None:
+            # a header even without rows, for scripts to rely on
+            if self.write_header():
+                self.out.flush()
+
+def add_output_parser_args(parser):
+    parser.add_argument('--format', choices=OUTPUT_FORMATS,
+                        help='Output format (default: json, indented on a terminal)')
+    parser.add_argument('--fields',
+                        help='Comma separated attributes to output, e.g. name,size,etag')
+
+def output_for(args, versioned=False, stream=False, entry_types=None):
+    '''
+    Returns an OboOutput for the --format and --fields arguments.
+    '''
+    return OboOutput(args.format, args.fields, versioned=versioned, stream=stream,
+                     entry_types=entry_types)
+
+def list_entry_types(versioned=False):
+    '''
+    Returns the types of the entries of a listing, of versions if versioned.
+    '''
+    if versioned:
+        return [boto.s3.key.Key, boto.s3.deletemarker.DeleteMarker, boto.s3.prefix.Prefix]
+    return [boto.s3.key.Key, boto.s3.prefix.Prefix]
+
+
+# an Error document, the body of a failed request
+ERROR_BODY_RE = re.compile(r'\s*(<\?xml[^>]*\?>\s*)?<Error>')
+
+def check_response(conn, resp):
+    '''
+    Reads the response of a raw request and raises if it failed, including
+    errors that come back in the body of a 200 response (as those of a
+    copy or of completing a multipart upload can).
+    '''
+    body = resp.read()
+    if resp.status / 100 != 2 or ERROR_BODY_RE.match(body):
+        raise conn.provider.storage_response_error(resp.status, resp.reason, body)
+    return body
+
+def hashing_sender(data, md5):
+    '''
+    Returns a boto sender that writes data (a string, buffer or mmap) to
+    the socket in SEND_CHUNK_SIZE slices, updating md5 with each on the
+    way out. The slices are buffers into data, so nothing is copied.
+    '''
+    def sender(http_conn, method, path, data_ignored, headers):
+        skips = {}
+        if 'Host' in headers:
+            skips['skip_host'] = 1
+        if 'Accept-Encoding' in headers:
+            skips['skip_accept_encoding'] = 1
+        http_conn.putrequest(method, path, **skips)
+        for h in headers:
+            http_conn.putheader(h, headers[h])
+        http_conn.endheaders()
+        for start in xrange(0, len(data), SEND_CHUNK_SIZE):
+            chunk = buffer(data, start, SEND_CHUNK_SIZE)
+            md5.update(chunk)
+            http_conn.send(chunk)
+        return http_conn.getresponse()
+    return sender
+
+def check_etag(resp, md5):
+    '''
+    Raises if the ETag of a single part or object PUT is not the MD5 of
+    what was sent. Multipart and encrypted ETags are not plain MD5s and
+    aren't checked.
+    '''
+    etag = (resp.getheader('etag') or '').strip('"')
+    if len(etag) == 32 and etag != md5.hexdigest():
+        raise boto.exception.S3DataError('ETag {e} does not match MD5 {m} of the data sent'.format(
+            e=etag, m=md5.hexdigest()))
+
+def put_data(obo, bucket_name, key_name, data, query_args = None, headers = None):
+    '''
+    PUTs data as the body of a request, hashing it in the same pass that
+    sends it and checking the MD5 against the ETag that comes back, rather
+    than reading it once to send a Content-MD5 up front and again to send
+    it. A mismatch is retried like any other failed idempotent request.
+    Returns the response and its body.
+    '''
+    def request():
+        md5 = hashlib.md5()
+        conn = obo.conn
+        h = dict(headers or {})
+        h['Content-Length'] = str(len(data))
+        resp = conn.make_request('PUT', bucket=bucket_name, key=key_name, query_args=query_args,
+                                 headers=h, sender=hashing_sender(data, md5))
+        body = check_response(conn, resp)
+        check_etag(resp, md5)
+        return resp, body
+    return obo.request(request)
+
+def map_file(f, size):
+    '''
+    Maps size bytes of the regular file f read-only, so that uploads are
+    sent straight from the page cache instead of being read into strings.
+    '''
+    if size == 0:
+        return ''
+    return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+GET_CHUNK_SIZE = 1 << 20
+SEND_CHUNK_SIZE = 1 << 20
+SHARD_PREFETCH_PAGES = 2
+MULTI_DELETE_MAX_KEYS = 1000
+MULTIPART_MIN_PART_SIZE = 5 << 20
+MULTIPART_MAX_PARTS = 10000
+
+def buffer_parts(data, part_size):
+    '''
+    Yields (part_num, data) slices of part_size bytes of data, as buffers
+    that share its memory.
+    '''
+    for part_num, start in enumerate(xrange(0, len(data), part_size), 1):
+        yield part_num, buffer(data, start, part_size)
+
+def read_parts(infile, part_size, head=''):
+    '''
+    Yields (part_num, data) chunks of part_size bytes read from infile,
+    starting with the already buffered head. Chunks are only read as the
+    parts are asked for, so a stream is never held in memory beyond the
+    parts in flight.
+    '''
+    whole = len(head) - len(head) % part_size
+    for part_num, data in buffer_parts(buffer(head, 0, whole), part_size):
+        yield part_num, data
+    part_num = whole / part_size + 1
+
+    chunks = [head[whole:]]
+    size = len(chunks[0])
+    while True:
+        while size < part_size:
+            chunk = infile.read(part_size - size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        if not size:
+            return
+        yield part_num, ''.join(chunks)
+        part_num += 1
+        chunks = []
+        size = 0
+
+class OboMultipartUpload:
+    def __init__(self, obo, bucket_name, key_name, query_args = None):
+        self.obo = obo
+        self.bucket_name = bucket_name
+        self.key_name = key_name
+        self.query_args = query_args
+        self.upload_id = None
+
+    def _request(self, method, query_args, headers = None, data = ''):
+        def request():
+            conn = self.obo.conn
+            resp = conn.make_request(method, bucket=self.bucket_name, key=self.key_name,
+                                     query_args=join_query_args(query_args, self.query_args),
+                                     headers=headers, data=data)
+            return resp, check_response(conn, resp)
+        # initiating or completing twice is not the same as doing it once
+        return self.obo.request(request, idempotent=method != 'POST')
+
+    def initiate(self, policy = None, headers = None):
+        headers = dict(headers or {})
+        if policy:
+            headers[self.obo.conn.provider.acl_header] = policy
+
+        resp, body = self._request('POST', 'uploads', headers=headers)
+
+        mpu = boto.s3.multipart.MultiPartUpload()
+        xml.sax.parseString(body, boto.handler.XmlHandler(mpu, None))
+        self.upload_id = mpu.id
+
+    def upload_part(self, part_num, data):
+        # each part is hashed on the worker that sends it
+        qa = 'partNumber={n}&uploadId={u}'.format(n=part_num, u=self.upload_id)
+        resp, body = put_data(self.obo, self.bucket_name, self.key_name, data,
+                              query_args=join_query_args(qa, self.query_args))
+        return resp.getheader('etag')
+
+    def copy_part(self, part_num, src_str, start, end, src_etag = None):
+        headers = { 'x-amz-copy-source': src_str,
+                    'x-amz-copy-source-range': 'bytes={s}-{e}'.format(s=start, e=end) }
+        if src_etag:
+            # fail rather than mix ranges of a source that got replaced
+            headers['x-amz-copy-source-if-match'] = src_etag
+        qa = 'partNumber={n}&uploadId={u}'.format(n=part_num, u=self.upload_id)
+        resp, body = self._request('PUT', qa, headers=headers)
+
+        k = boto.s3.key.Key()
+        xml.sax.parseString(body, boto.handler.XmlHandler(k, None))
+        return k.etag
+
+    def complete(self, parts):
+        xml_body = '<CompleteMultipartUpload>'
+        for part_num, etag in sorted(parts):
+            xml_body += '<Part><PartNumber>{n}</PartNumber><ETag>{e}</ETag></Part>'.format(n=part_num, e=etag)
+        xml_body += '</CompleteMultipartUpload>'
+
+        self._request('POST', 'uploadId=' + self.upload_id,
+                      headers={ 'Content-Type': 'text/xml' }, data=xml_body)
+
+    def abort(self):
+        self._request('DELETE', 'uploadId=' + self.upload_id)
+
+    def exists(self):
+        '''
+        Returns whether the upload is still in progress, i.e. was neither
+        completed nor aborted.
+        '''
+        try:
+            self._request('GET', 'max-parts=1&uploadId=' + self.upload_id)
+        except boto.exception.S3ResponseError as error:
+            if error.status == 404:
+                return False
+            raise
+        return True
+
+    def run(self, func, parts, concurrency, policy = None, headers = None, journal = None):
+        '''
+        Runs func on each of parts concurrently to create the parts of the
+        upload, and completes it from the (part_num, etag) each returns.
+        The upload is aborted if any of them fails, unless it is journaled
+        and has parts done, in which case it is left to be resumed.
+
+        If upload_id is already set, the upload it names is resumed, and
+        the parts recorded in journal are skipped.
+        '''
+        done = {}
+        if self.upload_id:
+            done = dict(journal.records)
+            journal.resume()
+        else:
+            self.initiate(policy, headers)
+            if journal:
+                journal.start(upload_id=self.upload_id, query_args=self.query_args)
+        etags = done.items()
+        try:
+            parts = (p for p in parts if p[0] not in done)
+            for part, etag in self.obo.engine.map(func, parts, concurrency):
+                etags.append((part[0], etag))
+                if journal:
+                    journal.record([part[0], etag])
+            self.complete(etags)
+        except:
+            exc_info = sys.exc_info()
+            if journal and etags:
+                print >> sys.stderr, ('WARNING: multipart upload %s interrupted with %d parts done, '
+                                      'run again with --resume to continue it' % (self.upload_id, len(etags)))
+            else:
+                try:
+                    self.abort()
+                except Exception as error:
+                    print >> sys.stderr, 'ERROR: failed to abort multipart upload %s: %s' % (self.upload_id, error)
+                if journal:
+                    journal.remove()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if journal:
+            journal.remove()
+
+    def upload(self, parts, concurrency, policy = None, journal = None):
+        '''
+        Uploads the (part_num, data) chunks yielded by parts.
+        '''
+        self.run(lambda p: self.upload_part(*p), parts, concurrency, policy=policy, journal=journal)
+
+    def copy(self, src_str, src_key, part_size, concurrency):
+        '''
+        Copies src_key, whose copy source is src_str, in ranges of
+        part_size bytes. The metadata of the source is carried over.
+        '''
+        headers = boto.utils.merge_meta({}, src_key.metadata, self.obo.conn.provider)
+        if src_key.content_type:
+            headers['Content-Type'] = src_key.content_type
+
+        parts = ((n + 1, start, min(start + part_size, src_key.size) - 1)
+                 for n, start in enumerate(xrange(0, src_key.size, part_size)))
+        self.run(lambda p: self.copy_part(p[0], src_str, p[1], p[2], src_key.etag),
+                 parts, concurrency, headers=headers)
+
+
+def multipart_part_size(size, part_size):
+    '''
+    Returns the part size to use for an object of size bytes, at least
+    part_size and MULTIPART_MIN_PART_SIZE, and big enough to stay within
+    MULTIPART_MAX_PARTS.
+    '''
+    part_size = max(part_size, MULTIPART_MIN_PART_SIZE)
+    if size is not None and size > part_size * MULTIPART_MAX_PARTS:
+        part_size = (size + MULTIPART_MAX_PARTS - 1) / MULTIPART_MAX_PARTS
+    return part_size
+
+
+class OboBucket:
+    def __init__(self, obo, args, bucket_name, need_to_exist, query_args = None):
+        self.obo = obo
+        self.args = args
+        self.bucket_name = bucket_name
+        self.need_to_exist = need_to_exist
+        self.query_args = query_args
+
+    @property
+    def bucket(self):
+        # most requests fail by themselves if the bucket does not exist,
+        # so don't pay for a lookup up front; see validate()
+        return self.obo.get_bucket(self.bucket_name, validate=False)
+
+    def validate(self):
+        '''
+        Checks that the bucket exists, for operations that would not fail
+        otherwise.
+        '''
+        if self.need_to_exist and not self.obo.get_bucket(self.bucket_name):
+            print 'ERROR: bucket does not exist:', self.bucket_name
+            sys.exit(1)
+
+    def list_objects(self):
+        if self.args.all or self.args.parallel:
+            self.list_all_objects()
+        elif (self.args.list_versions):
+            l = self.get_objects_page(self.args.key_marker, self.args.version_id_marker)
+            output_for(self.args, versioned=True, entry_types=list_entry_types(True)).write(l)
+        else:
+            l = self.get_objects_page(self.args.marker, None)
+            output_for(self.args, entry_types=list_entry_types()).write(l)
+
+    def get_objects_page(self, marker, version_id_marker):
+        def request():
+            bucket = self.bucket
+            if self.args.list_versions:
+                return bucket.get_all_versions(prefix=self.args.prefix, delimiter=self.args.delimiter,
+                                               key_marker=marker, version_id_marker=version_id_marker,
+                                               max_keys=self.args.max_keys)
+            return bucket.get_all_keys(prefix=self.args.prefix, delimiter=self.args.delimiter,
+                                       marker=marker, max_keys=self.args.max_keys)
+        return self.obo.request(request)
+
+    def iter_pages(self, markers, end = None):
+        '''
+        Yields listing pages starting after markers and following the
+        truncation markers until the listing is complete, or until it
+        goes past the end key (inclusive).
+        '''
+        while True:
+            rs = self.get_objects_page(*markers)
+            entries = rs
+            if self.args.delimiter:
+                # common prefixes come after the keys of each page
+                entries = sorted(rs, key=lambda e: e.name)
+            if end is not None and len(entries) > 0 and entries[-1].name > end:
+                yield [e for e in entries if e.name <= end]
+                return
+
+            yield entries
+
+            if not rs.is_truncated or len(rs) == 0:
+                return
+            if self.args.list_versions:
+                markers = (rs.next_key_marker, rs.next_version_id_marker)
+            else:
+                markers = (rs.next_marker or rs[-1].name, None)
+
+    def start_markers(self):
+        if self.args.list_versions:
+            return (self.args.key_marker, self.args.version_id_marker)
+        return (self.args.marker, None)
+
+    def list_pages(self):
+        # fetch the next page in the background while the current one is consumed
+        return self.obo.engine.chain([self.iter_pages(self.start_markers())], 1, 1)
+
+    def discover_splits(self, delimiter):
+        '''
+        Returns the common prefixes under --prefix, to be used as split
+        points for a parallel listing.
+        '''
+        bucket = self.bucket
+        splits = []
+        marker = None
+        while True:
+            rs = self.obo.request(lambda: bucket.get_all_keys(prefix=self.args.prefix, delimiter=delimiter,
+                                                              marker=marker))
+            splits += [e.name for e in rs if isinstance(e, boto.s3.prefix.Prefix)]
+            if not rs.is_truncated or len(rs) == 0:
+                break
+            marker = rs.next_marker or max([e.name for e in rs])
+        return sorted(splits)
+
+    def shards(self):
+        '''
+        Splits the key space at the split points into disjoint ranges
+        (previous split point exclusive, split point inclusive), and
+        returns a page iterator for each.
+        '''
+        if self.args.split_points:
+            splits = sorted(set(self.args.split_points.split(',')))
+        else:
+            splits = self.discover_splits(self.args.split_delimiter or '/')
+
+        markers = self.start_markers()
+        shards = []
+        for end in splits + [None]:
+            if end is not None and markers[0] is not None and end <= markers[0]:
+                continue
+            shards.append(self.iter_pages(markers, end))
+            markers = (end, None)
+        return shards
+
+    def list_sharded_pages(self):
+        '''
+        Lists the shards concurrently, and yields their pages in key order.
+        '''
+        return self.obo.engine.chain(self.shards(), SHARD_PREFETCH_PAGES, self.args.parallel)
+
+    def list_all_objects(self):
+        if self.args.parallel:
+            pages = self.list_sharded_pages()
+        else:
+            pages = self.list_pages()
+
+        def dedup(pages):
+            last_prefix = None
+            for rs in pages:
+                page = []
+                for e in rs:
+                    if isinstance(e, boto.s3.prefix.Prefix):
+                        # a common prefix can straddle two ranges
+                        if e.name == last_prefix:
+                            continue
+                        last_prefix = e.name
+                    page.append(e)
+                yield page
+
+        if self.args.list_versions:
+            out = output_for(self.args, versioned=True, stream=True,
+                             entry_types=list_entry_types(True))
+        else:
+            out = output_for(self.args, stream=True, entry_types=list_entry_types())
+        out.write_pages(dedup(pages))
+
+    def list_keys(self):
+        '''
+        Yields the keys (versions and delete markers with --list-versions)
+        of the listing, leaving out common prefixes.
+        '''
+        for rs in self.list_pages():
+            for e in rs:
+                if not isinstance(e, boto.s3.prefix.Prefix):
+                    yield e
+
+    def list_entries(self):
+        '''
+        Yields (key, version_id) for every entry of the listing, every
+        version (and delete marker) of every key with --list-versions.
+        '''
+        for k in self.list_keys():
+            yield k.name, k.version_id if self.args.list_versions else None
+
+    def delete_batch(self, batch):
+        '''
+        Deletes up to MULTI_DELETE_MAX_KEYS (key, version_id) entries in
+        one multi-object delete request, and returns the per-key errors.
+        '''
+        xml_body = u'<Delete><Quiet>true</Quiet>'
+        for key, version_id in batch:
+            xml_body += u'<Object><Key>{k}</Key>'.format(k=xml.sax.saxutils.escape(key))
+            if version_id:
+                xml_body += u'<VersionId>{v}</VersionId>'.format(v=xml.sax.saxutils.escape(version_id))
+            xml_body += u'</Object>'
+        xml_body = (xml_body + u'</Delete>').encode('utf-8')
+
+        headers = { 'Content-MD5': base64.b64encode(hashlib.md5(xml_body).digest()),
+                    'Content-Type': 'text/xml' }
+        def request():
+            conn = self.obo.conn
+            resp = conn.make_request('POST', bucket=self.bucket_name,
+                                     query_args=join_query_args('delete', self.query_args),
+                                     headers=headers, data=xml_body)
+            return check_response(conn, resp)
+        # deleting again is harmless, except that it would add another
+        # delete marker for keys given without a version
+        body = self.obo.request(request, idempotent=all(v for k, v in batch))
+
+        result = boto.s3.multidelete.MultiDeleteResult()
+        xml.sax.parseString(body, boto.handler.XmlHandler(result, None))
+        return result.errors
+
+    def remove_objects(self, entries, batch_size, concurrency):
+        '''
+        Deletes the (key, version_id) entries in batches, several batches
+        at a time. Keys that fail are reported one JSON object per line.
+        Returns whether all of them were deleted.
+        '''
+        batches = iter_batches(entries, min(batch_size, MULTI_DELETE_MAX_KEYS))
+
+        ok = True
+        for batch, errors in self.obo.engine.map(self.delete_batch, batches, concurrency):
+            for e in errors:
+                ok = False
+                print dump_json_line({ 'key': e.key, 'version_id': e.version_id,
+                                       'code': e.code, 'message': e.message })
+        return ok
+
+    def create(self):
+        try:
+            self.obo.request(lambda: self.obo.conn.create_bucket(self.bucket_name, policy=self.args.canned_acl),
+                             idempotent=False)
+            self.obo.bucket_cache.set(self.bucket_name, exists=True)
+        except socket.error as error:
+            print 'Had an issue connecting: %s' % error
+
+    def stat(self, obj):
+        if obj:
+            k = self.obo.request(lambda: head_key(self.bucket, obj))
+            output_for(self.args).write(k)
+        else:
+            j = { 'name': self.bucket_name }
+            append_attr_value(j, 'versioning_status', self.obo.get_versioning_status(self.bucket_name))
+            output_for(self.args).write(j)
+
+    def head(self, entry):
+        '''
+        Returns the key of the (key, version_id) entry as a HEAD request
+        finds it, or an OboStatError if that fails.
+        '''
+        name, version_id = entry
+        try:
+            k = self.obo.request(lambda: head_key(self.bucket, name, version_id))
+        except boto.exception.S3ResponseError as error:
+            return OboStatError(name, version_id, error.status, error.error_code or error.reason)
+        return k or OboStatError(name, version_id, 404, 'NoSuchKey')
+
+    def stat_keys(self, entries, concurrency = None, ordered = True):
+        '''
+        Stats the (key, version_id) entries with concurrent HEAD requests,
+        streaming the keys (NDJSON by default) in the order of entries or,
+        if not ordered, as the requests complete. Keys that cannot be
+        stated are output in their place as errors. Returns whether all of
+        them could be.
+        '''
+        engine = self.obo.engine
+        run = engine.map_ordered if ordered else engine.map
+        out = output_for(self.args, stream=True, entry_types=[boto.s3.key.Key, OboStatError])
+        failed = []
+
+        def results():
+            for _, k in run(self.head, entries, concurrency):
+                if isinstance(k, OboStatError):
+                    failed.append(k)
+                yield [k]
+        out.write_pages(results())
+        return not failed
+
+    def set_versioning(self, status):
+        bucket = self.bucket
+        self.obo.request(lambda: bucket.configure_versioning(status))
+        self.obo.bucket_cache.invalidate(self.bucket_name)
+
+    def get_config(self, func, missing_code):
+        '''
+        Returns the bucket configuration that func fetches, or None if the
+        bucket has none, which the gateway tells with a 404 missing_code.
+        Any other error, throttling included, is raised once request()
+        gives up on it, rather than taken for a missing configuration.
+        '''
+        try:
+            return self.obo.request(func)
+        except boto.exception.S3ResponseError as error:
+            if error.status != 404 or error.error_code != missing_code:
+                raise
+            return None
+
+    def get_website_config(self):
+        return self.get_config(self.bucket.get_website_configuration_obj, 'NoSuchWebsiteConfiguration')
+
+    def delete_website(self):
+        self.obo.request(self.bucket.delete_website_configuration)
+
+    def get_website(self):
+        output_for(self.args).write(self.obo.request(self.bucket.get_website_configuration_obj))
+
+    def configure_website(self, suffix, error_key, redirect_all_host, redirect_all_protocol,
+            condition_key_prefix, condition_http_error_code, redirect_hostname, redirect_protocol,
+            redirect_replace_key, replace_key_prefix, http_redirect_code):
+        bucket = self.bucket
+        config = self.get_website_config() or boto.s3.website.WebsiteConfiguration()
+
+        if suffix:
+            config.suffix = suffix
+        if error_key:
+            config.error_key = error_key
+        if redirect_all_host or redirect_all_protocol:
+            config.redirect_all_requests_to = boto.s3.website.RedirectLocation(redirect_all_host, redirect_all_protocol)
+        redirect_rule = None
+        if condition_key_prefix or condition_http_error_code:
+            redirect = boto.s3.website.Redirect(redirect_hostname, redirect_protocol, redirect_replace_key, replace_key_prefix, http_redirect_code)
+            redirect_rule = boto.s3.website.RoutingRule(boto.s3.website.Condition(condition_key_prefix, condition_http_error_code), redirect)
+            config.routing_rules.append(redirect_rule)
+
+        self.obo.request(lambda: bucket.set_website_configuration(config))
+
+    def remove(self):
+        self.obo.request(lambda: self.obo.conn.delete_bucket(self.bucket_name))
+        self.obo.bucket_cache.invalidate(self.bucket_name)
+
+    def getacl(self, obj):
+        bucket = self.bucket
+        acl = self.obo.request(lambda: bucket.get_acl(obj, version_id=self.args.version_id))
+        # TODO include a better format option for importing back
+        print acl
+
+    def get(self, obj):
+        k = None
+        if self.args.concurrency > 1 or self.args.resume:
+            k = self.obo.request(lambda: self.bucket.get_key(obj, version_id=self.args.version_id))
+
+        if k and k.size > self.args.range_size:
+            if self.args.out_file:
+                self.get_ranges_to_file(k, self.args.out_file)
+            else:
+                self.get_ranges(k, sys.stdout)
+            return
+
+        if not self.args.out_file:
+            out = sys.stdout
+        else:
+            out = open(self.args.out_file, 'wb')
+
+        if not k:
+            k = boto.s3.key.Key(self.bucket)
+            k.key = obj
+
+        if out is sys.stdout:
+            # what has been written cannot be taken back
+            self.obo.request(lambda: k.get_contents_to_file(out, version_id=self.args.version_id),
+                             idempotent=False)
+        else:
+            self.obo.request(lambda: get_contents_to_file(k, out, version_id=self.args.version_id))
+
+    def get_range(self, k, start, end, out_file = None):
+        '''
+        Fetches bytes [start, end] of k. If out_file is set the data is
+        written at its offset in that file, otherwise it is returned.
+        '''
+        headers = { 'Range': 'bytes={s}-{e}'.format(s=start, e=end) }
+        if k.etag:
+            # fail rather than mix ranges of an object that got replaced
+            headers['If-Match'] = k.etag
+        query_args = append_query_arg(None, 'versionId', self.args.version_id)
+
+        def request():
+            conn = self.obo.conn
+            resp = conn.make_request('GET', bucket=self.bucket_name, key=k.name,
+                                     headers=headers, query_args=query_args)
+            if resp.status != 206:
+                raise conn.provider.storage_response_error(resp.status, resp.reason, resp.read())
+
+            if not out_file:
+                return resp.read()
+
+            with open(out_file, 'r+b') as f:
+                f.seek(start)
+                while True:
+                    data = resp.read(GET_CHUNK_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+        return self.obo.request(request)
+
+    def ranges(self, k, range_size, done = ()):
+        return ((start, min(start + range_size, k.size) - 1)
+                for start in xrange(0, k.size, range_size) if start not in done)
+
+    def get_ranges(self, k, out):
+        ranges = self.ranges(k, self.args.range_size)
+        for r, data in self.obo.engine.map_ordered(lambda r: self.get_range(k, r[0], r[1]), ranges,
+                                                   self.args.concurrency):
+            out.write(data)
+
+    def get_ranges_to_file(self, k, path):
+        '''
+        Fetches k into path by byte ranges, journaling each range that is
+        written so that an interrupted download can be resumed with
+        --resume, as long as the object has not been replaced since.
+        '''
+        journal = OboJournal(self.obo, 'get', self.bucket_name, k.name, path,
+                             etag=k.etag, size=k.size, version_id=self.args.version_id)
+        done = ()
+        if (self.args.resume and journal.matches() and os.path.isfile(path) and
+            os.path.getsize(path) == k.size):
+            range_size = journal.header['range_size']
+            done = set(journal.records)
+            journal.resume()
+        else:
+            range_size = self.args.range_size
+            with open(path, 'wb') as out:
+                out.truncate(k.size)
+            journal.start(range_size=range_size)
+
+        ranges = self.ranges(k, range_size, done)
+        for r, result in self.obo.engine.map(lambda r: self.get_range(k, r[0], r[1], path), ranges,
+                                             self.args.concurrency):
+            journal.record(r[0])
+        journal.remove()
+
+    def put(self, obj):
+        if not self.args.in_file:
+            infile = sys.stdin
+        else:
+            infile = open(self.args.in_file, 'rb')
+
+        self.put_file(obj, infile)
+
+    def put_file(self, obj, infile):
+        threshold = self.args.multipart_threshold
+
+        size = get_file_size(infile)
+        if size is None:
+            # can't tell the size of a stream up front, read up to the
+            # threshold to find out whether it fits in a single put;
+            # anything bigger is streamed a part at a time
+            head = infile.read(threshold)
+            if len(head) < threshold:
+                self.put_data(obj, head)
+            else:
+                part_size = multipart_part_size(None, self.args.part_size)
+                self.put_parts(obj, read_parts(infile, part_size, head))
+            return
+
+        data = map_file(infile, size)
+        try:
+            if size < threshold:
+                self.put_data(obj, data)
+            elif infile is sys.stdin:
+                part_size = multipart_part_size(size, self.args.part_size)
+                self.put_parts(obj, buffer_parts(data, part_size))
+            else:
+                self.put_file_parts(obj, infile, data, size)
+        finally:
+            if size:
+                data.close()
+
+    def put_data(self, obj, data):
+        headers = { 'Content-Type': 'application/octet-stream' }
+        if self.args.canned_acl:
+            headers[self.obo.conn.provider.acl_header] = self.args.canned_acl
+        put_data(self.obo, self.bucket_name, obj, data, query_args=self.query_args, headers=headers)
+
+    def put_parts(self, obj, parts):
+        mpu = OboMultipartUpload(self.obo, self.bucket_name, obj, query_args=self.query_args)
+        mpu.upload(parts, self.args.concurrency, policy=self.args.canned_acl)
+
+    def put_file_parts(self, obj, infile, data, size):
+        '''
+        Uploads the mapped contents of the local file infile in parts,
+        journaling each part that is done so that an interrupted upload
+        can be resumed with --resume, as long as the file has not changed.
+        A journaled upload that is not resumed is aborted.
+        '''
+        mtime = os.fstat(infile.fileno()).st_mtime
+        journal = OboJournal(self.obo, 'put', self.bucket_name, obj, infile.name, size=size, mtime=mtime)
+        mpu = OboMultipartUpload(self.obo, self.bucket_name, obj, query_args=self.query_args)
+        part_size = multipart_part_size(size, self.args.part_size)
+        if journal.header:
+            mpu.upload_id = journal.header.get('upload_id')
+            if self.args.resume and journal.matches() and mpu.upload_id and mpu.exists():
+                part_size = journal.header['part_size']
+            else:
+                discard_journal(self.obo, journal.header)
+                journal.remove()
+                mpu.upload_id = None
+        journal.source['part_size'] = part_size
+        mpu.upload(buffer_parts(data, part_size), self.args.concurrency, policy=self.args.canned_acl,
+                   journal=journal)
+
+    def get_lifecycle_config(self):
+        return self.get_config(self.bucket.get_lifecycle_config, 'NoSuchLifecycleConfiguration')
+
+    def get_lifecycle(self):
+        self.validate()
+        lc = self.get_lifecycle_config() or boto.s3.lifecycle.Lifecycle()
+
+        output_for(self.args).write(lc)
+
+    def add_lifecycle(self, rule_id, prefix, status_bool, expiration, transition):
+
+        status = 'Enabled' if status_bool else 'Disabled'
+
+        lc = self.get_lifecycle_config() or boto.s3.lifecycle.Lifecycle()
+
+        lc.add_rule(rule_id, prefix, status, expiration, transition)
+
+        bucket = self.bucket
+        self.obo.request(lambda: bucket.configure_lifecycle(lc))
+
+    def get_lifecycle_rules(self):
+        '''
+        Returns the OboLifecycleRules the bucket has, if any.
+        '''
+        def request():
+            conn = self.obo.conn
+            resp = conn.make_request('GET', bucket=self.bucket_name, query_args='lifecycle')
+            return check_response(conn, resp)
+        body = self.get_config(request, 'NoSuchLifecycleConfiguration')
+        return parse_lifecycle_rules(body) if body else []
+
+    def remove_lifecycle(self, rule_id, remove_all):
+
+        bucket = self.bucket
+        if remove_all:
+            self.obo.request(bucket.delete_lifecycle_configuration)
+            return
+
+        new_lc = boto.s3.lifecycle.Lifecycle()
+
+        self.validate()
+        lc = self.get_lifecycle_config()
+        if lc is None:
+            return
+
+        for r in lc:
+            if r.id != rule_id:
+                new_lc.append(r) # add_rule(r.id, r.prefix, r.status, r.expiration, r.transition)
+
+        if len(new_lc) == 0:
+            self.obo.request(bucket.delete_lifecycle_configuration)
+            return
+
+        self.obo.request(lambda: bucket.configure_lifecycle(new_lc))
+
+
+def copy_source(bucket_name, key_name, version_id = None):
+    '''
+    Returns the x-amz-copy-source of a key, UTF-8 encoded and quoted the
+    way boto's Bucket.copy_key() does it, so that any key name can be a
+    source.
+    '''
+    src_str = '/{bucket}/{object}'.format(bucket=bucket_name,
+                                          object=urllib.quote(boto.utils.get_utf8_value(key_name)))
+    if version_id:
+        src_str = src_str + '?versionId=' + version_id
+    return src_str
+
+
+class OboObject:
+    def __init__(self, obo, args, bucket_name, object_name, query_args = None):
+        self.obo = obo
+        self.args = args
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.query_args = query_args
+
+    def remove(self, version_id):
+        query_args = append_query_arg(self.query_args, 'versionId', version_id)
+
+        def request():
+            resp = self.obo.conn.make_request("DELETE", bucket=self.bucket_name, key=self.object_name, query_args=query_args)
+            check_response(self.obo.conn, resp)
+        self.obo.request(request)
+
+    def copy(self, source, version_id, size = None):
+        '''
+        Copies source (a (bucket, key) pair) to this object. If the size of
+        the source is known and below the multipart threshold, it is not
+        looked up first.
+        '''
+        src_str = copy_source(source[0], source[1], version_id)
+
+        src_key = None
+        if self.args.multipart_threshold and (size is None or size >= self.args.multipart_threshold):
+            src_bucket = self.obo.get_bucket(source[0], validate=False)
+            src_key = self.obo.request(lambda: src_bucket.get_key(source[1], version_id=version_id))
+
+        if src_key and src_key.size >= self.args.multipart_threshold:
+            part_size = multipart_part_size(src_key.size, self.args.part_size)
+            mpu = OboMultipartUpload(self.obo, self.bucket_name, self.object_name, query_args=self.query_args)
+            mpu.copy(src_str, src_key, part_size, self.args.concurrency)
+            return
+
+        headers = {}
+        headers['x-amz-copy-source'] = src_str
+
+        def request():
+            resp = self.obo.conn.make_request("PUT", bucket=self.bucket_name, key=self.object_name, query_args=self.query_args, headers=headers)
+            check_response(self.obo.conn, resp)
+        self.obo.request(request)
+
+def walk_local_tree(root, rel = ''):
+    '''
+    Yields (relpath, path, stat) for the regular files under root, with
+    '/' separated relative paths in the same byte order as S3 keys. Only
+    one directory listing is held per level.
+    '''
+    path = os.path.join(root, rel) if rel else root
+    entries = []
+    for name in os.listdir(path):
+        st = os.stat(os.path.join(path, name))
+        if stat.S_ISDIR(st.st_mode):
+            # the keys under a directory sort as name + '/'
+            entries.append((name + '/', name, st))
+        elif stat.S_ISREG(st.st_mode):
+            entries.append((name, name, st))
+
+    for sort_name, name, st in sorted(entries):
+        relpath = rel + '/' + name if rel else name
+        if stat.S_ISDIR(st.st_mode):
+            for e in walk_local_tree(root, relpath):
+                yield e
+        else:
+            yield relpath, os.path.join(root, relpath), st
+
+def head_key(bucket, key_name, version_id = None):
+    '''
+    Like bucket.get_key(). A HEAD only reports the storage class if it is
+    not STANDARD, and boto would otherwise list the bucket to find it out
+    when the key is output.
+    '''
+    k = bucket.get_key(key_name, version_id=version_id)
+    if k and k._storage_class is None:
+        k.storage_class = 'STANDARD'
+    return k
+
+def get_contents_to_file(k, out, version_id = None):
+    '''
+    Downloads k into the file out from the start, discarding whatever an
+    earlier attempt left in it.
+    '''
+    out.seek(0)
+    out.truncate()
+    k.get_contents_to_file(out, version_id=version_id)
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(GET_CHUNK_SIZE)
+            if not data:
+                break
+            md5.update(data)
+    return md5.hexdigest()
+
+def key_mtime(k):
+    return calendar.timegm(boto.utils.parse_ts(k.last_modified).timetuple())
+
+def merge_join(left, right, key):
+    '''
+    Merges two iterators that are sorted by key, and yields (l, r) pairs
+    where either side is None if it has no entry with the same key.
+    '''
+    end = object()
+    l = next(left, end)
+    r = next(right, end)
+    while l is not end or r is not end:
+        if r is end or (l is not end and key(l) < key(r)):
+            yield l, None
+            l = next(left, end)
+        elif l is end or key(r) < key(l):
+            yield None, r
+            r = next(right, end)
+        else:
+            yield l, r
+            l = next(left, end)
+            r = next(right, end)
+
+
+class OboSync:
+    '''
+    Syncs a local directory tree with a bucket prefix, in either
+    direction. Both sides are walked in key order and merge-joined, so
+    neither is held in memory.
+    '''
+    def __init__(self, obo, args, local_dir, bucket_name, prefix, upload, query_args = None):
+        self.obo = obo
+        self.args = args
+        self.local_dir = local_dir
+        self.prefix = prefix
+        self.upload = upload
+        self.bucket = OboBucket(obo, args, bucket_name, True, query_args=query_args)
+
+    def remote_entries(self):
+        for k in self.bucket.list_keys():
+            rel = k.name[len(self.prefix):]
+            if not rel or rel.endswith('/'):
+                continue
+            yield rel.encode('utf-8'), k
+
+    def local_entries(self):
+        if not os.path.isdir(self.local_dir):
+            return iter([])
+        return walk_local_tree(self.local_dir)
+
+    def changed(self, local, remote):
+        relpath, path, st = local
+        if st.st_size != remote.size:
+            return True
+
+        if self.upload:
+            newer = st.st_mtime > key_mtime(remote)
+        else:
+            newer = key_mtime(remote) > st.st_mtime
+        if not newer:
+            return False
+
+        etag = remote.etag.strip('"')
+        if '-' in etag:
+            # a multipart ETag is not the MD5 of the data
+            return True
+        return file_md5(path) != etag
+
+    def actions(self):
+        '''
+        Yields the (action, relpath, local, remote) changes needed to make
+        the destination match the source.
+        '''
+        pairs = merge_join(self.local_entries(), self.remote_entries(), key=lambda e: e[0])
+        for local, remote in pairs:
+            if self.upload:
+                if not local:
+                    if self.args.delete:
+                        yield 'delete', remote[0], None, remote[1]
+                elif not remote or self.changed(local, remote[1]):
+                    yield 'upload', local[0], local, None
+            else:
+                if not remote:
+                    if self.args.delete:
+                        yield 'delete', local[0], local, None
+                elif not local or self.changed(local, remote[1]):
+                    yield 'download', remote[0], None, remote[1]
+
+    def local_path(self, relpath):
+        return os.path.join(self.local_dir, *relpath.split('/'))
+
+    def download(self, relpath, k):
+        path = self.local_path(relpath)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+
+        tmp_path = path + '.obo-tmp'
+        k = boto.s3.key.Key(self.bucket.bucket, k.name)
+        try:
+            with open(tmp_path, 'wb') as out:
+                self.obo.request(lambda: get_contents_to_file(k, out))
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.rename(tmp_path, path)
+
+        # match the remote mtime so that the next sync can skip it
+        mtime = key_mtime(k)
+        os.utime(path, (mtime, mtime))
+
+    def batch_remote_deletes(self, actions):
+        '''
+        Collects the remote deletes among actions into batches for a
+        multi-object delete, and passes the other actions through.
+        '''
+        batch = []
+        for action in actions:
+            if action[0] == 'delete' and action[3]:
+                batch.append(action)
+                if len(batch) == MULTI_DELETE_MAX_KEYS:
+                    yield 'delete_batch', batch
+                    batch = []
+            else:
+                yield action
+        if batch:
+            yield 'delete_batch', batch
+
+    def run_action(self, action):
+        '''
+        Carries out action and returns its error, if it failed; for a
+        delete batch, a dict of the errors of the keys that failed.
+        '''
+        op = action[0]
+        try:
+            if op == 'delete_batch':
+                errors = self.bucket.delete_batch([(a[3].name, None) for a in action[1]])
+                return dict((e.key, e.message) for e in errors)
+
+            op, relpath, local, remote = action
+            if op == 'upload':
+                with open(local[1], 'rb') as infile:
+                    self.bucket.put_file(self.prefix + relpath.decode('utf-8'), infile)
+            elif op == 'download':
+                self.download(relpath, remote)
+            else:
+                os.remove(local[1])
+        except Exception as e:
+            error = '{t}: {e}'.format(t=type(e).__name__, e=e)
+            if op == 'delete_batch':
+                return dict((a[3].name, error) for a in action[1])
+            return error
+        return None
+
+    def report(self, action, error = None):
+        op, relpath, local, remote = action
+        d = { 'action': op, 'key': self.prefix + relpath.decode('utf-8'),
+              'path': self.local_path(relpath) }
+        if error:
+            d['error'] = error
+        print dump_json_line(d)
+
+    def run(self):
+        '''
+        Returns whether all the actions succeeded. One that fails is
+        reported with its error, and does not stop the others.
+        '''
+        actions = self.actions()
+        if self.args.dry_run:
+            for action in actions:
+                self.report(action)
+            return True
+
+        failed = 0
+        actions = self.batch_remote_deletes(actions)
+        for action, error in self.obo.engine.map(self.run_action, actions, self.args.concurrency):
+            if action[0] == 'delete_batch':
+                for a in action[1]:
+                    if a[3].name in error:
+                        failed += 1
+                    self.report(a, error.get(a[3].name))
+            else:
+                if error:
+                    failed += 1
+                self.report(action, error)
+            sys.stdout.flush()
+        return failed == 0
+
+
+# part sizes that common tools upload in, tried when the one given does
+# not account for the number of parts of a multipart ETag
+VERIFY_PART_SIZES = [5 << 20, 8 << 20, 15 << 20, 16 << 20, 32 << 20, 64 << 20, 100 << 20,
+                     128 << 20, 256 << 20, 512 << 20, 1 << 30]
+
+def local_etags(path, part_sizes):
+    '''
+    Returns the ETags the file at path would have: its MD5 if part_sizes
+    is empty, otherwise the multipart ETag for each of part_sizes, all
+    from one read of the file. Runs in the verify process pool.
+    '''
+    whole = None if part_sizes else hashlib.md5()
+    # [part size, MD5 of the part so far, bytes in it, digests of the parts]
+    parts = [[p, hashlib.md5(), 0, []] for p in part_sizes]
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(GET_CHUNK_SIZE)
+            if not data:
+                break
+            if whole:
+                whole.update(data)
+            for c in parts:
+                i = 0
+                while i < len(data):
+                    n = min(c[0] - c[2], len(data) - i)
+                    c[1].update(buffer(data, i, n))
+                    c[2] += n
+                    i += n
+                    if c[2] == c[0]:
+                        c[3].append(c[1].digest())
+                        c[1] = hashlib.md5()
+                        c[2] = 0
+    if whole:
+        return [whole.hexdigest()]
+    etags = []
+    for c in parts:
+        if c[2]:
+            c[3].append(c[1].digest())
+        etags.append('{m}-{n}'.format(m=hashlib.md5(''.join(c[3])).hexdigest(), n=len(c[3])))
+    return etags
+
+def multipart_part_sizes(size, parts, part_size):
+    '''
+    Returns the part sizes an object of size bytes may have been uploaded
+    in as parts parts: part_size as it would have been adjusted, the
+    even split, then VERIFY_PART_SIZES, leaving out those that give
+    another number of parts, and those that only the last part of an
+    upload could have been.
+    '''
+    even = (size + parts - 1) / parts if parts else 0
+    candidates = [multipart_part_size(size, part_size), (even + (1 << 20) - 1) & ~((1 << 20) - 1), even]
+    sizes = []
+    for p in candidates + VERIFY_PART_SIZES:
+        if p < MULTIPART_MIN_PART_SIZE and parts > 1:
+            continue
+        if p > 0 and (size + p - 1) / p == max(parts, 1) and p not in sizes:
+            sizes.append(p)
+    return sizes
+
+class OboVerify(OboSync):
+    '''
+    Checks that the objects under a bucket prefix match the files of a
+    local tree, which are walked alongside the listing in key order as
+    sync does. The local files are hashed in a pool of processes, so all
+    cores are used, and compared against the ETags of the listing: the
+    MD5 of the data, or for multipart uploads the MD5 of the MD5s of the
+    parts, which is worked out for the part sizes the object could have
+    been uploaded in. With download, the objects are fetched and their
+    MD5 compared instead, which does not depend on the ETags at all.
+    '''
+    def __init__(self, obo, args, local_dir, bucket_name, prefix):
+        OboSync.__init__(self, obo, args, local_dir, bucket_name, prefix, True)
+        self.pool = None
+        self.lock = threading.Lock()
+        self.counts = collections.OrderedDict([('verified', 0), ('mismatch', 0), ('missing', 0), ('extra', 0),
+                                               ('unverified', 0)])
+
+    def remote_md5(self, k):
+        def request():
+            md5 = hashlib.md5()
+            conn = self.obo.conn
+            resp = conn.make_request('GET', bucket=self.bucket.bucket_name, key=k.name,
+                                     headers={ 'If-Match': k.etag })
+            if resp.status != 200:
+                raise conn.provider.storage_response_error(resp.status, resp.reason, resp.read())
+            while True:
+                data = resp.read(GET_CHUNK_SIZE)
+                if not data:
+                    break
+                md5.update(data)
+            return md5.hexdigest()
+        return self.obo.request(request)
+
+    def check(self, pair):
+        '''
+        Returns the status of a (local, remote) pair, and its row if it
+        is not verified.
+        '''
+        local, remote = pair
+        relpath = (local or remote)[0]
+        row = collections.OrderedDict([('status', None), ('key', self.prefix + relpath.decode('utf-8')),
+                                       ('path', self.local_path(relpath))])
+        if not remote:
+            row['status'] = 'missing'
+            return row
+        k = remote[1]
+        etag = k.etag.strip('"')
+        row['etag'] = etag
+        if not local:
+            row['status'] = 'extra'
+            return row
+        size = local[2].st_size
+        if size != k.size:
+            row['status'] = 'mismatch'
+            row['size'] = size
+            row['remote_size'] = k.size
+            return row
+
+        if self.args.download:
+            md5 = self.pool.apply_async(local_etags, (local[1], []))
+            remote_md5 = self.remote_md5(k)
+            local_md5 = md5.get()[0]
+            if local_md5 == remote_md5:
+                return None
+            row['status'] = 'mismatch'
+            row['md5'] = local_md5
+            row['remote_md5'] = remote_md5
+            return row
+
+        part_sizes = []
+        if '-' in etag:
+            parts = etag.rsplit('-', 1)[1]
+            part_sizes = multipart_part_sizes(size, int(parts) if parts.isdigit() else 0,
+                                              self.args.part_size)
+            if not part_sizes:
+                row['status'] = 'unverified'
+                row['reason'] = 'no part size gives the number of parts'
+                return row
+        etags = self.pool.apply_async(local_etags, (local[1], part_sizes)).get()
+        if etag in etags:
+            return None
+        if part_sizes:
+            # a part size not tried is as likely as a corrupt object
+            row['status'] = 'unverified'
+            row['reason'] = 'no part size tried gives the ETag'
+            row['part_sizes'] = part_sizes
+        else:
+            row['status'] = 'mismatch'
+            row['local_etag'] = etags[0]
+        return row
+
+    def rows(self):
+        pairs = merge_join(self.local_entries(), self.remote_entries(), key=lambda e: e[0])
+        if self.args.download:
+            limit = self.obo.engine.limit(self.args.concurrency)
+        else:
+            # keep every process busy, with the next file queued
+            limit = 2 * self.args.jobs
+        for pair, row in self.obo.engine.map_ordered(self.check, pairs, limit):
+            self.counts[row['status'] if row else 'verified'] += 1
+            if row:
+                yield [row]
+
+    def run(self):
+        '''
+        Returns whether all the objects were verified.
+        '''
+        # fork before any thread is started
+        self.pool = multiprocessing.Pool(self.args.jobs)
+        try:
+            output_for(self.args, stream=True).write_pages(self.rows())
+            self.pool.close()
+        except:
+            self.pool.terminate()
+            raise
+        finally:
+            self.pool.join()
+
+        c = self.counts
+        print >> sys.stderr, 'verified {v} objects: {x} mismatched, {m} missing, {e} extra, {u} unverified'.format(
+            v=c['verified'], x=c['mismatch'], m=c['missing'], e=c['extra'], u=c['unverified'])
+        return c['verified'] == sum(c.values())
+
+
+class OboPrefixCopy:
+    '''
+    Server-side copies every key under a prefix of one bucket to another
+    prefix, a worker pool of keys at a time, streaming the listing. With
+    skip_existing the destination prefix is listed alongside and keys
+    whose size and ETag already match are skipped.
+    '''
+    def __init__(self, obo, args, source, target, query_args = None):
+        self.obo = obo
+        self.args = args
+        self.src_bucket_name, src_prefix = (source.split('/', 1) + [''])[:2]
+        self.dst_bucket_name, dst_prefix = (target.split('/', 1) + [''])[:2]
+        # key names are listed as unicode
+        self.src_prefix = src_prefix.decode('utf-8')
+        self.dst_prefix = dst_prefix.decode('utf-8')
+        self.query_args = query_args
+
+        self.copied = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.last_report = self.start
 
-    def get_bucket(self, bucket_name):
-        return self.conn.lookup(bucket_name)
+    def keys(self, bucket_name, prefix):
+        args = argparse.Namespace(**vars(self.args))
+        args.prefix = prefix
+        bucket = OboBucket(self.obo, args, bucket_name, True)
+        for k in bucket.list_keys():
+            yield k.name[len(prefix):].encode('utf-8'), k
 
-def append_attr_value(d, attr, attrv):
-    if attrv and len(str(attrv)) > 0:
-        d[attr] = attrv
+    def pending(self):
+        src = self.keys(self.src_bucket_name, self.src_prefix)
+        if not self.args.skip_existing:
+            for e in src:
+                yield e[1]
+            return
 
-def append_attr(d, k, attr):
-    try:
-        attrv = getattr(k, attr)
-    except:
-        return
-    append_attr_value(d, attr, attrv)
+        dst = self.keys(self.dst_bucket_name, self.dst_prefix)
+        for s, d in merge_join(src, dst, key=lambda e: e[0]):
+            if not s:
+                continue
+            if d and d[1].size == s[1].size and d[1].etag == s[1].etag:
+                self.skipped += 1
+                continue
+            yield s[1]
 
-def get_attrs(k, attrs):
-    d = {}
-    for a in attrs:
-        append_attr(d, k, a)
+    def copy_key(self, k):
+        dst_key = self.dst_prefix + k.name[len(self.src_prefix):]
+        try:
+            o = OboObject(self.obo, self.args, self.dst_bucket_name, dst_key, query_args=self.query_args)
+            o.copy((self.src_bucket_name, k.name), None, k.size)
+        except Exception as e:
+            return dst_key, '{t}: {e}'.format(t=type(e).__name__, e=e)
+        return dst_key, None
 
-    return d
+    def report_progress(self, final = False):
+        now = time.time()
+        if not final and now - self.last_report < self.args.progress_interval:
+            return
+        self.last_report = now
+        elapsed = max(now - self.start, 0.001)
+        print >> sys.stderr, ('copied {c} objects ({b:.1f} MB), skipped {s}, failed {f}, '
+                              '{o:.1f} objects/s, {r:.1f} MB/s').format(
+                c=self.copied, b=self.bytes / 1e6, s=self.skipped, f=self.failed,
+                o=self.copied / elapsed, r=self.bytes / 1e6 / elapsed)
 
-def append_query_arg(s, n, v):
-    if not v:
-        return s
-    nv = '{n}={v}'.format(n=n, v=v)
-    if not s:
-        return nv
-    return '{s}&{nv}'.format(s=s, nv=nv)
+    def run(self):
+        '''
+        Returns whether all the keys were copied.
+        '''
+        for k, (dst_key, error) in self.obo.engine.map(self.copy_key, self.pending(), self.args.concurrency):
+            d = { 'source': k.name, 'key': dst_key, 'size': k.size }
+            if error:
+                self.failed += 1
+                d['error'] = error
+            else:
+                self.copied += 1
+                self.bytes += k.size
+            print dump_json_line(d)
+            sys.stdout.flush()
+            self.report_progress()
 
-class KeyJSONEncoder(boto.s3.key.Key):
-    @staticmethod
-    def default(k, versioned=False):
-        attrs = ['name', 'size', 'last_modified', 'metadata', 'cache_control',
-                 'content_type', 'content_disposition', 'content_language',
-                 'owner', 'storage_class', 'md5', 'version_id', 'encrypted',
-                 'delete_marker', 'expiry_date', 'VersionedEpoch']
-        d = get_attrs(k, attrs)
-        d['etag'] = k.etag[1:-1]
-        if versioned:
-            d['is_latest'] = k.is_latest
-        return d
+        self.report_progress(final=True)
+        return self.failed == 0
+
+
+DIFF_FIELDS = ['delete_marker', 'etag', 'size', 'is_latest', 'VersionedEpoch']
+DIFF_PAGE_ROWS = 1000
+DIFF_PREFETCH_PAGES = 2
 
-class DeleteMarkerJSONEncoder(boto.s3.key.Key):
-    @staticmethod
-    def default(k):
-        attrs = ['name', 'version_id', 'last_modified', 'owner']
-        d = get_attrs(k, attrs)
+def diff_attrs(e, versions):
+    '''
+    Returns the attributes of a listing entry that are compared by a diff.
+    '''
+    d = collections.OrderedDict()
+    if isinstance(e, boto.s3.deletemarker.DeleteMarker):
         d['delete_marker'] = True
-        d['is_latest'] = k.is_latest
-        return d
+    else:
+        d['etag'] = e.etag.strip('"') if e.etag else None
+        d['size'] = e.size
+    if versions:
+        d['is_latest'] = e.is_latest
+    epoch = getattr(e, 'VersionedEpoch', None)
+    if epoch is not None:
+        d['VersionedEpoch'] = epoch
+    return d
 
-class UserJSONEncoder(boto.s3.user.User):
-    @staticmethod
-    def default(k):
-        attrs = ['id', 'display_name']
-        return get_attrs(k, attrs)
-
-class BucketJSONEncoder(boto.s3.bucket.Bucket):
-    @staticmethod
-    def default(k):
-        attrs = ['name', 'creation_date']
-        return get_attrs(k, attrs)
-
-class BucketLifecycleRuleJSONEncoder(boto.s3.lifecycle.Rule):
-    @staticmethod
-    def default(k):
-        attrs = ['id', 'prefix', 'status', 'expiration', 'transition']
-        return get_attrs(k, attrs)
-
-class BucketLifecycleExpirationJSONEncoder(boto.s3.lifecycle.Expiration):
-    @staticmethod
-    def default(k):
-        attrs = ['days', 'date']
-        return get_attrs(k, attrs)
-
-class BucketLifecycleTransitionJSONEncoder(boto.s3.lifecycle.Transition):
-    @staticmethod
-    def default(k):
-        attrs = ['days', 'date', 'storage_class']
-        return get_attrs(k, attrs)
-
-class WebsiteRedirectJSONEncoder(boto.s3.website.Redirect):
-    @staticmethod
-    def default(k):
-        attrs = ['hostname', 'protocol', 'replace_key', 'replace_key_prefix', 'http_redirect_code']
-        return get_attrs(k, attrs)
-
-class WebsiteConditionJSONEncoder(boto.s3.website.Redirect):
-    @staticmethod
-    def default(k):
-        attrs = ['key_prefix', 'http_error_code']
-        return get_attrs(k, attrs)
-
-class WebsiteRedirectLocationJSONEncoder(boto.s3.website.RedirectLocation):
-    @staticmethod
-    def default(k):
-        attrs = ['hostname', 'protocol']
-        return get_attrs(k, attrs)
-
-class WebsiteRoutingRuleJSONEncoder(boto.s3.website.RoutingRule):
-    @staticmethod
-    def default(k):
-        attrs = ['condition', 'redirect']
-        return get_attrs(k, attrs)
-
-class WebsiteConfigurationJSONEncoder(boto.s3.website.WebsiteConfiguration):
-    @staticmethod
-    def default(k):
-        attrs = ['suffix', 'error_key', 'redirect_all_requests_to', 'routing_rules']
-        return get_attrs(k, attrs)
+def group_versions(pages, prefix):
+    '''
+    Yields (name relative to prefix, entries) for each key of a listing,
+    with all of its versions (or just the one key without versions).
+    '''
+    name = None
+    entries = []
+    for rs in pages:
+        for e in rs:
+            if isinstance(e, boto.s3.prefix.Prefix):
+                continue
+            if e.name != name:
+                if entries:
+                    yield name[len(prefix):], entries
+                name = e.name
+                entries = []
+            entries.append(e)
+    if entries:
+        yield name[len(prefix):], entries
 
-class BotoJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, boto.s3.key.Key):
-            return KeyJSONEncoder.default(obj)
-        if isinstance(obj, boto.s3.deletemarker.DeleteMarker):
-            return DeleteMarkerJSONEncoder.default(obj)
-        if isinstance(obj, boto.s3.user.User):
-            return UserJSONEncoder.default(obj)
-        if isinstance(obj, boto.s3.prefix.Prefix):
-            return (lambda x: {'prefix': x.name})(obj)
-        if isinstance(obj, boto.s3.bucket.Bucket):
-            return BucketJSONEncoder.default(obj)
-        if isinstance(obj, boto.s3.lifecycle.Rule):
-            return BucketLifecycleRuleJSONEncoder.default(obj)
-        if isinstance(obj, boto.s3.lifecycle.Expiration):
-            return BucketLifecycleExpirationJSONEncoder.default(obj)
-        if isinstance(obj, boto.s3.lifecycle.Transition):
-            return BucketLifecycleTransitionJSONEncoder.default(obj)
-        if isinstance(obj, boto.s3.website.Redirect):
-            return WebsiteRedirectJSONEncoder.default(obj)
-        if isinstance(obj, boto.s3.website.Condition):
-            return WebsiteConditionJSONEncoder.default(obj)
-        if isinstance(obj, boto.s3.website.RedirectLocation):
-            return WebsiteRedirectLocationJSONEncoder.default(obj)
-        if isinstance(obj, boto.s3.website.RoutingRule):
-            return WebsiteRoutingRuleJSONEncoder.default(obj)
-        if isinstance(obj, boto.s3.website.WebsiteConfiguration):
-            return WebsiteConfigurationJSONEncoder.default(obj)
-        return json.JSONEncoder.default(self, obj)
-
-class BotoJSONEncoderListBucketVersioned(BotoJSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, boto.s3.key.Key):
-            return KeyJSONEncoder.default(obj, versioned=True)
-        return BotoJSONEncoder.default(self, obj)
+class OboDiff:
+    '''
+    Compares the listings of two buckets (or prefixes), possibly on
+    different endpoints, e.g. two zones of a multisite setup. Both sides
+    are listed at once and merge-joined in key order, so neither is held
+    in memory; the versions of each key are matched up by version id.
+    With parallel, the key space is split into ranges at the same points
+    on both sides and the ranges are compared concurrently.
+    '''
+    def __init__(self, obo, args, source, target):
+        self.obo = obo
+        self.args = args
+        self.versions = not args.current_only
+        self.sides = []
+        for spec, endpoint in ((source, args.source_endpoint), (target, args.target_endpoint)):
+            bucket_name, prefix = (spec.split('/', 1) + [''])[:2]
+            side_args = argparse.Namespace(**vars(args))
+            side_args.prefix = prefix or None
+            side_args.list_versions = self.versions
+            self.sides.append((OboBucket(obo.for_host(endpoint), side_args, bucket_name, True),
+                               prefix.decode('utf-8')))
 
-def dump_json(o, cls=BotoJSONEncoder):
-    return json.dumps(o, cls=cls, indent=4)
+        self.lock = threading.Lock()
+        self.counts = collections.OrderedDict([('compared', 0), ('missing', 0), ('extra', 0), ('mismatch', 0)])
 
+    def ranges(self):
+        '''
+        Returns the (start, end] key ranges to compare, relative to the
+        prefixes, None standing for the start or end of the prefix.
+        '''
+        if not self.args.parallel:
+            return [(None, None)]
+        bucket, prefix = self.sides[0]
+        if self.args.split_points:
+            splits = sorted(set(self.args.split_points.split(',')))
+        else:
+            splits = [s[len(prefix):] for s in bucket.discover_splits(self.args.split_delimiter or '/')]
+        return zip([None] + splits, splits + [None])
 
-class OboBucketStatus(json.JSONEncoder):
-    def default(self, k):
-        if isinstance(k, boto.s3.bucket.Bucket):
-            j = { 'name': k.name }
-            append_attr_value(j, 'versioning_status', k.get_versioning_status())
-            return j
-        return json.JSONEncoder.default(self, k)
+    def pages(self, side, start, end):
+        bucket, prefix = side
+        markers = (prefix + start if start is not None else None, None)
+        pages = bucket.iter_pages(markers, prefix + end if end is not None else None)
+        # each range being compared lists both sides at once, so the pool
+        # this runs on needs two workers per range
+        return self.obo.engine.chain([pages], 1, 2 * (self.args.parallel or 1))
 
-class OboBucket:
-    def __init__(self, obo, args, bucket_name, need_to_exist, query_args = None):
+    def compare(self, r):
+        '''
+        Yields pages of the differences between the sides in range r.
+        '''
+        source, target = [group_versions(self.pages(side, r[0], r[1]), side[1]) for side in self.sides]
+        rows = []
+        for s, t in merge_join(source, target, key=lambda g: g[0]):
+            rows += self.compare_key(s, t)
+            if len(rows) >= DIFF_PAGE_ROWS:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+    def compare_key(self, s, t):
+        name = (s or t)[0]
+        source = collections.OrderedDict((e.version_id, e) for e in s[1]) if s else {}
+        target = collections.OrderedDict((e.version_id, e) for e in t[1]) if t else {}
+        rows = []
+        compared = 0
+        for version_id, e in source.iteritems():
+            compared += 1
+            other = target.pop(version_id, None)
+            if other is None:
+                rows.append(self.row('missing', name, version_id, e, None))
+                continue
+            a = diff_attrs(e, self.versions)
+            b = diff_attrs(other, self.versions)
+            # not every gateway reports a versioned epoch
+            differences = [f for f in DIFF_FIELDS if a.get(f) != b.get(f) and
+                           (f != 'VersionedEpoch' or (f in a and f in b))]
+            if differences:
+                rows.append(self.row('mismatch', name, version_id, e, other, differences))
+        for version_id, e in target.iteritems():
+            compared += 1
+            rows.append(self.row('extra', name, version_id, None, e))
+
+        with self.lock:
+            self.counts['compared'] += compared
+            for row in rows:
+                self.counts[row['status']] += 1
+        return rows
+
+    def row(self, status, name, version_id, source, target, differences = None):
+        d = collections.OrderedDict([('status', status), ('key', name)])
+        if self.versions:
+            d['version_id'] = version_id
+        if differences:
+            d['differences'] = differences
+        if source is not None:
+            d['source'] = diff_attrs(source, self.versions)
+        if target is not None:
+            d['target'] = diff_attrs(target, self.versions)
+        return d
+
+    def run(self):
+        '''
+        Returns whether the sides match.
+        '''
+        compares = [self.compare(r) for r in self.ranges()]
+        pages = self.obo.engine.chain(compares, DIFF_PREFETCH_PAGES, self.args.parallel or 1)
+        output_for(self.args, stream=True).write_pages(pages)
+
+        c = self.counts
+        print >> sys.stderr, 'compared {n} entries: {m} missing, {e} extra, {x} mismatched'.format(
+                n=c['compared'], m=c['missing'], e=c['extra'], x=c['mismatch'])
+        return c['missing'] + c['extra'] + c['mismatch'] == 0
+
+
+class OboUsage:
+    '''
+    Totals the objects and bytes under a prefix of a bucket, for each
+    prefix down to depth levels below it. Keys are folded into [objects,
+    bytes] accumulators as listing pages arrive, so memory grows with the
+    number of prefixes reported rather than with the number of keys.
+    With a parallel listing each key range is totalled on a worker of its
+    own and the totals are merged at the end.
+    '''
+    def __init__(self, obo, args, target):
         self.obo = obo
         self.args = args
-        self.bucket_name = bucket_name
-        self.bucket = obo.get_bucket(bucket_name)
-        self.query_args = query_args
+        bucket_name, prefix = (target.split('/', 1) + [''])[:2]
+        args.prefix = prefix
+        # key names are listed as unicode
+        self.prefix = prefix.decode('utf-8')
+        self.bucket = OboBucket(obo, args, bucket_name, True)
+        self.delimiter = args.group_delimiter.decode('utf-8')
 
-        if need_to_exist and not self.bucket:
-            print 'ERROR: bucket does not exist:', bucket_name
-            raise
+    def group(self, name):
+        '''
+        Returns the prefix, at most depth levels below the listed one,
+        that the key name is counted under.
+        '''
+        i = len(self.prefix)
+        for _ in xrange(self.args.depth):
+            j = name.find(self.delimiter, i)
+            if j < 0:
+                break
+            i = j + len(self.delimiter)
+        return name[:i]
 
-    def list_objects(self):
-        if (self.args.list_versions):
-            l = self.bucket.get_all_versions(prefix=self.args.prefix, delimiter=self.args.delimiter,
-                                        key_marker=self.args.key_marker, version_id_marker=self.args.version_id_marker,
-                                        max_keys=self.args.max_keys)
-            print dump_json(l, cls=BotoJSONEncoderListBucketVersioned)
-        else:
-            l = self.bucket.get_all_keys(prefix=self.args.prefix, delimiter=self.args.delimiter,
-                                        marker=self.args.marker, max_keys=self.args.max_keys)
-            print dump_json(l)
+    def aggregate(self, pages):
+        '''
+        Returns the totals of the entries of pages, keyed on (prefix,
+        storage class, version state). The class is None unless broken
+        down by, and so is the state unless versions are listed.
+        '''
+        totals = {}
+        by_class = self.args.by_storage_class
+        versions = self.args.list_versions
+        for rs in pages:
+            for e in rs:
+                if isinstance(e, boto.s3.prefix.Prefix):
+                    continue
+                if isinstance(e, boto.s3.deletemarker.DeleteMarker):
+                    state, size = 'delete_marker', 0
+                elif versions:
+                    state, size = 'current' if e.is_latest else 'noncurrent', e.size
+                else:
+                    state, size = None, e.size
+                t = (self.group(e.name), e.storage_class if by_class and state != 'delete_marker' else None, state)
+                acc = totals.get(t)
+                if acc is None:
+                    acc = totals[t] = [0, 0]
+                acc[0] += 1
+                acc[1] += size
+        return totals
 
-    def create(self):
-        try:
-            self.obo.conn.create_bucket(self.bucket_name, policy=self.args.canned_acl)
-        except socket.error as error:
-            print 'Had an issue connecting: %s' % error
+    def totals(self):
+        if not self.args.parallel:
+            return self.aggregate(self.bucket.list_pages())
 
-    def stat(self, obj):
-        if obj:
-            k = self.bucket.get_key(obj)
-            print dump_json(k)
-        else:
-            print json.dumps(self.bucket, cls=OboBucketStatus, indent=4)
+        totals = {}
+        for shard, t in self.obo.engine.map(self.aggregate, self.bucket.shards(), self.args.parallel):
+            for k, (objects, size) in t.iteritems():
+                acc = totals.setdefault(k, [0, 0])
+                acc[0] += objects
+                acc[1] += size
+        return totals
 
-    def set_versioning(self, status):
-        bucket = self.obo.get_bucket(self.bucket_name)
-        bucket.configure_versioning(status)
+    def parents(self, prefix):
+        '''
+        Yields prefix and each of its parents, up to the listed prefix.
+        '''
+        yield prefix
+        while len(prefix) > len(self.prefix):
+            i = prefix.rfind(self.delimiter, len(self.prefix), len(prefix) - len(self.delimiter))
+            prefix = prefix[:i + len(self.delimiter)] if i >= 0 else self.prefix
+            yield prefix
 
-    def delete_website(self):
-        bucket = self.obo.get_bucket(self.bucket_name)
-        bucket.delete_website_configuration()
+    def rows(self, totals):
+        rows = {}
+        for (group, storage_class, state), (objects, size) in totals.iteritems():
+            for prefix in self.parents(group):
+                row = rows.get(prefix)
+                if row is None:
+                    row = rows[prefix] = collections.OrderedDict([('prefix', prefix), ('objects', 0), ('bytes', 0)])
+                    if self.args.list_versions:
+                        row['current'] = { 'objects': 0, 'bytes': 0 }
+                        row['noncurrent'] = { 'objects': 0, 'bytes': 0 }
+                        row['delete_markers'] = 0
+                    if self.args.by_storage_class:
+                        row['storage_classes'] = {}
+                if state == 'delete_marker':
+                    row['delete_markers'] += objects
+                    continue
+                row['objects'] += objects
+                row['bytes'] += size
+                if state:
+                    row[state]['objects'] += objects
+                    row[state]['bytes'] += size
+                if storage_class:
+                    c = row['storage_classes'].setdefault(storage_class, { 'objects': 0, 'bytes': 0 })
+                    c['objects'] += objects
+                    c['bytes'] += size
+        if self.prefix not in rows:
+            rows[self.prefix] = collections.OrderedDict([('prefix', self.prefix), ('objects', 0), ('bytes', 0)])
+        return [rows[p] for p in sorted(rows)]
 
-    def get_website(self):
-        bucket = self.obo.get_bucket(self.bucket_name)
-        print dump_json(bucket.get_website_configuration_obj())
+    def run(self):
+        output_for(self.args).write(self.rows(self.totals()))
 
-    def configure_website(self, suffix, error_key, redirect_all_host, redirect_all_protocol,
-            condition_key_prefix, condition_http_error_code, redirect_hostname, redirect_protocol,
-            redirect_replace_key, replace_key_prefix, http_redirect_code):
-        bucket = self.obo.get_bucket(self.bucket_name)
-        try:
-            config = bucket.get_website_configuration_obj()
-        except:
-            config = boto.s3.website.WebsiteConfiguration()
+# lifecycle rule element -> (action, element of its age in days)
+LIFECYCLE_ACTIONS = collections.OrderedDict([
+    ('Expiration', ('expiration', 'Days')),
+    ('Transition', ('transition', 'Days')),
+    ('NoncurrentVersionExpiration', ('noncurrent_expiration', 'NoncurrentDays')),
+    ('NoncurrentVersionTransition', ('noncurrent_transition', 'NoncurrentDays')),
+])
 
-        if suffix:
-            config.suffix = suffix
-        if error_key:
-            config.error_key = error_key
-        if redirect_all_host or redirect_all_protocol:
-            config.redirect_all_requests_to = boto.s3.website.RedirectLocation(redirect_all_host, redirect_all_protocol)
-        redirect_rule = None
-        if condition_key_prefix or condition_http_error_code:
-            redirect = boto.s3.website.Redirect(redirect_hostname, redirect_protocol, redirect_replace_key, replace_key_prefix, http_redirect_code)
-            redirect_rule = boto.s3.website.RoutingRule(boto.s3.website.Condition(condition_key_prefix, condition_http_error_code), redirect)
-            config.routing_rules.append(redirect_rule)
+class OboLifecycleRule:
+    '''
+    A lifecycle rule as far as the simulation goes: the prefix it applies
+    to and its actions, each a dict of action (see LIFECYCLE_ACTIONS),
+    days or date, and storage_class for transitions.
+    '''
+    def __init__(self, rule_id, prefix, status, actions, tags = False):
+        self.id = rule_id
+        self.prefix = prefix.decode('utf-8') if isinstance(prefix, str) else prefix or u''
+        self.status = status
+        self.actions = actions
+        self.tags = tags
 
-        bucket.set_website_configuration(config)
+def xml_child(elem, *path):
+    '''
+    Returns the element at path below elem, ignoring namespaces, or None.
+    '''
+    for name in path:
+        elem = next((c for c in elem if c.tag.rsplit('}', 1)[-1] == name), None)
+        if elem is None:
+            return None
+    return elem
 
-    def remove(self):
-        self.obo.conn.delete_bucket(self.bucket_name)
+def xml_text(elem, *path):
+    elem = xml_child(elem, *path)
+    if elem is None:
+        return None
+    return (elem.text or '').strip()
 
-    def getacl(self, obj):
-        acl = self.bucket.get_acl(obj, version_id=self.args.version_id)
-        # TODO include a better format option for importing back
-        print acl
+def lifecycle_action(action, days = None, date = None, storage_class = None):
+    if days is None and not date:
+        return None
+    return { 'action': action, 'days': int(days) if days is not None else None,
+             'date': parse_time(date.split('.')[0]) if date else None,
+             'storage_class': storage_class }
 
-    def get(self, obj):
-        k = Key(self.bucket)
-        k.key = obj
+def parse_lifecycle_rules(body):
+    '''
+    Returns the OboLifecycleRules of a LifecycleConfiguration document.
+    '''
+    rules = []
+    for r in xml.etree.ElementTree.fromstring(body):
+        if r.tag.rsplit('}', 1)[-1] != 'Rule':
+            continue
+        prefix = xml_text(r, 'Prefix')
+        if prefix is None:
+            prefix = xml_text(r, 'Filter', 'Prefix')
+        if prefix is None:
+            prefix = xml_text(r, 'Filter', 'And', 'Prefix')
+        tags = xml_child(r, 'Filter', 'Tag') is not None or xml_child(r, 'Filter', 'And', 'Tag') is not None
+        actions = []
+        for c in r:
+            name = c.tag.rsplit('}', 1)[-1]
+            if name not in LIFECYCLE_ACTIONS:
+                continue
+            action, days = LIFECYCLE_ACTIONS[name]
+            a = lifecycle_action(action, xml_text(c, days), xml_text(c, 'Date'), xml_text(c, 'StorageClass'))
+            if a:
+                actions.append(a)
+        rules.append(OboLifecycleRule(xml_text(r, 'ID'), prefix or '', xml_text(r, 'Status'), actions, tags))
+    return rules
 
-        if not self.args.out_file:
-            out = sys.stdout
-        else:
-            out = open(self.args.out_file, 'wb')
+class OboLifecycleSimulation:
+    '''
+    Estimates what lifecycle rules would do to a bucket as of a given
+    time: how many objects (or noncurrent versions) and bytes each action
+    of each rule would expire or transition, disabled rules included.
 
-        k.get_contents_to_file(out, version_id=self.args.version_id)
+    The listing is streamed, and each page is turned into columns (key,
+    last modified, size, storage class, current or not) that every
+    action is evaluated over in turn. Pages are in key order, so the
+    prefix of a rule selects a contiguous run of each page, and the age
+    and date conditions come down to comparing ISO 8601 times against a
+    cutoff worked out once per action. Versions become noncurrent when
+    the version (or delete marker) after them was made, which is the age
+    noncurrent actions go by.
+    '''
+    def __init__(self, obo, args, bucket_name, rules, as_of):
+        self.obo = obo
+        self.args = args
+        self.rules = rules
+        self.as_of = as_of
+        self.versions = args.list_versions
+        args.prefix = os.path.commonprefix([r.prefix for r in rules]) or None
+        self.bucket = OboBucket(obo, args, bucket_name, True)
 
-    def put(self, obj):
-        k = Key(self.bucket)
-        k.key = obj
+        # an action applies to what was made (or became noncurrent) at or
+        # before its cutoff: S3 counts days from then, rounded up to the
+        # next midnight UTC
+        midnight = calendar.timegm(time.strptime(as_of[:10], '%Y-%m-%d'))
+        self.actions = []
+        for r in rules:
+            for a in r.actions:
+                if a['days'] is not None:
+                    cutoff = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(midnight - a['days'] * 24 * 3600))
+                else:
+                    cutoff = u'\U0010ffff' if as_of >= a['date'] else u''
+                self.actions.append((r, a, prefix_bounds(r.prefix), cutoff))
 
-        if not self.args.in_file:
-            infile = sys.stdin
-        else:
-            infile = open(self.args.in_file, 'rb')
+    def columns(self, page, successor):
+        '''
+        Returns the columns of the versions in page, and the last entry of
+        the page, which is the successor of the first version on the next.
+        '''
+        names, times, sizes, classes, current = [], [], [], [], []
+        for e in page:
+            if isinstance(e, boto.s3.prefix.Prefix):
+                continue
+            if not isinstance(e, boto.s3.deletemarker.DeleteMarker):
+                names.append(e.name)
+                sizes.append(e.size)
+                classes.append(e.storage_class)
+                if not self.versions or e.is_latest:
+                    times.append(e.last_modified)
+                    current.append(True)
+                else:
+                    times.append(successor.last_modified if successor and successor.name == e.name
+                                 else e.last_modified)
+                    current.append(False)
+            successor = e
+        return names, times, sizes, classes, current, successor
 
-        k.set_contents_from_file(infile, policy=self.args.canned_acl, rewind=True, query_args=self.query_args)
+    def evaluate(self, pages):
+        '''
+        Returns the [objects, bytes] totals of each action over pages, and
+        those of what was scanned.
+        '''
+        totals = [[0, 0] for _ in self.actions]
+        scanned = [0, 0]
+        successor = None
+        for page in pages:
+            names, times, sizes, classes, current, successor = self.columns(page, successor)
+            scanned[0] += len(names)
+            scanned[1] += sum(sizes)
+            for t, (r, a, (low, high), cutoff) in zip(totals, self.actions):
+                want_current = not a['action'].startswith('noncurrent')
+                target = a['storage_class']
+                hit = [i for i in xrange(bisect.bisect_left(names, low), bisect.bisect_left(names, high))
+                       if current[i] == want_current and times[i] <= cutoff and classes[i] != target]
+                t[0] += len(hit)
+                t[1] += sum(sizes[i] for i in hit)
+        return totals, scanned
 
-    def get_lifecycle(self):
-        try:
-            lc = self.bucket.get_lifecycle_config()
-        except:
-            lc = boto.s3.lifecycle.Lifecycle()
+    def totals(self):
+        if not self.args.parallel:
+            return self.evaluate(self.bucket.list_pages())
 
-        print dump_json(lc)
+        totals = [[0, 0] for _ in self.actions]
+        scanned = [0, 0]
+        for shard, (t, s) in self.obo.engine.map(self.evaluate, self.bucket.shards(), self.args.parallel):
+            for acc, (objects, size) in zip(totals + [scanned], t + [s]):
+                acc[0] += objects
+                acc[1] += size
+        return totals, scanned
 
-    def add_lifecycle(self, rule_id, prefix, status_bool, expiration, transition):
+    def run(self):
+        for r in self.rules:
+            if r.tags:
+                print >> sys.stderr, 'WARNING: rule %s also filters on tags, which listings do not show; ' \
+                    'its counts include objects without them' % r.id
+        totals, scanned = self.totals()
+        rows = []
+        for (r, a, _, _), (objects, size) in zip(self.actions, totals):
+            row = collections.OrderedDict([('id', r.id), ('prefix', r.prefix), ('status', r.status),
+                                           ('action', a['action'])])
+            for f in ('days', 'date', 'storage_class'):
+                row[f] = a[f]
+            row['objects'] = objects
+            row['bytes'] = size
+            rows.append(row)
+        output_for(self.args).write(rows)
+        print >> sys.stderr, 'scanned {n} {what} ({b} bytes) as of {t}'.format(
+            n=scanned[0], what='versions' if self.versions else 'objects', b=scanned[1], t=self.as_of)
 
-        status = 'Enabled' if status_bool else 'Disabled'
+INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS buckets (
+    bucket TEXT PRIMARY KEY,
+    versions INTEGER NOT NULL,
+    built REAL,
+    refreshed REAL
+);
+CREATE TABLE IF NOT EXISTS objects (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    version_id TEXT NOT NULL,
+    is_latest INTEGER NOT NULL,
+    delete_marker INTEGER NOT NULL,
+    size INTEGER,
+    last_modified TEXT,
+    etag TEXT,
+    storage_class TEXT,
+    owner_id TEXT,
+    owner_name TEXT,
+    PRIMARY KEY (bucket, key, version_id)
+);
+CREATE INDEX IF NOT EXISTS objects_size ON objects (bucket, size);
+CREATE INDEX IF NOT EXISTS objects_last_modified ON objects (bucket, last_modified);
+CREATE INDEX IF NOT EXISTS objects_storage_class ON objects (bucket, storage_class);
+'''
 
-        try:
-            lc = self.bucket.get_lifecycle_config()
-        except:
-            lc = boto.s3.lifecycle.Lifecycle()
+INDEX_COLUMNS = ('key', 'version_id', 'is_latest', 'delete_marker', 'size', 'last_modified',
+                 'etag', 'storage_class', 'owner_id', 'owner_name')
 
-        lc.add_rule(rule_id, prefix, status, expiration, transition)
+INDEX_SORT_KEYS = ['key', 'size', 'last_modified']
 
-        self.bucket.configure_lifecycle(lc)
+def index_row(e, versions):
+    '''
+    Returns the INDEX_COLUMNS of a listing entry. Without versions every
+    entry is current, and has no version id.
+    '''
+    owner = e.owner
+    owner_id = owner.id if owner else None
+    owner_name = owner.display_name if owner else None
+    if isinstance(e, boto.s3.deletemarker.DeleteMarker):
+        return (e.name, e.version_id or '', int(bool(e.is_latest)), 1, None, e.last_modified,
+                None, None, owner_id, owner_name)
+    return (e.name, e.version_id or '', int(bool(e.is_latest) or not versions), 0,
+            e.size, e.last_modified, e.etag, e.storage_class, owner_id, owner_name)
 
-    def remove_lifecycle(self, rule_id, remove_all):
+def index_entry(row, versions):
+    '''
+    Turns a row of INDEX_COLUMNS back into the boto object it was listed
+    as, for the output encoders.
+    '''
+    name, version_id, is_latest, delete_marker, size, last_modified, etag, storage_class, owner_id, owner_name = row
+    if delete_marker:
+        e = boto.s3.deletemarker.DeleteMarker(name=name)
+    else:
+        e = boto.s3.key.Key(name=name)
+        e.size = size
+        e.etag = etag
+        e.storage_class = storage_class
+    e.last_modified = last_modified
+    if versions:
+        e.version_id = version_id
+        e.is_latest = bool(is_latest)
+    if owner_id or owner_name:
+        e.owner = boto.s3.user.User(id=owner_id, display_name=owner_name)
+    return e
 
-        if remove_all:
-            self.bucket.delete_lifecycle_configuration()
-            return
+def prefix_bounds(prefix):
+    '''
+    Returns the (inclusive, exclusive) bounds of the keys under prefix.
+    '''
+    return prefix, prefix + u'\U0010ffff'
 
-        new_lc = boto.s3.lifecycle.Lifecycle()
+class OboIndex:
+    '''
+    Local SQLite inventory of bucket listings, to answer questions about
+    huge buckets without listing them again. A refresh lists the bucket
+    (or a prefix of it, the key ranges of which can be listed in
+    parallel) and merges each page into the rows indexed for the same
+    key range, so only what changed is written.
+    '''
+    def __init__(self, obo, args, target):
+        self.obo = obo
+        self.args = args
+        bucket_name, prefix = (target.split('/', 1) + [''])[:2]
+        self.bucket_name = bucket_name.decode('utf-8')
+        self.prefix = prefix.decode('utf-8')
+        args.prefix = prefix or None
 
-        try:
-            lc = self.bucket.get_lifecycle_config()
-        except:
-            return
+        path = args.db or obo.index_path
+        index_dir = os.path.dirname(path)
+        if index_dir and not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(INDEX_SCHEMA)
 
-        for r in lc:
-            if r.id != rule_id:
-                new_lc.append(r) # add_rule(r.id, r.prefix, r.status, r.expiration, r.transition)
+    def versions(self):
+        '''
+        Returns whether the bucket is indexed with all of its versions, or
+        None if it is not indexed.
+        '''
+        row = self.db.execute('SELECT versions FROM buckets WHERE bucket = ?', (self.bucket_name,)).fetchone()
+        return bool(row[0]) if row else None
 
-        if len(new_lc) == 0:
-            self.bucket.delete_lifecycle_configuration()
+    def build(self):
+        versions = bool(self.args.list_versions)
+        low, high = prefix_bounds(self.prefix)
+        with self.db:
+            if self.versions() != versions:
+                # rows listed the other way can't be merged with these
+                self.db.execute('DELETE FROM objects WHERE bucket = ?', (self.bucket_name,))
+            else:
+                self.db.execute('DELETE FROM objects WHERE bucket = ? AND key >= ? AND key < ?',
+                                (self.bucket_name, low, high))
+            self.db.execute('INSERT OR REPLACE INTO buckets (bucket, versions, built) VALUES (?, ?, ?)',
+                            (self.bucket_name, int(versions), time.time()))
+        self.scan(versions)
+
+    def refresh(self):
+        versions = self.versions()
+        if versions is None:
+            print 'ERROR: bucket {b} is not indexed, run obo index build first'.format(b=self.bucket_name)
+            sys.exit(1)
+        self.args.list_versions = versions
+        self.scan(versions)
+
+    def scan(self, versions):
+        start = time.time()
+        bucket = OboBucket(self.obo, self.args, self.bucket_name, True)
+        if self.args.parallel:
+            pages = bucket.list_sharded_pages()
+        else:
+            pages = bucket.list_pages()
+
+        counts = collections.OrderedDict([('bucket', self.bucket_name), ('prefix', self.prefix),
+                                          ('objects', 0), ('added', 0), ('updated', 0), ('removed', 0)])
+        # the versions of the last key of a page can go on in the next
+        # one, so that key is held back until the page after it
+        low = None
+        pending = []
+        for rs in pages:
+            pending.extend(e for e in rs if not isinstance(e, boto.s3.prefix.Prefix))
+            if not pending:
+                continue
+            i = len(pending)
+            while i > 0 and pending[i - 1].name == pending[-1].name:
+                i -= 1
+            if i:
+                self.merge(low, pending[i - 1].name, pending[:i], versions, counts)
+                low = pending[i - 1].name
+                pending = pending[i:]
+        self.merge(low, None, pending, versions, counts)
+
+        with self.db:
+            self.db.execute('UPDATE buckets SET refreshed = ? WHERE bucket = ?', (time.time(), self.bucket_name))
+        counts['seconds'] = round(time.time() - start, 3)
+        output_for(self.args).write(counts)
+
+    def merge(self, low, high, entries, versions, counts):
+        '''
+        Makes the indexed rows with keys in (low, high] (bounded by the
+        prefix where low or high is None) those of the listed entries.
+        '''
+        prefix_low, prefix_high = prefix_bounds(self.prefix)
+        where = 'bucket = ?'
+        params = [self.bucket_name]
+        if low is None:
+            where += ' AND key >= ?'
+            params.append(prefix_low)
+        else:
+            where += ' AND key > ?'
+            params.append(low)
+        if high is None:
+            where += ' AND key < ?'
+            params.append(prefix_high)
+        else:
+            where += ' AND key <= ?'
+            params.append(high)
+
+        indexed = {}
+        for row in self.db.execute('SELECT {c} FROM objects WHERE {w}'.format(c=', '.join(INDEX_COLUMNS), w=where),
+                                   params):
+            indexed[row[:2]] = row
+
+        changed = []
+        for e in entries:
+            row = index_row(e, versions)
+            old = indexed.pop(row[:2], None)
+            if old is None:
+                counts['added'] += 1
+            elif old == row:
+                continue
+            else:
+                counts['updated'] += 1
+            changed.append((self.bucket_name,) + row)
+        counts['objects'] += len(entries)
+        counts['removed'] += len(indexed)
+
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO objects (bucket, {c}) VALUES ({p})'.format(
+                                c=', '.join(INDEX_COLUMNS), p=', '.join('?' * (len(INDEX_COLUMNS) + 1))), changed)
+            self.db.executemany('DELETE FROM objects WHERE bucket = ? AND key = ? AND version_id = ?',
+                                [(self.bucket_name,) + k for k in indexed])
+
+    def query(self):
+        versions = self.versions()
+        if versions is None:
+            print 'ERROR: bucket {b} is not indexed, run obo index build first'.format(b=self.bucket_name)
+            sys.exit(1)
+
+        low, high = prefix_bounds(self.prefix)
+        where = 'bucket = ? AND key >= ? AND key < ?'
+        params = [self.bucket_name, low, high]
+        if not self.args.all_versions:
+            where += ' AND is_latest = 1 AND delete_marker = 0'
+        for arg, cond in (('min_size', 'size >= ?'), ('max_size', 'size <= ?'),
+                          ('modified_after', 'last_modified >= ?'), ('modified_before', 'last_modified < ?'),
+                          ('storage_class', 'storage_class = ?')):
+            v = getattr(self.args, arg)
+            if v is not None:
+                where += ' AND ' + cond
+                params.append(v)
+
+        if self.args.count:
+            objects, size = self.db.execute('SELECT COUNT(*), TOTAL(size) FROM objects WHERE ' + where,
+                                            params).fetchone()
+            output_for(self.args).write(collections.OrderedDict([('bucket', self.bucket_name),
+                                                                 ('prefix', self.prefix),
+                                                                 ('objects', objects), ('bytes', int(size))]))
             return
 
-        self.bucket.configure_lifecycle(new_lc)
+        order = self.args.sort + (' DESC' if self.args.reverse else '')
+        if self.args.sort != 'key':
+            order += ', key'
+        # newest version of each key first, as listed
+        order += ', is_latest DESC, last_modified DESC'
+        sql = 'SELECT {c} FROM objects WHERE {w} ORDER BY {o}'.format(c=', '.join(INDEX_COLUMNS), w=where, o=order)
+        if self.args.limit:
+            sql += ' LIMIT ?'
+            params.append(self.args.limit)
 
+        if versions:
+            out = output_for(self.args, versioned=True, stream=True, entry_types=list_entry_types(True)[:2])
+        else:
+            out = output_for(self.args, stream=True, entry_types=list_entry_types()[:1])
+        cursor = self.db.execute(sql, params)
+        def pages():
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    return
+                yield [index_entry(row, versions) for row in rows]
+        out.write_pages(pages())
 
-class OboObject:
-    def __init__(self, obo, args, bucket_name, object_name, query_args = None):
-        self.obo = obo
+class OboIndexCommand:
+    def __init__(self, command, args):
+        self.command = command
         self.args = args
-        self.bucket_name = bucket_name
-        self.bucket = obo.get_bucket(bucket_name)
-        self.object_name = object_name
-        self.query_args = query_args
 
-    def remove(self, version_id):
-        query_args = append_query_arg(self.query_args, 'versionId', version_id)
+    @property
+    def obo(self):
+        return self.command.obo
 
-        self.obo.conn.make_request("DELETE", bucket=self.bucket.name, key=self.object_name, query_args=query_args)
+    def parse(self):
+        parser = argparse.ArgumentParser(
+            description='S3 control tool',
+            usage='''obo index <subcommand> <bucket>[/<prefix>] [<args>]
 
-    def copy(self, source, version_id):
-        src_str = '/{bucket}/{object}'.format(bucket=source[0], object=source[1])
-        if version_id and version_id != '':
-            src_str = src_str + '?versionId=' + version_id
+The subcommands are:
+   build                         Index the listing of a bucket or prefix
+   refresh                       List it again and update the index with what changed
+   query                         Find objects in the index
+''')
+        parser.add_argument('subcommand', help='Subcommand to run')
+        # parse_args defaults to [1:] for args, but you need to
+        # exclude the rest of the args too, or validation will fail
+        args = parser.parse_args(self.args[0:1])
+        if not hasattr(self, args.subcommand) or args.subcommand == 'parse':
+            print 'Unrecognized subcommand:', args.subcommand
+            parser.print_help()
+            sys.exit(1)
+        # use dispatch pattern to invoke method with same name
+        return getattr(self, args.subcommand)
 
-        headers = {}
-        headers['x-amz-copy-source'] = src_str
+    def _add_scan_parser_args(self, parser):
+        parser.add_argument('target', help='<bucket>[/<prefix>]')
+        parser.add_argument('--db', help='Index database (default: $OBO_INDEX_DIR/index-<endpoint>.sqlite)')
+        parser.add_argument('--max-keys')
+        parser.add_argument('--parallel', type=int,
+                            help='List key ranges with this many concurrent listers')
+        parser.add_argument('--split-delimiter',
+                            help='Split key ranges at the common prefixes for this delimiter (default /)')
+        parser.add_argument('--split-points',
+                            help='Comma separated keys to split key ranges at')
+        add_output_parser_args(parser)
+        parser.set_defaults(delimiter=None, marker=None, key_marker=None, version_id_marker=None)
+
+    def build(self):
+        parser = argparse.ArgumentParser(
+            description='Index the listing of a bucket or prefix',
+            usage='obo index build <bucket>[/<prefix>] [<args>]')
+        self._add_scan_parser_args(parser)
+        parser.add_argument('--versions', dest='list_versions', action='store_true',
+                            help='Index every version and delete marker')
+        args = parser.parse_args(self.args[1:])
+
+        OboIndex(self.obo, args, args.target).build()
+
+    def refresh(self):
+        parser = argparse.ArgumentParser(
+            description='List a bucket or prefix again and update its index with what changed',
+            usage='obo index refresh <bucket>[/<prefix>] [<args>]')
+        self._add_scan_parser_args(parser)
+        args = parser.parse_args(self.args[1:])
+
+        OboIndex(self.obo, args, args.target).refresh()
+
+    def query(self):
+        parser = argparse.ArgumentParser(
+            description='Find objects in the index',
+            usage='obo index query <bucket>[/<prefix>] [<args>]')
+        parser.add_argument('target', help='<bucket>[/<prefix>]')
+        parser.add_argument('--db', help='Index database (default: $OBO_INDEX_DIR/index-<endpoint>.sqlite)')
+        parser.add_argument('--min-size', type=parse_size)
+        parser.add_argument('--max-size', type=parse_size)
+        parser.add_argument('--modified-after', type=parse_time,
+                            help='UTC date or time, or an age like 7d or 12h')
+        parser.add_argument('--modified-before', type=parse_time,
+                            help='UTC date or time, or an age like 7d or 12h')
+        parser.add_argument('--storage-class')
+        parser.add_argument('--versions', dest='all_versions', action='store_true',
+                            help='Include noncurrent versions and delete markers')
+        parser.add_argument('--sort', choices=INDEX_SORT_KEYS, default='key')
+        parser.add_argument('--reverse', action='store_true')
+        parser.add_argument('--limit', type=int)
+        parser.add_argument('--count', action='store_true',
+                            help='Only output the number and total size of the matches')
+        add_output_parser_args(parser)
+        args = parser.parse_args(self.args[1:])
+
+        OboIndex(self.obo, args, args.target).query()
 
-        self.obo.conn.make_request("PUT", bucket=self.bucket.name, key=self.object_name, query_args=self.query_args, headers=headers)
 
 class OboService:
     def __init__(self, obo, args):
@@ -358,17 +3572,119 @@ class OboService:
         self.args = args
 
     def list_buckets(self):
-        print dump_json(self.obo.conn.get_all_buckets())
+        output_for(self.args).write(self.obo.request(lambda: self.obo.conn.get_all_buckets()))
 
-class OboBucketLifecycleCommand:
-    def __init__(self, obo, args):
+class OboThreadOutput:
+    '''
+    Stands in for sys.stdout/sys.stderr, sending what threads that are
+    capturing their output write to a buffer of their own.
+    '''
+    def __init__(self, out):
+        self.out = out
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buf = StringIO()
+
+    def release(self):
+        buf = self.local.buf
+        self.local.buf = None
+        return buf.getvalue()
+
+    def write(self, data):
+        (getattr(self.local, 'buf', None) or self.out).write(data)
+
+    def flush(self):
+        if not getattr(self.local, 'buf', None):
+            self.out.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.out, name)
+
+
+class OboBatch:
+    '''
+    Runs obo commands read from a file, one per line in the command line
+    syntax, over the same connections. Reports the outcome of each line
+    as a JSON object per line, in input order.
+    '''
+    def __init__(self, obo, infile):
         self.obo = obo
+        self.infile = infile
+
+    def lines(self):
+        for n, line in enumerate(self.infile, 1):
+            words = shlex.split(line, comments=True)
+            if words:
+                yield n, line.strip(), words
+
+    def run_line(self, entry):
+        n, line, words = entry
+        status = 0
+        error = None
+        sys.stdout.capture()
+        sys.stderr.capture()
+        try:
+            if words[0] == 'batch':
+                raise ValueError('batch commands can not be nested')
+            cmd = OboCommand(['obo'] + words, self.obo)._parse()
+            cmd()
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                status = 1
+                error = str(e.code)
+        except Exception as e:
+            status = 1
+            error = '{t}: {e}'.format(t=type(e).__name__, e=e)
+        finally:
+            output = sys.stdout.release().decode('utf-8', 'replace')
+            errout = sys.stderr.release().decode('utf-8', 'replace')
+
+        d = { 'line': n, 'command': line, 'status': status }
+        if output:
+            try:
+                if output[0] not in '[{':
+                    raise ValueError
+                d['result'] = json.loads(output)
+            except ValueError:
+                d['output'] = output
+        if error or errout:
+            d['error'] = error or errout.strip()
+        return d
+
+    def run(self, concurrency):
+        '''
+        Returns whether all the commands succeeded.
+        '''
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = OboThreadOutput(stdout)
+        sys.stderr = OboThreadOutput(stderr)
+        ok = True
+        try:
+            for entry, d in self.obo.engine.map_ordered(self.run_line, self.lines(), concurrency):
+                ok = ok and d['status'] == 0
+                stdout.write(dump_json_line(d) + '\n')
+                stdout.flush()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        return ok
+
+
+class OboBucketLifecycleCommand:
+    def __init__(self, command, args):
+        self.command = command
         self.args = args
 
+    @property
+    def obo(self):
+        return self.command.obo
+
     def parse(self):
         parser = argparse.ArgumentParser(
             description='S3 control tool',
-            usage='obo bucket lifecycle [add | remove | get] <bucket> [<args>]')
+            usage='obo bucket lifecycle [add | remove | get | simulate] <bucket> [<args>]')
         parser.add_argument('subcommand', help='Subcommand to run')
         # parse_args defaults to [1:] for args, but you need to
         # exclude the rest of the args too, or validation will fail
@@ -376,15 +3692,16 @@ class OboBucketLifecycleCommand:
         if not hasattr(self, args.subcommand):
             print 'Unrecognized subcommand:', args.subcommand
             parser.print_help()
-            exit(1)
+            sys.exit(1)
         # use dispatch pattern to invoke method with same name
         return getattr(self, args.subcommand)
 
     def get(self):
         parser = argparse.ArgumentParser(
             description='Get bucket lifecycle configuration',
-            usage='obo bucket lifecycle get <bucket>')
+            usage='obo bucket lifecycle get <bucket> [--format <fmt>] [--fields <fields>]')
         parser.add_argument('bucket_name')
+        add_output_parser_args(parser)
         args = parser.parse_args(self.args[1:])
 
         OboBucket(self.obo, args, args.bucket_name, True).get_lifecycle()
@@ -426,12 +3743,74 @@ class OboBucketLifecycleCommand:
 
         OboBucket(self.obo, args, args.bucket_name, True).remove_lifecycle(args.id, args.remove_all)
 
+    def simulate(self):
+        parser = argparse.ArgumentParser(
+            description='Count the objects and bytes that lifecycle rules would expire or transition',
+            usage='obo bucket lifecycle simulate <bucket> [<args>]')
+        parser.add_argument('bucket_name')
+        parser.add_argument('--as-of', type=parse_time,
+                            help='Evaluate the rules as of this UTC date or time (default: now)')
+        parser.add_argument('--rules-from',
+                            help='Simulate the LifecycleConfiguration XML in this file (- for stdin) '
+                                 'instead of the rules the bucket has')
+        parser.add_argument('--id', help='ID of a rule to add to the simulated ones')
+        parser.add_argument('--prefix', help='Prefix of the added rule')
+        parser.add_argument('--disable', action='store_true', help='Add the rule as disabled')
+        parser.add_argument('--expiration-days', type=int)
+        parser.add_argument('--expiration-date')
+        parser.add_argument('--transition-days', type=int)
+        parser.add_argument('--transition-date')
+        parser.add_argument('--transition-storage-class')
+        parser.add_argument('--noncurrent-expiration-days', type=int)
+        parser.add_argument('--versions', dest='list_versions', action='store_true',
+                            help='List versions, to evaluate noncurrent actions (default: if the bucket is versioned)')
+        parser.add_argument('--max-keys')
+        parser.add_argument('--parallel', type=int,
+                            help='Evaluate key ranges with this many concurrent listers')
+        parser.add_argument('--split-delimiter',
+                            help='Split key ranges at the common prefixes for this delimiter (default /)')
+        parser.add_argument('--split-points',
+                            help='Comma separated keys to split key ranges at')
+        add_output_parser_args(parser)
+        parser.set_defaults(delimiter=None, marker=None, key_marker=None, version_id_marker=None)
+        args = parser.parse_args(self.args[1:])
+
+        bucket = OboBucket(self.obo, args, args.bucket_name, True)
+        if args.rules_from:
+            infile = sys.stdin if args.rules_from == '-' else open(args.rules_from)
+            rules = parse_lifecycle_rules(infile.read())
+        else:
+            bucket.validate()
+            rules = bucket.get_lifecycle_rules()
+
+        actions = [a for a in (lifecycle_action('expiration', args.expiration_days, args.expiration_date),
+                               lifecycle_action('transition', args.transition_days, args.transition_date,
+                                                args.transition_storage_class),
+                               lifecycle_action('noncurrent_expiration', args.noncurrent_expiration_days))
+                   if a]
+        if actions:
+            rules.append(OboLifecycleRule(args.id, args.prefix or '', 'Disabled' if args.disable else 'Enabled',
+                                          actions))
+        if not any(r.actions for r in rules):
+            print 'ERROR: no lifecycle rules to simulate'
+            sys.exit(1)
+
+        if not args.list_versions:
+            args.list_versions = self.obo.get_versioning_status(args.bucket_name).get('Versioning') is not None
+
+        OboLifecycleSimulation(self.obo, args, args.bucket_name, rules,
+                               args.as_of or time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())).run()
+
 
 class OboBucketCommand:
-    def __init__(self, obo, args):
-        self.obo = obo
+    def __init__(self, command, args):
+        self.command = command
         self.args = args
 
+    @property
+    def obo(self):
+        return self.command.obo
+
     def parse(self):
         parser = argparse.ArgumentParser(
             description='S3 control tool',
@@ -449,7 +3828,7 @@ The subcommands are:
         if not hasattr(self, args.subcommand):
             print 'Unrecognized subcommand:', args.subcommand
             parser.print_help()
-            exit(1)
+            sys.exit(1)
         # use dispatch pattern to invoke method with same name
         return getattr(self, args.subcommand)
 
@@ -485,6 +3864,7 @@ The subcommands are:
         parser.add_argument('--redirect-replace-key')
         parser.add_argument('--redirect-replace-key-prefix')
         parser.add_argument('--http-redirect-code')
+        add_output_parser_args(parser)
         args = parser.parse_args(self.args[1:])
 
         if args.set:
@@ -498,53 +3878,91 @@ The subcommands are:
             OboBucket(self.obo, args, args.bucket_name, True).get_website()
 
     def lifecycle(self):
-        cmd = OboBucketLifecycleCommand(self.obo, sys.argv[3:]).parse()
+        cmd = OboBucketLifecycleCommand(self.command, self.args[1:]).parse()
         cmd()
 
 
 class OboCommand:
+    def __init__(self, argv = None, obo = None):
+        self.argv = argv or sys.argv
+        self._obo = obo
+
+    @property
+    def obo(self):
+        # only made once a command has parsed its arguments and needs to
+        # talk to the gateway, so --help and usage errors don't need the
+        # environment
+        if not self._obo:
+            if STATS:
+                STATS.parse_done()
+            access_key = os.environ['S3_ACCESS_KEY_ID']
+            secret_key = os.environ['S3_SECRET_ACCESS_KEY']
+            host = os.environ['S3_HOSTNAME']
+
+            self._obo = OBO(access_key, secret_key, host)
+        return self._obo
 
     def _parse(self):
         parser = argparse.ArgumentParser(
             description='S3 control tool',
-            usage='''obo <command> [<args>]
+            usage='''obo [<global args>] <command> [<args>]
+
+The global args are:
+   --stats                       Print request counts, latencies and phase timings to stderr
+   --stats-file <file>           Write them to a file (default: $OBO_STATS_FILE)
+   --stats-format <fmt>          Format of --stats-file: json or prometheus (default: by extension, .prom)
+   --profile <file>              Write a cProfile dump of the main thread
+
+$OBO_TRACE=1 also prints each request as a JSON line to stderr.
 
 The commands are:
    list                          List buckets
    list <bucket>                 List objects in bucket
    getacl <bucket>[/<key>]       Get object ACL
    create <bucket>               Create a bucket
-   stat <bucket>                 Get bucket info
+   stat <bucket>[/<obj>]         Get bucket or object info
+   stat <bucket> --prefix <p>    Get the info of objects in bulk
    get <bucket>/<obj>            Get object
    put <bucket>/<obj>            Put object
    delete <bucket>[/<key>]       Delete bucket or key
+   delete <bucket> --prefix <p>  Delete objects in bulk
    copy <source> <target>        Copies an object
+   copy -r <source> <target>     Copies all objects under a prefix
+   sync <source> <target>        Sync a local directory and a bucket prefix
+   verify <dir> <bucket>[/<p>]   Check that objects match local files
+   diff <source> <target>        Compare the listings of two buckets or prefixes
+   du <bucket>[/<prefix>]        Summarize object count and size per prefix
+   index <...>                   Manage a local index of bucket listings
    bucket versioning <bucket>    Enable/disable bucket versioning
    bucket lifecycle <...>        Manage bucket lifecycle
    bucket website <...>          Manage bucket website
+   batch [-f <file>]             Run commands from a file, one per line
 ''')
         parser.add_argument('command', help='Subcommand to run')
         # parse_args defaults to [1:] for args, but you need to
         # exclude the rest of the args too, or validation will fail
-        args = parser.parse_args(sys.argv[1:2])
-        if not hasattr(self, args.command) or args.command[0] == '_':
+        args = parser.parse_args(self.argv[1:2])
+        if not hasattr(self, args.command) or args.command[0] == '_' or args.command == 'obo':
             print 'Unrecognized command:', args.command
             parser.print_help()
-            exit(1)
+            sys.exit(1)
         # use dispatch pattern to invoke method with same name
-        ret = getattr(self, args.command)
-        access_key = os.environ['S3_ACCESS_KEY_ID']
-        secret_key = os.environ['S3_SECRET_ACCESS_KEY']
-        host = os.environ['S3_HOSTNAME']
-
-        self.obo = OBO(access_key, secret_key, host)
-        return ret
+        return getattr(self, args.command)
 
     def _add_rgwx_parser_args(self, parser):
         parser.add_argument('--rgwx-uid')
         parser.add_argument('--rgwx-version-id')
         parser.add_argument('--rgwx-versioned-epoch')
 
+    def _add_list_parser_args(self, parser):
+        parser.add_argument('--prefix')
+        parser.add_argument('--delimiter')
+        parser.add_argument('--marker')
+        parser.add_argument('--max-keys')
+        parser.add_argument('--list-versions', action='store_true')
+        parser.add_argument('--key-marker')
+        parser.add_argument('--version-id-marker')
+
     def _get_rgwx_query_args(self, args):
         qa = append_query_arg(None, 'rgwx-uid', args.rgwx_uid)
         qa = append_query_arg(qa, 'rgwx-version-id', args.rgwx_version_id)
@@ -557,14 +3975,17 @@ The commands are:
             usage='obo list [bucket_name] [<args>]')
         parser.add_argument('bucket_name', nargs='?')
         parser.add_argument('--versions', action='store_true')
-        parser.add_argument('--prefix')
-        parser.add_argument('--delimiter')
-        parser.add_argument('--marker')
-        parser.add_argument('--max-keys')
-        parser.add_argument('--list-versions', action='store_true')
-        parser.add_argument('--key-marker')
-        parser.add_argument('--version-id-marker')
-        args = parser.parse_args(sys.argv[2:])
+        self._add_list_parser_args(parser)
+        parser.add_argument('--all', action='store_true',
+                            help='Follow truncated listings to the end, one JSON entry per line')
+        parser.add_argument('--parallel', type=int,
+                            help='List key ranges with this many concurrent listers (implies --all)')
+        parser.add_argument('--split-delimiter',
+                            help='Split key ranges at the common prefixes for this delimiter (default /)')
+        parser.add_argument('--split-points',
+                            help='Comma separated keys to split key ranges at')
+        add_output_parser_args(parser)
+        args = parser.parse_args(self.argv[2:])
 
         if not args.bucket_name:
             OboService(self.obo, args).list_buckets()
@@ -578,19 +3999,39 @@ The commands are:
         parser.add_argument('bucket_name')
         parser.add_argument('--location')
         parser.add_argument('--canned-acl')
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(self.argv[2:])
 
         OboBucket(self.obo, args, args.bucket_name, False).create()
 
     def stat(self):
         parser = argparse.ArgumentParser(
-            description='Get bucket status',
+            description='Get bucket or object status, or the status of many objects',
             usage='obo stat <target> [<args>]')
         parser.add_argument('target', help='Target of operation: <bucket>[/<object>]')
-        args = parser.parse_args(sys.argv[2:])
+        self._add_list_parser_args(parser)
+        parser.add_argument('--keys-from',
+                            help='Stat the keys listed in this file (- for stdin), one <key>[<tab><version-id>] per line')
+        parser.add_argument('--concurrency', type=int,
+                            help='Number of HEAD requests in flight (default: $OBO_CONCURRENCY or %d per endpoint)' % DEFAULT_CONCURRENCY)
+        parser.add_argument('--order', choices=['input', 'completion'], default='input',
+                            help='Output the keys in the order they are given or listed, or as they are stated')
+        add_output_parser_args(parser)
+        args = parser.parse_args(self.argv[2:])
 
         target = args.target.split('/', 1)
 
+        if args.keys_from or args.prefix is not None:
+            assert len(target) == 1
+            bucket = OboBucket(self.obo, args, target[0], True)
+            if args.keys_from:
+                infile = sys.stdin if args.keys_from == '-' else open(args.keys_from)
+                entries = read_key_list(infile)
+            else:
+                entries = bucket.list_entries()
+            if not bucket.stat_keys(entries, args.concurrency, args.order == 'input'):
+                sys.exit(1)
+            return
+
         obj = target[1] if len(target) == 2 else None
 
         OboBucket(self.obo, args, target[0], True).stat(obj)
@@ -602,12 +4043,19 @@ The commands are:
         parser.add_argument('source')
         parser.add_argument('--version-id')
         parser.add_argument('-o', '--out-file')
-        args = parser.parse_args(sys.argv[2:])
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Number of byte ranges to fetch concurrently')
+        parser.add_argument('--range-size', type=parse_size, default='16M',
+                            help='Size of each byte range when fetching concurrently')
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue an interrupted download into --out-file, if the object has not changed')
+        args = parser.parse_args(self.argv[2:])
 
         target = args.source.split('/', 1)
 
         assert len(target) == 2
 
+        expire_journals(self.obo)
         OboBucket(self.obo, args, target[0], True).get(target[1])
 
     def getacl(self):
@@ -616,7 +4064,7 @@ The commands are:
             usage='obo getcl <bucket_name>/<key> [<args>]')
         parser.add_argument('source')
         parser.add_argument('--version-id')
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(self.argv[2:])
 
         target = args.source.split('/', 1)
         obj = target[1] if len(target) == 2 else ''
@@ -630,8 +4078,16 @@ The commands are:
         parser.add_argument('target')
         parser.add_argument('-i', '--in-file')
         parser.add_argument('--canned-acl')
+        parser.add_argument('--multipart-threshold', type=parse_size, default='64M',
+                            help='Use a multipart upload for objects of this size or larger')
+        parser.add_argument('--part-size', type=parse_size, default='16M',
+                            help='Size of each part in a multipart upload (min 5M)')
+        parser.add_argument('--concurrency', type=int,
+                            help='Number of parts to upload concurrently (default: $OBO_CONCURRENCY or %d per endpoint)' % DEFAULT_CONCURRENCY)
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue an interrupted multipart upload of --in-file, if the file has not changed')
         self._add_rgwx_parser_args(parser)
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(self.argv[2:])
 
         target = args.target.split('/', 1)
 
@@ -639,22 +4095,40 @@ The commands are:
 
         assert len(target) == 2
 
+        expire_journals(self.obo)
         OboBucket(self.obo, args, target[0], True, query_args=rgwx_query_args).put(target[1])
 
     def delete(self):
         parser = argparse.ArgumentParser(
-            description='Delete a bucket or an object',
+            description='Delete a bucket or an object, or objects in bulk',
             usage='obo delete <target> [<args>]')
         parser.add_argument('target')
         parser.add_argument('--version-id')
+        self._add_list_parser_args(parser)
+        parser.add_argument('--keys-from',
+                            help='Delete the keys listed in this file (- for stdin), one <key>[<tab><version-id>] per line')
+        parser.add_argument('--batch-size', type=int, default=MULTI_DELETE_MAX_KEYS,
+                            help='Number of keys per multi-object delete request')
+        parser.add_argument('--concurrency', type=int,
+                            help='Number of multi-object delete requests in flight (default: $OBO_CONCURRENCY or %d per endpoint)' % DEFAULT_CONCURRENCY)
         self._add_rgwx_parser_args(parser)
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(self.argv[2:])
 
         target = args.target.split('/', 1)
 
         rgwx_query_args = self._get_rgwx_query_args(args)
 
-        if len(target) == 1:
+        if args.keys_from or args.prefix is not None:
+            assert len(target) == 1
+            bucket = OboBucket(self.obo, args, target[0], True, query_args=rgwx_query_args)
+            if args.keys_from:
+                infile = sys.stdin if args.keys_from == '-' else open(args.keys_from)
+                entries = read_key_list(infile)
+            else:
+                entries = bucket.list_entries()
+            if not bucket.remove_objects(entries, args.batch_size, args.concurrency):
+                sys.exit(1)
+        elif len(target) == 1:
             OboBucket(self.obo, args, target[0], False).remove()
         else:
             assert len(target) == 2
@@ -667,23 +4141,222 @@ The commands are:
         parser.add_argument('source')
         parser.add_argument('target')
         parser.add_argument('--version-id')
+        parser.add_argument('--multipart-threshold', type=parse_size, default='64M',
+                            help='Copy sources of this size or larger in parallel parts (0 to never)')
+        parser.add_argument('--part-size', type=parse_size, default='16M',
+                            help='Size of each part in a multipart copy (min 5M)')
+        parser.add_argument('--concurrency', type=int,
+                            help='Number of parts (and keys with --recursive) to copy concurrently (default: $OBO_CONCURRENCY or %d per endpoint)' % DEFAULT_CONCURRENCY)
+        parser.add_argument('-r', '--recursive', action='store_true',
+                            help='Copy every key under the <bucket>/<prefix> source to the target prefix')
+        parser.add_argument('--skip-existing', action='store_true',
+                            help='With --recursive, skip keys whose size and ETag match at the target')
+        parser.add_argument('--progress-interval', type=float, default=10,
+                            help='Seconds between progress reports with --recursive')
         self._add_rgwx_parser_args(parser)
-        args = parser.parse_args(sys.argv[2:])
+        parser.set_defaults(delimiter=None, marker=None, max_keys=None, list_versions=False)
+        args = parser.parse_args(self.argv[2:])
+
+        rgwx_query_args = self._get_rgwx_query_args(args)
+
+        if args.recursive:
+            if not OboPrefixCopy(self.obo, args, args.source, args.target, query_args=rgwx_query_args).run():
+                sys.exit(1)
+            return
 
         source = args.source.split('/', 1)
         target = args.target.split('/', 1)
 
+        OboObject(self.obo, args, target[0], target[1], query_args=rgwx_query_args).copy(source, args.version_id)
+
+    def sync(self):
+        parser = argparse.ArgumentParser(
+            description='Sync a local directory and a bucket prefix',
+            usage='obo sync <source> <target> [<args>]')
+        parser.add_argument('source', help='Local directory or <bucket>[/<prefix>]')
+        parser.add_argument('target', help='<bucket>[/<prefix>] or local directory')
+        parser.add_argument('--delete', action='store_true',
+                            help='Delete target files that do not exist in the source')
+        parser.add_argument('-n', '--dry-run', action='store_true',
+                            help='Only print what would be transferred or deleted')
+        parser.add_argument('--canned-acl')
+        parser.add_argument('--multipart-threshold', type=parse_size, default='64M')
+        parser.add_argument('--part-size', type=parse_size, default='16M')
+        parser.add_argument('--concurrency', type=int,
+                            help='Number of files to transfer concurrently (default: $OBO_CONCURRENCY or %d per endpoint)' % DEFAULT_CONCURRENCY)
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue interrupted multipart uploads of files that have not changed')
+        self._add_rgwx_parser_args(parser)
+        parser.set_defaults(delimiter=None, marker=None, max_keys=None, list_versions=False)
+        args = parser.parse_args(self.argv[2:])
+
+        upload = os.path.isdir(args.source)
+        if upload:
+            local_dir, remote = args.source, args.target
+        else:
+            local_dir, remote = args.target, args.source
+
+        target = remote.split('/', 1)
+        prefix = target[1].rstrip('/') + '/' if len(target) == 2 and target[1] else ''
+        args.prefix = prefix
+
         rgwx_query_args = self._get_rgwx_query_args(args)
 
-        OboObject(self.obo, args, target[0], target[1], query_args=rgwx_query_args).copy(source, args.version_id)
+        expire_journals(self.obo)
+        if not OboSync(self.obo, args, local_dir, target[0], prefix.decode('utf-8'), upload,
+                       query_args=rgwx_query_args).run():
+            sys.exit(1)
+
+    def verify(self):
+        parser = argparse.ArgumentParser(
+            description='Check that the objects under a bucket prefix match the files of a local directory',
+            usage='obo verify <local_dir> <bucket>[/<prefix>] [<args>]')
+        parser.add_argument('local_dir')
+        parser.add_argument('target', help='<bucket>[/<prefix>]')
+        parser.add_argument('--part-size', type=parse_size, default='16M',
+                            help='Part size the files were uploaded in, for multipart ETags (default: 16M, '
+                                 'then sizes common tools use)')
+        parser.add_argument('--jobs', type=int,
+                            help='Number of processes to hash files in (default: one per CPU)')
+        parser.add_argument('--download', action='store_true',
+                            help='Compare the MD5 of the downloaded objects instead of the ETags')
+        parser.add_argument('--concurrency', type=int,
+                            help='Number of objects to download concurrently with --download '
+                                 '(default: $OBO_CONCURRENCY or %d per endpoint)' % DEFAULT_CONCURRENCY)
+        add_output_parser_args(parser)
+        parser.set_defaults(delimiter=None, marker=None, max_keys=None, list_versions=False)
+        args = parser.parse_args(self.argv[2:])
+
+        if not os.path.isdir(args.local_dir):
+            print 'ERROR: not a directory:', args.local_dir
+            sys.exit(1)
+        args.jobs = args.jobs or multiprocessing.cpu_count()
+
+        target = args.target.split('/', 1)
+        prefix = target[1].rstrip('/') + '/' if len(target) == 2 and target[1] else ''
+        args.prefix = prefix
+
+        if not OboVerify(self.obo, args, args.local_dir, target[0], prefix.decode('utf-8')).run():
+            sys.exit(1)
+
+    def diff(self):
+        parser = argparse.ArgumentParser(
+            description='Compare the listings of two buckets or prefixes',
+            usage='obo diff <source> <target> [<args>]')
+        parser.add_argument('source', help='<bucket>[/<prefix>]')
+        parser.add_argument('target', help='<bucket>[/<prefix>]')
+        parser.add_argument('--source-endpoint',
+                            help='<host>[:<port>][,...] of the source (default: $S3_HOSTNAME)')
+        parser.add_argument('--target-endpoint',
+                            help='<host>[:<port>][,...] of the target (default: $S3_HOSTNAME)')
+        parser.add_argument('--current-only', action='store_true',
+                            help='Compare only the current version of each key')
+        parser.add_argument('--max-keys')
+        parser.add_argument('--parallel', type=int,
+                            help='Compare key ranges with this many concurrent listers per side')
+        parser.add_argument('--split-delimiter',
+                            help='Split key ranges at the common prefixes of the source for this delimiter (default /)')
+        parser.add_argument('--split-points',
+                            help='Comma separated keys, relative to the prefixes, to split key ranges at')
+        add_output_parser_args(parser)
+        parser.set_defaults(delimiter=None)
+        args = parser.parse_args(self.argv[2:])
+
+        if not OboDiff(self.obo, args, args.source, args.target).run():
+            sys.exit(1)
+
+    def du(self):
+        parser = argparse.ArgumentParser(
+            description='Summarize object count and size per prefix',
+            usage='obo du <bucket>[/<prefix>] [<args>]')
+        parser.add_argument('target', help='<bucket>[/<prefix>]')
+        parser.add_argument('--depth', type=int, default=1,
+                            help='Number of prefix levels below the target to report (default 1)')
+        parser.add_argument('--delimiter', dest='group_delimiter', default='/',
+                            help='Delimiter between prefix levels (default /)')
+        parser.add_argument('--versions', dest='list_versions', action='store_true',
+                            help='Count every version, broken down into current and noncurrent')
+        parser.add_argument('--by-storage-class', action='store_true',
+                            help='Break the totals down by storage class')
+        parser.add_argument('--max-keys')
+        parser.add_argument('--parallel', type=int,
+                            help='Total key ranges with this many concurrent listers')
+        parser.add_argument('--split-delimiter',
+                            help='Split key ranges at the common prefixes for this delimiter (default /)')
+        parser.add_argument('--split-points',
+                            help='Comma separated keys to split key ranges at')
+        add_output_parser_args(parser)
+        parser.set_defaults(delimiter=None, marker=None, key_marker=None, version_id_marker=None)
+        args = parser.parse_args(self.argv[2:])
+
+        OboUsage(self.obo, args, args.target).run()
 
     def bucket(self):
-        cmd = OboBucketCommand(self.obo, sys.argv[2:]).parse()
+        cmd = OboBucketCommand(self, self.argv[2:]).parse()
         cmd()
 
+    def index(self):
+        cmd = OboIndexCommand(self, self.argv[2:]).parse()
+        cmd()
+
+    def batch(self):
+        parser = argparse.ArgumentParser(
+            description='Run obo commands from a file, one per line',
+            usage='obo batch [-f <file>|-] [<args>]')
+        parser.add_argument('-f', '--file', default='-',
+                            help='File to read commands from (default: stdin)')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Number of commands to run concurrently')
+        args = parser.parse_args(self.argv[2:])
+
+        infile = sys.stdin if args.file == '-' else open(args.file)
+
+        if not OboBatch(self.obo, infile).run(args.concurrency):
+            sys.exit(1)
+
+GLOBAL_ARGS = { '--stats': False, '--stats-file': True, '--stats-format': True, '--profile': True }
+
+def split_global_args(argv):
+    '''
+    Returns the global args at the start of argv, and the rest of argv.
+    '''
+    i = 1
+    while i < len(argv) and argv[i].split('=', 1)[0] in GLOBAL_ARGS:
+        i += 2 if GLOBAL_ARGS.get(argv[i]) else 1
+    return argv[1:i], argv[:1] + argv[i:]
+
 def main():
-    cmd = OboCommand()._parse()
-    cmd()
+    global STATS
+    global_argv, argv = split_global_args(sys.argv)
+    parser = argparse.ArgumentParser(prog='obo')
+    parser.add_argument('--stats', action='store_true')
+    parser.add_argument('--stats-file', default=os.environ.get('OBO_STATS_FILE'))
+    parser.add_argument('--stats-format', choices=STATS_FORMATS)
+    parser.add_argument('--profile')
+    args = parser.parse_args(global_argv)
+
+    trace = os.environ.get('OBO_TRACE', '') not in ('', '0')
+    if args.stats or args.stats_file or trace:
+        STATS = OboStats(trace)
+    profile = None
+    if args.profile:
+        profile = cProfile.Profile()
+        profile.enable()
+
+    command = OboCommand(argv)
+    try:
+        cmd = command._parse()
+        cmd()
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(args.profile)
+        if STATS:
+            if args.stats or trace:
+                STATS.summary(command._obo)
+            if args.stats_file:
+                fmt = args.stats_format or ('prometheus' if args.stats_file.endswith('.prom') else 'json')
+                STATS.export(args.stats_file, fmt, argv[1] if len(argv) > 1 else '', command._obo)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,726 @@
+'''
+Minimal in-memory S3 stand-in, good enough to drive obo against.
+
+Implements the subset of the S3 REST API that obo uses: service and bucket
+listing (including versions, markers and delimiters), object get (with
+ranges)/put/head/delete/copy, multipart uploads (including part copies),
+multi-object delete and the versioning/lifecycle/website/acl
+subresources. Signatures are not checked.
+
+Requests are counted per operation; GET /_standin/counts returns the
+counts since the last such request as JSON and resets them. Throttling
+can be simulated with 503 SlowDown responses, at random and/or once more
+than a given number of requests are in flight. With --gateways, it
+listens on several ports that serve the same buckets, like the gateways
+of one cluster, each with its own in-flight limit.
+
+    python -m obo.standin [--port <port>] [--latency <seconds>] [--jitter <seconds>]
+                          [--error-rate <fraction>] [--max-inflight <n>] [--gateways <n>]
+'''
+import re
+import sys
+import time
+import json
+import argparse
+import random
+import hashlib
+import threading
+import urllib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+OWNER_ID = 'obo-standin'
+OWNER_NAME = 'obo-standin'
+COUNTS_PATH = '/_standin/counts'
+
+
+def iso_time(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t)) + '.%03dZ' % (int(t * 1000) % 1000)
+
+def http_time(t):
+    return time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(t))
+
+def xml_elem(name, value):
+    return '<{n}>{v}</{n}>'.format(n=name, v=escape(str(value)))
+
+def parse_xml(body):
+    return ET.fromstring(re.sub(r' xmlns="[^"]*"', '', body, count=1))
+
+def owner_xml():
+    return '<Owner><ID>{i}</ID><DisplayName>{n}</DisplayName></Owner>'.format(i=OWNER_ID, n=OWNER_NAME)
+
+
+class StandinError(Exception):
+    def __init__(self, status, code, message=''):
+        Exception.__init__(self, code)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class Version:
+    def __init__(self, key, version_id, data, delete_marker=False, etag=None, headers=None):
+        self.key = key
+        self.version_id = version_id
+        self.data = data
+        self.delete_marker = delete_marker
+        self.etag = etag or hashlib.md5(data).hexdigest()
+        self.mtime = time.time()
+        self.headers = headers or {}
+
+
+class Bucket:
+    def __init__(self, name):
+        self.name = name
+        self.created = time.time()
+        self.versioning = None
+        self.subresources = {}
+        # key -> list of versions, newest first
+        self.objects = {}
+        self.uploads = {}
+        self.next_version = 0
+
+    def new_version_id(self):
+        if self.versioning != 'Enabled':
+            return 'null'
+        self.next_version += 1
+        return '%016d' % (10 ** 15 - self.next_version)
+
+    def add_version(self, v):
+        versions = self.objects.setdefault(v.key, [])
+        if v.version_id == 'null':
+            versions[:] = [o for o in versions if o.version_id != 'null']
+        versions.insert(0, v)
+
+    def current(self, key, version_id=None):
+        versions = self.objects.get(key)
+        if not versions:
+            raise StandinError(404, 'NoSuchKey', 'The specified key does not exist.')
+        if version_id:
+            for v in versions:
+                if v.version_id == version_id:
+                    if v.delete_marker:
+                        raise StandinError(405, 'MethodNotAllowed', 'The specified method is not allowed against this resource.')
+                    return v
+            raise StandinError(404, 'NoSuchVersion', 'The specified version does not exist.')
+        if versions[0].delete_marker:
+            raise StandinError(404, 'NoSuchKey', 'The specified key does not exist.')
+        return versions[0]
+
+    def delete(self, key, version_id=None):
+        versions = self.objects.get(key)
+        if version_id:
+            if versions:
+                versions[:] = [v for v in versions if v.version_id != version_id]
+                if not versions:
+                    del self.objects[key]
+            return None
+        if self.versioning == 'Enabled':
+            marker = Version(key, self.new_version_id(), '', delete_marker=True)
+            self.add_version(marker)
+            return marker
+        if versions:
+            versions[:] = [v for v in versions if v.version_id != 'null']
+            if not versions:
+                del self.objects[key]
+        return None
+
+
+class Standin:
+    '''
+    The stand-in server. Runs threaded HTTP servers for gateways gateways,
+    on host:port and the ports after it (port 0 picks free ones), in
+    background threads. latency seconds are added to every request, with
+    up to jitter extra. error_rate of the requests, and those that find
+    max_inflight others in flight on their gateway, get a 503 SlowDown.
+    '''
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, max_inflight=None, gateways=1):
+        self.lock = threading.RLock()
+        self.buckets = {}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_inflight = max_inflight
+        self.inflight = [0] * gateways
+        self.counts = {}
+        self.next_upload = 0
+
+        standin = self
+
+        self.servers = []
+        for i in xrange(gateways):
+            class Handler(StandinHandler):
+                server_standin = standin
+                server_gateway = i
+
+            self.servers.append(ThreadingHTTPServer((host, port + i if port else 0), Handler))
+        self.host, self.port = self.servers[0].server_address[:2]
+        self.threads = []
+
+    @property
+    def endpoint(self):
+        return ','.join('{h}:{p}'.format(h=h, p=p) for h, p in (s.server_address[:2] for s in self.servers))
+
+    def start(self):
+        for httpd in self.servers:
+            thread = threading.Thread(target=httpd.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def serve_forever(self):
+        self.start()
+        while True:
+            time.sleep(3600)
+
+    def stop(self):
+        for httpd in self.servers:
+            httpd.stopping = True
+            httpd.shutdown()
+            httpd.server_close()
+
+    def count(self, op):
+        with self.lock:
+            self.counts[op] = self.counts.get(op, 0) + 1
+
+    def reset_counts(self):
+        with self.lock:
+            counts = self.counts
+            self.counts = {}
+        return counts
+
+    def bucket(self, name):
+        b = self.buckets.get(name)
+        if not b:
+            raise StandinError(404, 'NoSuchBucket', 'The specified bucket does not exist.')
+        return b
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+    stopping = False
+
+    def handle_error(self, request, client_address):
+        # keep-alive connections are torn down under their handler threads
+        # once the server is stopped
+        if not self.stopping:
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_standin = None
+    server_gateway = 0
+    # send each response in one write, so the stand-in does not add
+    # Nagle/delayed ACK stalls of its own to what is being measured
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_HEAD(self):
+        self.dispatch('HEAD')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        s = self.server_standin
+        if self.path == COUNTS_PATH:
+            self.respond(method, 200, { 'Content-Type': 'application/json' }, json.dumps(s.reset_counts()))
+            return
+
+        if s.latency or s.jitter:
+            time.sleep(s.latency + random.random() * s.jitter)
+
+        url = urlparse.urlsplit(self.path)
+        parts = url.path.lstrip('/').split('/', 1)
+        self.bucket_name = urllib.unquote(parts[0])
+        self.key = urllib.unquote(parts[1]) if len(parts) == 2 and parts[1] else None
+        self.query = dict((k, v[0] if v else '') for k, v in
+                          urlparse.parse_qs(url.query, keep_blank_values=True).items())
+        length = int(self.headers.getheader('content-length') or 0)
+        self.body = self.rfile.read(length) if length else ''
+
+        if not self.bucket_name:
+            op = 'list_buckets'
+        elif not self.key:
+            op = method.lower() + '_bucket'
+        else:
+            op = method.lower() + '_object'
+        for sub in ('uploads', 'uploadId', 'delete', 'versioning', 'lifecycle', 'website', 'acl', 'versions'):
+            if sub in self.query:
+                op = '{o}_{s}'.format(o=op, s=sub.lower())
+                break
+        if self.headers.getheader('x-amz-copy-source'):
+            op = op + '_copy'
+        s.count(method + ' ' + op)
+
+        g = self.server_gateway
+        with s.lock:
+            s.inflight[g] += 1
+            overloaded = s.max_inflight and s.inflight[g] > s.max_inflight
+        try:
+            if overloaded or (s.error_rate and random.random() < s.error_rate):
+                s.count('503 SlowDown')
+                raise StandinError(503, 'SlowDown', 'Please reduce your request rate.')
+            with s.lock:
+                handler = getattr(self, 'op_' + op, None)
+                if not handler:
+                    raise StandinError(501, 'NotImplemented', op)
+                status, headers, body = handler(s)
+        except StandinError as e:
+            status = e.status
+            headers = {}
+            body = ('<?xml version="1.0" encoding="UTF-8"?>\n<Error>' + xml_elem('Code', e.code) +
+                    xml_elem('Message', e.message) + '</Error>')
+            if method == 'HEAD':
+                body = ''
+        finally:
+            with s.lock:
+                s.inflight[g] -= 1
+        self.respond(method, status, headers, body)
+
+    def respond(self, method, status, headers, body):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        if 'Content-Length' not in headers:
+            self.send_header('Content-Length', str(len(body)))
+        self.send_header('x-amz-request-id', 'standin')
+        self.end_headers()
+        if method != 'HEAD' and body:
+            self.wfile.write(body)
+
+    def xml(self, body, status=200):
+        return status, { 'Content-Type': 'application/xml' }, '<?xml version="1.0" encoding="UTF-8"?>\n' + body
+
+    # service
+
+    def op_list_buckets(self, s):
+        out = '<ListAllMyBucketsResult>' + owner_xml() + '<Buckets>'
+        for name in sorted(s.buckets):
+            out += '<Bucket>' + xml_elem('Name', name) + xml_elem('CreationDate', iso_time(s.buckets[name].created)) + '</Bucket>'
+        return self.xml(out + '</Buckets></ListAllMyBucketsResult>')
+
+    # buckets
+
+    def op_head_bucket(self, s):
+        s.bucket(self.bucket_name)
+        return 200, {}, ''
+
+    def op_put_bucket(self, s):
+        if self.bucket_name in s.buckets:
+            raise StandinError(409, 'BucketAlreadyOwnedByYou')
+        s.buckets[self.bucket_name] = Bucket(self.bucket_name)
+        return 200, {}, ''
+
+    def op_delete_bucket(self, s):
+        b = s.bucket(self.bucket_name)
+        if b.objects:
+            raise StandinError(409, 'BucketNotEmpty', 'The bucket you tried to delete is not empty.')
+        del s.buckets[self.bucket_name]
+        return 204, {}, ''
+
+    def list_entries(self, b, prefix, delimiter, marker, versions):
+        '''
+        Yields ('key', name) and ('prefix', name) entries in order, after
+        marker, rolling keys up into common prefixes.
+        '''
+        last_prefix = None
+        for name in sorted(b.objects):
+            if not name.startswith(prefix) or (marker and name <= marker):
+                continue
+            if not versions and b.objects[name][0].delete_marker:
+                continue
+            if delimiter:
+                i = name.find(delimiter, len(prefix))
+                if i >= 0:
+                    cp = name[:i + len(delimiter)]
+                    if cp == last_prefix or (marker and cp <= marker):
+                        continue
+                    last_prefix = cp
+                    yield 'prefix', cp
+                    continue
+            yield 'key', name
+
+    def op_get_bucket(self, s):
+        b = s.bucket(self.bucket_name)
+        q = self.query
+        prefix = q.get('prefix', '')
+        delimiter = q.get('delimiter', '')
+        marker = q.get('marker', '')
+        max_keys = int(q.get('max-keys') or 1000)
+
+        contents = ''
+        prefixes = ''
+        n = 0
+        truncated = False
+        last = None
+        for kind, name in self.list_entries(b, prefix, delimiter, marker, False):
+            if n == max_keys:
+                truncated = True
+                break
+            n += 1
+            last = name
+            if kind == 'prefix':
+                prefixes += '<CommonPrefixes>' + xml_elem('Prefix', name) + '</CommonPrefixes>'
+                continue
+            v = b.objects[name][0]
+            contents += ('<Contents>' + xml_elem('Key', name) + xml_elem('LastModified', iso_time(v.mtime)) +
+                         xml_elem('ETag', '"%s"' % v.etag) + xml_elem('Size', len(v.data)) +
+                         xml_elem('StorageClass', 'STANDARD') + owner_xml() + '</Contents>')
+
+        out = ('<ListBucketResult>' + xml_elem('Name', b.name) + xml_elem('Prefix', prefix) +
+               xml_elem('Marker', marker) + xml_elem('MaxKeys', max_keys) +
+               xml_elem('IsTruncated', 'true' if truncated else 'false'))
+        if delimiter:
+            out += xml_elem('Delimiter', delimiter)
+            if truncated:
+                out += xml_elem('NextMarker', last)
+        return self.xml(out + contents + prefixes + '</ListBucketResult>')
+
+    def op_get_bucket_versions(self, s):
+        b = s.bucket(self.bucket_name)
+        q = self.query
+        prefix = q.get('prefix', '')
+        delimiter = q.get('delimiter', '')
+        key_marker = q.get('key-marker', '')
+        version_id_marker = q.get('version-id-marker', '')
+        max_keys = int(q.get('max-keys') or 1000)
+
+        entries = []
+        if key_marker and version_id_marker and key_marker in b.objects:
+            # resume within the versions of the marker key
+            versions = b.objects[key_marker]
+            ids = [v.version_id for v in versions]
+            if version_id_marker in ids:
+                for v in versions[ids.index(version_id_marker) + 1:]:
+                    entries.append(('version', v))
+        for kind, name in self.list_entries(b, prefix, delimiter, key_marker, True):
+            if kind == 'prefix':
+                entries.append(('prefix', name))
+            else:
+                for v in b.objects[name]:
+                    entries.append(('version', v))
+            if len(entries) > max_keys:
+                break
+
+        truncated = len(entries) > max_keys
+        entries = entries[:max_keys]
+        out = ('<ListVersionsResult>' + xml_elem('Name', b.name) + xml_elem('Prefix', prefix) +
+               xml_elem('KeyMarker', key_marker) + xml_elem('VersionIdMarker', version_id_marker) +
+               xml_elem('MaxKeys', max_keys) + xml_elem('IsTruncated', 'true' if truncated else 'false'))
+        if delimiter:
+            out += xml_elem('Delimiter', delimiter)
+        if truncated:
+            kind, last = entries[-1]
+            if kind == 'prefix':
+                out += xml_elem('NextKeyMarker', last)
+            else:
+                out += xml_elem('NextKeyMarker', last.key) + xml_elem('NextVersionIdMarker', last.version_id)
+        for kind, e in entries:
+            if kind == 'prefix':
+                out += '<CommonPrefixes>' + xml_elem('Prefix', e) + '</CommonPrefixes>'
+                continue
+            latest = b.objects[e.key][0] is e
+            if e.delete_marker:
+                out += ('<DeleteMarker>' + xml_elem('Key', e.key) + xml_elem('VersionId', e.version_id) +
+                        xml_elem('IsLatest', 'true' if latest else 'false') +
+                        xml_elem('LastModified', iso_time(e.mtime)) + owner_xml() + '</DeleteMarker>')
+            else:
+                out += ('<Version>' + xml_elem('Key', e.key) + xml_elem('VersionId', e.version_id) +
+                        xml_elem('IsLatest', 'true' if latest else 'false') +
+                        xml_elem('LastModified', iso_time(e.mtime)) + xml_elem('ETag', '"%s"' % e.etag) +
+                        xml_elem('Size', len(e.data)) + xml_elem('StorageClass', 'STANDARD') +
+                        owner_xml() + '</Version>')
+        return self.xml(out + '</ListVersionsResult>')
+
+    def op_post_bucket_delete(self, s):
+        b = s.bucket(self.bucket_name)
+        req = parse_xml(self.body)
+        quiet = (req.findtext('Quiet') or '').lower() == 'true'
+        out = '<DeleteResult>'
+        for o in req.findall('Object'):
+            # keys are held UTF-8 encoded, as they come in request paths
+            key = o.findtext('Key').encode('utf-8')
+            version_id = o.findtext('VersionId')
+            marker = b.delete(key, version_id)
+            if quiet:
+                continue
+            out += '<Deleted>' + xml_elem('Key', key)
+            if version_id:
+                out += xml_elem('VersionId', version_id)
+            if marker:
+                out += xml_elem('DeleteMarker', 'true') + xml_elem('DeleteMarkerVersionId', marker.version_id)
+            out += '</Deleted>'
+        return self.xml(out + '</DeleteResult>')
+
+    def op_get_bucket_uploads(self, s):
+        b = s.bucket(self.bucket_name)
+        out = ('<ListMultipartUploadsResult>' + xml_elem('Bucket', b.name) +
+               xml_elem('IsTruncated', 'false'))
+        for upload_id, u in sorted(b.uploads.items()):
+            out += ('<Upload>' + xml_elem('Key', u['key']) + xml_elem('UploadId', upload_id) +
+                    xml_elem('Initiated', iso_time(u['initiated'])) + owner_xml() + '</Upload>')
+        return self.xml(out + '</ListMultipartUploadsResult>')
+
+    def op_get_bucket_versioning(self, s):
+        b = s.bucket(self.bucket_name)
+        out = '<VersioningConfiguration>'
+        if b.versioning:
+            out += xml_elem('Status', b.versioning)
+        return self.xml(out + '</VersioningConfiguration>')
+
+    def op_put_bucket_versioning(self, s):
+        b = s.bucket(self.bucket_name)
+        b.versioning = parse_xml(self.body).findtext('Status')
+        return 200, {}, ''
+
+    def get_subresource(self, s, name, code):
+        b = s.bucket(self.bucket_name)
+        if name not in b.subresources:
+            raise StandinError(404, code)
+        return self.xml(b.subresources[name].split('?>', 1)[-1])
+
+    def put_subresource(self, s, name):
+        s.bucket(self.bucket_name).subresources[name] = self.body
+        return 200, {}, ''
+
+    def delete_subresource(self, s, name):
+        s.bucket(self.bucket_name).subresources.pop(name, None)
+        return 204, {}, ''
+
+    def op_get_bucket_lifecycle(self, s):
+        return self.get_subresource(s, 'lifecycle', 'NoSuchLifecycleConfiguration')
+
+    def op_put_bucket_lifecycle(self, s):
+        return self.put_subresource(s, 'lifecycle')
+
+    def op_delete_bucket_lifecycle(self, s):
+        return self.delete_subresource(s, 'lifecycle')
+
+    def op_get_bucket_website(self, s):
+        return self.get_subresource(s, 'website', 'NoSuchWebsiteConfiguration')
+
+    def op_put_bucket_website(self, s):
+        return self.put_subresource(s, 'website')
+
+    def op_delete_bucket_website(self, s):
+        return self.delete_subresource(s, 'website')
+
+    def acl(self):
+        return self.xml('<AccessControlPolicy>' + owner_xml() + '<AccessControlList><Grant>' +
+                        '<Grantee xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:type="CanonicalUser">' +
+                        xml_elem('ID', OWNER_ID) + xml_elem('DisplayName', OWNER_NAME) + '</Grantee>' +
+                        xml_elem('Permission', 'FULL_CONTROL') + '</Grant></AccessControlList></AccessControlPolicy>')
+
+    def op_get_bucket_acl(self, s):
+        s.bucket(self.bucket_name)
+        return self.acl()
+
+    def op_get_object_acl(self, s):
+        s.bucket(self.bucket_name).current(self.key, self.query.get('versionId'))
+        return self.acl()
+
+    # objects
+
+    def object_headers(self, v):
+        headers = { 'ETag': '"%s"' % v.etag,
+                    'Last-Modified': http_time(v.mtime),
+                    'Content-Type': v.headers.get('content-type', 'application/octet-stream'),
+                    'Accept-Ranges': 'bytes' }
+        if v.version_id != 'null':
+            headers['x-amz-version-id'] = v.version_id
+        for k, val in v.headers.items():
+            if k.startswith('x-amz-meta-'):
+                headers[k] = val
+        return headers
+
+    def check_conditions(self, v):
+        if_match = self.headers.getheader('if-match')
+        if if_match and if_match.strip('"') != v.etag:
+            raise StandinError(412, 'PreconditionFailed', 'At least one of the pre-conditions you specified did not hold')
+
+    def parse_range(self, header, size):
+        start, end = header.split('=', 1)[1].split('-', 1)
+        if not start:
+            start, end = size - int(end), size - 1
+        else:
+            start = int(start)
+            end = int(end) if end else size - 1
+        if start >= size:
+            raise StandinError(416, 'InvalidRange', 'The requested range is not satisfiable')
+        return start, min(end, size - 1)
+
+    def op_get_object(self, s):
+        v = s.bucket(self.bucket_name).current(self.key, self.query.get('versionId'))
+        self.check_conditions(v)
+        headers = self.object_headers(v)
+        rng = self.headers.getheader('range')
+        if rng:
+            start, end = self.parse_range(rng, len(v.data))
+            headers['Content-Range'] = 'bytes {s}-{e}/{t}'.format(s=start, e=end, t=len(v.data))
+            return 206, headers, v.data[start:end + 1]
+        return 200, headers, v.data
+
+    def op_head_object(self, s):
+        v = s.bucket(self.bucket_name).current(self.key, self.query.get('versionId'))
+        self.check_conditions(v)
+        headers = self.object_headers(v)
+        headers['Content-Length'] = str(len(v.data))
+        return 200, headers, ''
+
+    def op_put_object(self, s):
+        b = s.bucket(self.bucket_name)
+        headers = dict((k.lower(), v) for k, v in self.headers.items()
+                       if k.lower().startswith('x-amz-meta-') or k.lower() == 'content-type')
+        v = Version(self.key, b.new_version_id(), self.body, headers=headers)
+        b.add_version(v)
+        headers = { 'ETag': '"%s"' % v.etag }
+        if v.version_id != 'null':
+            headers['x-amz-version-id'] = v.version_id
+        return 200, headers, ''
+
+    def copy_source(self, s):
+        src, _, query = self.headers.getheader('x-amz-copy-source').partition('?')
+        bucket, key = urllib.unquote(src).lstrip('/').split('/', 1)
+        version_id = urlparse.parse_qs(query).get('versionId', [None])[0]
+        return s.bucket(bucket).current(key, version_id)
+
+    def op_put_object_copy(self, s):
+        b = s.bucket(self.bucket_name)
+        src = self.copy_source(s)
+        v = Version(self.key, b.new_version_id(), src.data, etag=src.etag, headers=dict(src.headers))
+        b.add_version(v)
+        status, headers, body = self.xml('<CopyObjectResult>' + xml_elem('LastModified', iso_time(v.mtime)) +
+                                         xml_elem('ETag', '"%s"' % v.etag) + '</CopyObjectResult>')
+        if v.version_id != 'null':
+            headers['x-amz-version-id'] = v.version_id
+        return status, headers, body
+
+    def op_delete_object(self, s):
+        marker = s.bucket(self.bucket_name).delete(self.key, self.query.get('versionId'))
+        headers = {}
+        if marker:
+            headers = { 'x-amz-delete-marker': 'true', 'x-amz-version-id': marker.version_id }
+        return 204, headers, ''
+
+    # multipart
+
+    def upload(self, s):
+        b = s.bucket(self.bucket_name)
+        u = b.uploads.get(self.query.get('uploadId'))
+        if not u or u['key'] != self.key:
+            raise StandinError(404, 'NoSuchUpload', 'The specified upload does not exist.')
+        return b, u
+
+    def op_post_object_uploads(self, s):
+        b = s.bucket(self.bucket_name)
+        s.next_upload += 1
+        upload_id = '2~standin-%08d' % s.next_upload
+        b.uploads[upload_id] = { 'key': self.key, 'parts': {}, 'initiated': time.time() }
+        return self.xml('<InitiateMultipartUploadResult>' + xml_elem('Bucket', b.name) +
+                        xml_elem('Key', self.key) + xml_elem('UploadId', upload_id) +
+                        '</InitiateMultipartUploadResult>')
+
+    def op_put_object_uploadid(self, s):
+        b, u = self.upload(s)
+        etag = hashlib.md5(self.body).hexdigest()
+        u['parts'][int(self.query['partNumber'])] = (etag, self.body)
+        return 200, { 'ETag': '"%s"' % etag }, ''
+
+    def op_put_object_uploadid_copy(self, s):
+        b, u = self.upload(s)
+        data = self.copy_source(s).data
+        rng = self.headers.getheader('x-amz-copy-source-range')
+        if rng:
+            start, end = self.parse_range(rng, len(data))
+            data = data[start:end + 1]
+        etag = hashlib.md5(data).hexdigest()
+        u['parts'][int(self.query['partNumber'])] = (etag, data)
+        return self.xml('<CopyPartResult>' + xml_elem('LastModified', iso_time(time.time())) +
+                        xml_elem('ETag', '"%s"' % etag) + '</CopyPartResult>')
+
+    def op_get_object_uploadid(self, s):
+        b, u = self.upload(s)
+        out = ('<ListPartsResult>' + xml_elem('Bucket', b.name) + xml_elem('Key', self.key) +
+               xml_elem('UploadId', self.query['uploadId']) + xml_elem('IsTruncated', 'false'))
+        for n, (etag, data) in sorted(u['parts'].items()):
+            out += ('<Part>' + xml_elem('PartNumber', n) + xml_elem('ETag', '"%s"' % etag) +
+                    xml_elem('Size', len(data)) + '</Part>')
+        return self.xml(out + '</ListPartsResult>')
+
+    def op_post_object_uploadid(self, s):
+        b, u = self.upload(s)
+        req = parse_xml(self.body)
+        data = []
+        digests = []
+        for p in req.findall('Part'):
+            n = int(p.findtext('PartNumber'))
+            etag = p.findtext('ETag').strip('"')
+            if n not in u['parts'] or u['parts'][n][0] != etag:
+                raise StandinError(400, 'InvalidPart', 'One or more of the specified parts could not be found.')
+            data.append(u['parts'][n][1])
+            digests.append(etag.decode('hex'))
+        etag = '%s-%d' % (hashlib.md5(''.join(digests)).hexdigest(), len(digests))
+        v = Version(self.key, b.new_version_id(), ''.join(data), etag=etag)
+        b.add_version(v)
+        del b.uploads[self.query['uploadId']]
+        return self.xml('<CompleteMultipartUploadResult>' + xml_elem('Bucket', b.name) +
+                        xml_elem('Key', self.key) + xml_elem('ETag', '"%s"' % etag) +
+                        '</CompleteMultipartUploadResult>')
+
+    def op_delete_object_uploadid(self, s):
+        b, u = self.upload(s)
+        del b.uploads[self.query['uploadId']]
+        return 204, {}, ''
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='In-memory S3 stand-in for testing and benchmarking obo',
+        usage='python -m obo.standin [<args>]')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0,
+                        help='Port to listen on (default: pick a free one)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Up to this many seconds added to every request at random')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests to fail with 503 SlowDown')
+    parser.add_argument('--max-inflight', type=int,
+                        help='Fail requests with 503 SlowDown beyond this many in flight on a gateway')
+    parser.add_argument('--gateways', type=int, default=1,
+                        help='Number of ports, from --port on, to serve the same buckets on')
+    args = parser.parse_args()
+
+    s = Standin(args.host, args.port, args.latency, args.jitter, args.error_rate, args.max_inflight,
+                args.gateways)
+    print 'listening on', s.endpoint
+    sys.stdout.flush()
+    try:
+        s.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
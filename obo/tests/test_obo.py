@@ -0,0 +1,788 @@
+# -*- coding: utf-8 -*-
+'''
+Runs obo commands against the in-memory stand-in (obo.standin).
+
+    nosetests obo
+'''
+import os
+import sys
+import json
+import hashlib
+import random
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
+
+import boto.exception
+from nose.tools import eq_, assert_raises, with_setup
+
+from obo import obo
+from obo import standin
+
+STANDIN = None
+OBO = None
+TMPDIR = None
+
+
+def setup_module():
+    global STANDIN, OBO, TMPDIR
+    TMPDIR = tempfile.mkdtemp(prefix='obo-test-')
+    os.environ['OBO_JOURNAL_DIR'] = os.path.join(TMPDIR, 'journal')
+    os.environ.pop('OBO_BUCKET_CACHE_TTL', None)
+    # keep the backoff of the retry tests short
+    obo.RETRY_BASE_DELAY = 0.001
+    obo.RETRY_MAX_DELAY = 0.01
+    STANDIN = standin.Standin().start()
+    OBO = obo.OBO('access', 'secret', STANDIN.endpoint)
+
+def teardown_module():
+    OBO.engine.close()
+    STANDIN.stop()
+    shutil.rmtree(TMPDIR)
+
+def reset_errors():
+    STANDIN.error_rate = 0.0
+    OBO.max_attempts = obo.RETRY_MAX_ATTEMPTS
+
+
+def run(*argv, **kwargs):
+    '''
+    Runs an obo command (on the OBO given as obo, by default the shared
+    one), and returns what it wrote to stdout and its exit status.
+    '''
+    out = StringIO()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = out
+    sys.stderr = StringIO()
+    status = 0
+    try:
+        obo.OboCommand(['obo'] + list(argv), obo=kwargs.get('obo', OBO))._parse()()
+    except SystemExit as e:
+        status = e.code
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    return out.getvalue(), status
+
+def json_lines(out):
+    return [json.loads(l) for l in out.splitlines() if l]
+
+def new_bucket():
+    name = 'obo-test-{n}'.format(n=random.randint(0, 1 << 30))
+    run('create', name)
+    return name
+
+def objects(bucket_name):
+    '''
+    Returns the key names (UTF-8 encoded) and data of the stand-in's
+    bucket.
+    '''
+    b = STANDIN.buckets[bucket_name]
+    return dict((k, v[0].data) for k, v in b.objects.items() if not v[0].delete_marker)
+
+def put(bucket_name, key_name, data):
+    path = write_file('put', data)
+    eq_(run('put', '{b}/{k}'.format(b=bucket_name, k=key_name), '--in-file', path)[1], 0)
+
+def write_file(name, data):
+    path = os.path.join(TMPDIR, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def make_tree(files):
+    root = tempfile.mkdtemp(dir=TMPDIR)
+    for relpath, data in files.items():
+        path = os.path.join(root, *relpath.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+    return root
+
+
+class FakeResponse:
+    def __init__(self, status, body):
+        self.status = status
+        self.reason = 'OK'
+        self.body = body
+
+    def read(self):
+        return self.body
+
+def test_check_response_error_body():
+    conn = OBO.conn
+    eq_(obo.check_response(conn, FakeResponse(200, '<CopyObjectResult/>')), '<CopyObjectResult/>')
+    for body in ('<Error><Code>InternalError</Code></Error>',
+                 '<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>InternalError</Code></Error>'):
+        e = None
+        try:
+            obo.check_response(conn, FakeResponse(200, body))
+        except boto.exception.S3ResponseError as error:
+            e = error
+        eq_(e.error_code, 'InternalError')
+
+
+def test_throttle_window():
+    throttle = obo.OboThrottle()
+    for i in xrange(4):
+        throttle.acquire()
+    throttle.release(throttled=True)
+    eq_(throttle.window, 2.0)
+    # one overload counts once
+    throttle.release(throttled=True)
+    eq_(throttle.window, 2.0)
+    throttle.release()
+    throttle.release()
+    assert 2.0 < throttle.window < 3.0
+    eq_(throttle.inflight, 0)
+    eq_(throttle.throttled, 2)
+
+def test_request_retries_throttled():
+    calls = []
+
+    def request():
+        calls.append(None)
+        if len(calls) < 3:
+            raise boto.exception.S3ResponseError(503, 'Slow Down',
+                                                 '<Error><Code>SlowDown</Code></Error>')
+        return 'done'
+    eq_(OBO.request(request, idempotent=False), 'done')
+    eq_(len(calls), 3)
+
+def test_request_does_not_retry_client_errors():
+    calls = []
+
+    def request():
+        calls.append(None)
+        raise boto.exception.S3ResponseError(404, 'Not Found', '<Error><Code>NoSuchKey</Code></Error>')
+    assert_raises(boto.exception.S3ResponseError, OBO.request, request)
+    eq_(len(calls), 1)
+
+@with_setup(teardown=reset_errors)
+def test_lifecycle_add_throttled():
+    bucket_name = new_bucket()
+    STANDIN.error_rate = 0.3
+    for i in xrange(8):
+        eq_(run('bucket', 'lifecycle', 'add', bucket_name, '--id', 'rule-{i}'.format(i=i),
+                '--prefix', 'p{i}/'.format(i=i), '--enable', '--expiration-days', '1')[1], 0)
+    STANDIN.error_rate = 0.0
+    out, status = run('bucket', 'lifecycle', 'get', bucket_name)
+    eq_(sorted(r['id'] for r in json.loads(out)), ['rule-{i}'.format(i=i) for i in xrange(8)])
+
+def test_lifecycle_remove_missing():
+    bucket_name = new_bucket()
+    eq_(run('bucket', 'lifecycle', 'remove', bucket_name, '--id', 'none')[1], 0)
+    eq_(json.loads(run('bucket', 'lifecycle', 'get', bucket_name)[0]), [])
+
+@with_setup(teardown=reset_errors)
+def test_lookup_throttled():
+    bucket_name = new_bucket()
+    OBO.bucket_cache.invalidate(bucket_name)
+    STANDIN.error_rate = 1.0
+    OBO.max_attempts = 2
+    # not taken for a missing bucket
+    b = obo.OboBucket(OBO, None, bucket_name, True)
+    assert_raises(boto.exception.S3ResponseError, b.validate)
+    STANDIN.error_rate = 0.0
+    b.validate()
+    assert_raises(SystemExit, obo.OboBucket(OBO, None, bucket_name + '-missing', True).validate)
+
+@with_setup(teardown=reset_errors)
+def test_stat_bucket_throttled():
+    bucket_name = new_bucket()
+    STANDIN.error_rate = 0.3
+    for i in xrange(5):
+        out, status = run('stat', bucket_name)
+        eq_(json.loads(out)['name'], bucket_name)
+
+
+def test_engine_map_ordered():
+    def work(i):
+        # complete out of order
+        time.sleep(random.random() * 0.01)
+        return i * 2
+    results = list(OBO.engine.map_ordered(work, iter(xrange(50)), 8))
+    eq_(results, [(i, i * 2) for i in xrange(50)])
+
+def test_engine_pool_grows_under_callers():
+    engine = obo.OboEngine(2)
+    # holds the pool of 2 workers, with items left to submit to it
+    small = engine.map(lambda i: i, iter(xrange(20)), 2)
+    first = next(small)
+    # a caller at the same depth that needs more workers replaces it
+    eq_(sorted(engine.map(lambda i: i, xrange(20), 8)), [(i, i) for i in xrange(20)])
+    eq_(sorted([first] + list(small)), [(i, i) for i in xrange(20)])
+    engine.close()
+
+def test_output_fields():
+    out = StringIO()
+    obo.OboOutput(fmt='csv', fields='name,size', out=out).write([{ 'name': 'a', 'size': 1, 'etag': 'x' }])
+    eq_(out.getvalue().splitlines(), ['name,size', 'a,1'])
+
+
+def test_copy_recursive_unicode():
+    src = new_bucket()
+    dst = new_bucket()
+    names = ['src/plain', 'src/q?r', 'src/é', 'src/sub/ü&+ x']
+    for name in names:
+        put(src, name, name)
+    out, status = run('copy', '-r', src + '/src/', dst + '/dst/é/')
+    eq_(status, 0)
+    eq_(len(json_lines(out)), len(names))
+    eq_(objects(dst), dict(('dst/é/' + n[len('src/'):], n) for n in names))
+
+def test_copy_recursive_unicode_prefix():
+    src = new_bucket()
+    dst = new_bucket()
+    put(src, 'café/x', 'x')
+    eq_(run('copy', '-r', src + '/café/', dst + '/thé/')[1], 0)
+    eq_(objects(dst), { 'thé/x': 'x' })
+
+def test_copy_multipart_unicode():
+    src = new_bucket()
+    dst = new_bucket()
+    data = os.urandom(11 << 20)
+    put(src, 'é?big', data)
+    eq_(run('copy', src + '/é?big', dst + '/copy', '--multipart-threshold', '5M', '--part-size', '5M')[1], 0)
+    assert objects(dst)['copy'] == data
+
+
+def test_sync_unicode_prefix():
+    bucket_name = new_bucket()
+    files = { 'a': 'a', 'sub/é': 'e acute', 'q?r': 'q' }
+    root = make_tree(files)
+    out, status = run('sync', root, bucket_name + '/café')
+    eq_(status, 0)
+    eq_(objects(bucket_name), dict(('café/' + k, v) for k, v in files.items()))
+    eq_(sorted(e['action'] for e in json_lines(out)), ['upload'] * 3)
+
+    # and back
+    target = tempfile.mkdtemp(dir=TMPDIR)
+    eq_(run('sync', bucket_name + '/café', target)[1], 0)
+    for relpath, data in files.items():
+        with open(os.path.join(target, *relpath.split('/'))) as f:
+            eq_(f.read(), data)
+
+    # nothing changed
+    eq_(run('sync', root, bucket_name + '/café')[0], '')
+
+    out, status = run('verify', root, bucket_name + '/café', '--jobs', '1')
+    eq_(status, 0)
+
+def test_sync_failed_action():
+    bucket_name = new_bucket()
+    put(bucket_name, 'p/sub/x', 'x')
+    put(bucket_name, 'p/y', 'y')
+    target = tempfile.mkdtemp(dir=TMPDIR)
+    # a file where the directory should be
+    with open(os.path.join(target, 'sub'), 'w') as f:
+        f.write('in the way')
+    out, status = run('sync', bucket_name + '/p', target)
+    eq_(status, 1)
+    actions = dict((e['key'], e) for e in json_lines(out))
+    assert 'error' in actions['p/sub/x']
+    assert 'error' not in actions['p/y']
+    with open(os.path.join(target, 'y')) as f:
+        eq_(f.read(), 'y')
+
+
+def test_batch():
+    bucket_name = new_bucket()
+    put(bucket_name, 'a', 'a')
+    batch = write_file('batch', '''# comment
+stat {b}/a --fields name,size
+get {b}/missing
+batch -f -
+'''.format(b=bucket_name))
+    out, status = run('batch', '-f', batch, '--concurrency', '2')
+    eq_(status, 1)
+    lines = json_lines(out)
+    eq_([l['line'] for l in lines], [2, 3, 4])
+    eq_([l['status'] for l in lines], [0, 1, 1])
+    eq_(lines[0]['result'], { 'name': 'a', 'size': 1 })
+    assert 'nested' in lines[2]['error']
+
+def test_batch_mixed_concurrency():
+    bucket_name = new_bucket()
+    data = os.urandom(12 << 20)
+    path = write_file('batch-data', data)
+    batch = write_file('batch', ''.join(
+        'put {b}/k{c} --in-file {p} --multipart-threshold 5M --part-size 5M --concurrency {c}\n'.format(
+            b=bucket_name, p=path, c=c) for c in (2, 4, 6, 8)))
+    for i in xrange(3):
+        # a new engine each time, so that its pools grow while lines run
+        o = obo.OBO('access', 'secret', STANDIN.endpoint)
+        try:
+            out, status = run('batch', '-f', batch, '--concurrency', '4', obo=o)
+        finally:
+            o.engine.close()
+        eq_([(l['status'], l.get('error')) for l in json_lines(out)], [(0, None)] * 4)
+        eq_(status, 0)
+    for c in (2, 4, 6, 8):
+        assert objects(bucket_name)['k{c}'.format(c=c)] == data
+
+
+def test_du():
+    bucket_name = new_bucket()
+    for name, data in (('café/a/1', 'xx'), ('café/a/2', 'xxx'), ('café/é/1', 'x'), ('café/top', 'xxxx'),
+                       ('other', 'x')):
+        put(bucket_name, name, data)
+    out, status = run('du', bucket_name + '/café/')
+    eq_(status, 0)
+    eq_([(r['prefix'], r['objects'], r['bytes']) for r in json.loads(out)],
+        [(u'café/', 4, 10), (u'café/a/', 2, 5), (u'café/é/', 1, 1)])
+
+    out, status = run('du', bucket_name + '/café', '--depth', '2')
+    eq_(status, 0)
+    eq_([(r['prefix'], r['objects'], r['bytes']) for r in json.loads(out)],
+        [(u'café', 4, 10), (u'café/', 4, 10), (u'café/a/', 2, 5), (u'café/é/', 1, 1)])
+
+    out, status = run('du', bucket_name, '--parallel', '2', '--split-points', 'c,o')
+    eq_(status, 0)
+    eq_([(r['prefix'], r['objects'], r['bytes']) for r in json.loads(out)],
+        [(u'', 5, 11), (u'café/', 4, 10)])
+
+
+def test_output_formats():
+    bucket_name = new_bucket()
+    put(bucket_name, 'a', 'aa')
+    out, status = run('list', bucket_name, '--fields', 'name,size')
+    eq_(json.loads(out), [{ 'name': 'a', 'size': 2 }])
+    out, status = run('list', bucket_name, '--all', '--fields', 'name,size')
+    eq_(json_lines(out), [{ 'name': 'a', 'size': 2 }])
+    out, status = run('list', bucket_name, '--format', 'tsv', '--fields', 'size,name')
+    eq_(out.splitlines(), ['size\tname', '2\ta'])
+
+def test_output_empty_csv():
+    bucket_name = new_bucket()
+    eq_(run('list', bucket_name, '--format', 'csv', '--fields', 'name,size')[0], 'name,size\n')
+    eq_(run('list', bucket_name, '--all', '--format', 'csv', '--fields', 'name,size')[0], 'name,size\n')
+    header = run('list', bucket_name, '--format', 'csv')[0].splitlines()
+    eq_(len(header), 1)
+    assert header[0].startswith('name,size,')
+    eq_(run('list', bucket_name, '--format', 'json')[0], '[]\n')
+    eq_(run('list', bucket_name, '--all', '--format', 'ndjson')[0], '')
+
+
+def test_multipart_part_sizes():
+    eq_(obo.multipart_part_sizes(11 << 20, 3, 16 << 20), [5 << 20])
+    eq_(obo.multipart_part_sizes(40 << 20, 3, 16 << 20), [16 << 20, 14 << 20, (40 << 20) / 3 + 1, 15 << 20])
+    # the one part of a single part upload can be as small as the object
+    assert 1 << 20 in obo.multipart_part_sizes(1 << 20, 1, 16 << 20)
+
+def test_verify_multipart():
+    bucket_name = new_bucket()
+    data = os.urandom(11 << 20)
+    root = make_tree({ 'big': data, 'small': 'small', 'changed': 'before' })
+    eq_(run('sync', root, bucket_name + '/v', '--multipart-threshold', '5M', '--part-size', '5M')[1], 0)
+    assert '-3' in STANDIN.buckets[bucket_name].objects['v/big'][0].etag
+    out, status = run('verify', root, bucket_name + '/v', '--jobs', '2')
+    eq_((out, status), ('', 0))
+
+    with open(os.path.join(root, 'changed'), 'wb') as f:
+        f.write('after!')
+    os.remove(os.path.join(root, 'small'))
+    for args in ([], ['--download']):
+        out, status = run('verify', root, bucket_name + '/v', '--jobs', '2', *args)
+        eq_(status, 1)
+        eq_([(r['status'], r['key']) for r in json_lines(out)], [('mismatch', 'v/changed'), ('extra', 'v/small')])
+
+
+def test_put_multipart():
+    bucket_name = new_bucket()
+    data = os.urandom(13 << 20)
+    path = write_file('multipart', data)
+    STANDIN.reset_counts()
+    eq_(run('put', bucket_name + '/file', '--in-file', path, '--multipart-threshold', '5M', '--part-size', '5M',
+            '--concurrency', '3')[1], 0)
+    assert objects(bucket_name)['file'] == data
+    counts = STANDIN.reset_counts()
+    eq_(counts['PUT put_object_uploadid'], 3)
+    eq_(counts['POST post_object_uploadid'], 1)
+
+    # a stream, whose size is not known up front
+    stdin = sys.stdin
+    sys.stdin = StringIO(data)
+    try:
+        eq_(run('put', bucket_name + '/stream', '--multipart-threshold', '5M', '--part-size', '5M')[1], 0)
+    finally:
+        sys.stdin = stdin
+    assert objects(bucket_name)['stream'] == data
+    eq_(STANDIN.reset_counts()['PUT put_object_uploadid'], 3)
+
+def test_put_single():
+    bucket_name = new_bucket()
+    put(bucket_name, 'small', 'small')
+    put(bucket_name, 'empty', '')
+    eq_(objects(bucket_name), { 'small': 'small', 'empty': '' })
+    # the ETag is checked against the MD5 of what was sent
+    eq_(STANDIN.buckets[bucket_name].objects['small'][0].etag, hashlib.md5('small').hexdigest())
+
+
+def test_get_ranges():
+    bucket_name = new_bucket()
+    data = os.urandom((5 << 20) + 123)
+    put(bucket_name, 'file', data)
+    path = os.path.join(TMPDIR, 'get')
+    STANDIN.reset_counts()
+    eq_(run('get', bucket_name + '/file', '-o', path, '--concurrency', '4', '--range-size', '1M')[1], 0)
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    eq_(STANDIN.reset_counts()['GET get_object'], 6)
+
+    # in order on stdout
+    out, status = run('get', bucket_name + '/file', '--concurrency', '4', '--range-size', '1M')
+    eq_(status, 0)
+    assert out == data
+    eq_(STANDIN.reset_counts()['GET get_object'], 6)
+
+    # one request below the range size
+    out, status = run('get', bucket_name + '/file', '--concurrency', '4', '--range-size', '8M')
+    assert out == data
+    eq_(STANDIN.reset_counts()['GET get_object'], 1)
+
+
+def test_list_all():
+    bucket_name = new_bucket()
+    names = ['a', 'b/1', 'b/2', 'c', 'd/1', 'é']
+    for name in names:
+        put(bucket_name, name, name)
+    STANDIN.reset_counts()
+    out, status = run('list', bucket_name, '--all', '--max-keys', '2')
+    eq_(status, 0)
+    eq_([e['name'] for e in json_lines(out)], [n.decode('utf-8') for n in names])
+    eq_(STANDIN.reset_counts()['GET get_bucket'], 3)
+
+    out, status = run('list', bucket_name, '--all', '--max-keys', '2', '--delimiter', '/')
+    eq_([e.get('name') or e.get('prefix') for e in json_lines(out)], ['a', 'b/', 'c', 'd/', u'é'])
+
+    run('bucket', 'versioning', bucket_name, '--enable')
+    put(bucket_name, 'a', 'again')
+    out, status = run('list', bucket_name, '--all', '--list-versions', '--max-keys', '1', '--prefix', 'a')
+    eq_([(e['name'], e['is_latest']) for e in json_lines(out)], [('a', True), ('a', False)])
+
+
+def test_list_parallel():
+    bucket_name = new_bucket()
+    names = ['a/1', 'a/2', 'b/1', 'c', 'd/1', 'd/2', 'd/3', 'e']
+    for name in names:
+        put(bucket_name, name, name)
+    # split at the common prefixes, and at given points
+    for args in ([], ['--split-points', 'b,d/2,zz'], ['--split-delimiter', '/', '--max-keys', '1']):
+        out, status = run('list', bucket_name, '--parallel', '3', *args)
+        eq_(status, 0)
+        eq_([e['name'] for e in json_lines(out)], names)
+
+    # a common prefix split over two ranges is only output once
+    out, status = run('list', bucket_name, '--parallel', '3', '--delimiter', '/', '--split-points', 'd/2')
+    eq_([e.get('name') or e.get('prefix') for e in json_lines(out)], ['a/', 'b/', 'c', 'd/', 'e'])
+
+    out, status = run('list', bucket_name, '--parallel', '2', '--prefix', 'd/', '--split-points', 'd/1')
+    eq_([e['name'] for e in json_lines(out)], ['d/1', 'd/2', 'd/3'])
+
+
+def test_delete_bulk():
+    bucket_name = new_bucket()
+    for name in ('p/1', 'p/2', 'p/3', 'p/é&<', 'q/1', 'q/2', 'r'):
+        put(bucket_name, name, name)
+    STANDIN.reset_counts()
+    out, status = run('delete', bucket_name, '--prefix', 'p/', '--batch-size', '2', '--concurrency', '2')
+    eq_((out, status), ('', 0))
+    eq_(sorted(objects(bucket_name)), ['q/1', 'q/2', 'r'])
+    eq_(STANDIN.reset_counts()['POST post_bucket_delete'], 2)
+
+    keys = write_file('keys', 'q/1\nr\n\nmissing\n')
+    eq_(run('delete', bucket_name, '--keys-from', keys)[1], 0)
+    eq_(sorted(objects(bucket_name)), ['q/2'])
+
+def test_delete_bulk_versions():
+    bucket_name = new_bucket()
+    run('bucket', 'versioning', bucket_name, '--enable')
+    put(bucket_name, 'v', '1')
+    put(bucket_name, 'v', '2')
+    eq_(run('delete', bucket_name, '--prefix', 'v', '--list-versions')[1], 0)
+    eq_(STANDIN.buckets[bucket_name].objects, {})
+
+
+def failing_on(cls, name, fail):
+    '''
+    Patches cls.name to raise on the calls for which fail(*args) is true,
+    and returns a function that restores it.
+    '''
+    orig = getattr(cls, name)
+    def patched(self, *args):
+        if fail(*args):
+            raise IOError('injected failure')
+        return orig(self, *args)
+    setattr(cls, name, patched)
+    return lambda: setattr(cls, name, orig)
+
+def test_put_resume():
+    bucket_name = new_bucket()
+    data = os.urandom(21 << 20)
+    path = write_file('resume-put', data)
+    args = ('put', bucket_name + '/file', '--in-file', path, '--multipart-threshold', '5M', '--part-size', '5M',
+            '--concurrency', '1')
+    restore = failing_on(obo.OboMultipartUpload, 'upload_part', lambda n, data: n == 3)
+    try:
+        assert_raises(IOError, run, *args)
+    finally:
+        restore()
+    eq_(objects(bucket_name), {})
+    eq_(len(os.listdir(OBO.journal_dir)), 1)
+
+    STANDIN.reset_counts()
+    eq_(run(*(args + ('--resume',)))[1], 0)
+    assert objects(bucket_name)['file'] == data
+    counts = STANDIN.reset_counts()
+    eq_(counts['PUT put_object_uploadid'], 3)
+    eq_(counts.get('POST post_object'), None)
+    eq_(os.listdir(OBO.journal_dir), [])
+
+    # without --resume, the interrupted upload is aborted and started over
+    restore = failing_on(obo.OboMultipartUpload, 'upload_part', lambda n, data: n == 3)
+    try:
+        assert_raises(IOError, run, *args)
+    finally:
+        restore()
+    STANDIN.reset_counts()
+    eq_(run(*args)[1], 0)
+    counts = STANDIN.reset_counts()
+    eq_(counts['PUT put_object_uploadid'], 5)
+    eq_(counts['DELETE delete_object_uploadid'], 1)
+
+def test_get_resume():
+    bucket_name = new_bucket()
+    data = os.urandom((4 << 20) + 123)
+    put(bucket_name, 'file', data)
+    path = os.path.join(TMPDIR, 'resume-get')
+    # ranges are only journaled with --resume, which also starts afresh
+    args = ('get', bucket_name + '/file', '-o', path, '--concurrency', '1', '--range-size', '1M', '--resume')
+    restore = failing_on(obo.OboBucket, 'get_range', lambda k, start, end, out_file: start == 2 << 20)
+    try:
+        assert_raises(IOError, run, *args)
+    finally:
+        restore()
+
+    STANDIN.reset_counts()
+    eq_(run(*args)[1], 0)
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    eq_(STANDIN.reset_counts()['GET get_object'], 3)
+    eq_(os.listdir(OBO.journal_dir), [])
+
+    # an object replaced since is fetched whole
+    restore = failing_on(obo.OboBucket, 'get_range', lambda k, start, end, out_file: start == 2 << 20)
+    try:
+        assert_raises(IOError, run, *args)
+    finally:
+        restore()
+    data = os.urandom((4 << 20) + 123)
+    put(bucket_name, 'file', data)
+    STANDIN.reset_counts()
+    eq_(run(*args)[1], 0)
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    eq_(STANDIN.reset_counts()['GET get_object'], 5)
+
+
+def test_index():
+    bucket_name = new_bucket()
+    for name, data in (('a', '1'), ('b/1', '22'), ('b/2', '333'), ('b/é', '4444'), ('c', '55555')):
+        put(bucket_name, name, data)
+    db = os.path.join(TMPDIR, 'index.sqlite')
+
+    out, status = run('index', 'build', bucket_name, '--db', db, '--max-keys', '2')
+    eq_(status, 0)
+    counts = json_lines(out)[0]
+    eq_((counts['objects'], counts['added'], counts['updated'], counts['removed']), (5, 5, 0, 0))
+
+    def refresh(*args):
+        out, status = run('index', 'refresh', bucket_name, '--db', db, '--max-keys', '2', *args)
+        eq_(status, 0)
+        counts = json_lines(out)[0]
+        return counts['objects'], counts['added'], counts['updated'], counts['removed']
+
+    put(bucket_name, 'b/2', 'changed')
+    put(bucket_name, 'b/3', '')
+    run('delete', bucket_name + '/a')
+    eq_(refresh(), (5, 1, 1, 1))
+    eq_(refresh(), (5, 0, 0, 0))
+    put(bucket_name, 'a', '1')
+    put(bucket_name, 'b/4', '')
+    run('delete', bucket_name + '/b/3')
+    eq_(refresh('--parallel', '2', '--split-points', 'b/2'), (6, 2, 0, 1))
+    run('delete', bucket_name + '/a')
+    run('delete', bucket_name + '/b/4')
+    put(bucket_name, 'b/3', '')
+    eq_(refresh('--parallel', '2', '--split-points', 'b/2'), (5, 1, 0, 2))
+
+    out, status = run('index', 'query', bucket_name + '/b/', '--db', db)
+    eq_([e['name'] for e in json_lines(out)], ['b/1', 'b/2', 'b/3', u'b/é'])
+    out, status = run('index', 'query', bucket_name, '--db', db, '--min-size', '3', '--sort', 'size', '--reverse')
+    eq_([(e['name'], e['size']) for e in json_lines(out)], [('b/2', 7), ('c', 5), (u'b/é', 4)])
+    out, status = run('index', 'query', bucket_name + '/b/', '--db', db, '--count')
+    eq_(json_lines(out), [{ 'bucket': bucket_name, 'prefix': 'b/', 'objects': 4, 'bytes': 13 }])
+
+    eq_(run('index', 'query', new_bucket(), '--db', db)[1], 1)
+
+def test_index_versions():
+    bucket_name = new_bucket()
+    run('bucket', 'versioning', bucket_name, '--enable')
+    put(bucket_name, 'a', '1')
+    put(bucket_name, 'a', '22')
+    put(bucket_name, 'b', '1')
+    run('delete', bucket_name + '/b')
+    db = os.path.join(TMPDIR, 'index.sqlite')
+    # the versions of a key split over pages are indexed whole
+    out, status = run('index', 'build', bucket_name, '--db', db, '--versions', '--max-keys', '1')
+    eq_(json_lines(out)[0]['added'], 4)
+
+    out, status = run('index', 'query', bucket_name, '--db', db)
+    eq_([(e['name'], e['size']) for e in json_lines(out)], [('a', 2)])
+    out, status = run('index', 'query', bucket_name, '--db', db, '--versions')
+    eq_([(e['name'], e['is_latest']) for e in json_lines(out)], [('a', True), ('a', False), ('b', True), ('b', False)])
+
+
+def test_diff():
+    source, target = new_bucket(), new_bucket()
+    for name in ('a', 'b/1', 'b/2', 'c', 'é'):
+        put(source, 'src/' + name, name)
+        put(target, name, name)
+    out, status = run('diff', source + '/src/', target, '--max-keys', '2')
+    eq_((json_lines(out), status), ([], 0))
+
+    put(target, 'b/2', 'changed')
+    run('delete', target + '/c')
+    put(target, 'd', 'd')
+    for args in ([], ['--current-only'], ['--parallel', '2'], ['--parallel', '3', '--split-points', 'b/2,c'],
+                 ['--target-endpoint', STANDIN.endpoint]):
+        out, status = run('diff', source + '/src/', target, '--max-keys', '2', *args)
+        eq_(status, 1)
+        rows = json_lines(out)
+        eq_([(r['status'], r['key']) for r in rows], [('mismatch', 'b/2'), ('missing', 'c'), ('extra', 'd')])
+        eq_(rows[0]['differences'], ['etag', 'size'])
+        eq_('version_id' in rows[0], '--current-only' not in args)
+
+
+def test_stat_keys():
+    bucket_name = new_bucket()
+    run('bucket', 'versioning', bucket_name, '--enable')
+    for name in ('a', 'b/1', 'b/2', 'é'):
+        put(bucket_name, name, name)
+    put(bucket_name, 'a', 'again')
+    old = STANDIN.buckets[bucket_name].objects['a'][1].version_id
+    keys = write_file('stat-keys', 'é\nmissing\n\na\t{v}\nb/1\n'.format(v=old))
+    STANDIN.reset_counts()
+    out, status = run('stat', bucket_name, '--keys-from', keys, '--concurrency', '3')
+    eq_(status, 1)
+    rows = json_lines(out)
+    eq_([r['name'] for r in rows], [u'é', 'missing', 'a', 'b/1'])
+    eq_((rows[1]['status'], rows[1]['error']), (404, 'NoSuchKey'))
+    eq_((rows[2]['version_id'], rows[2]['size']), (old, 1))
+    eq_(STANDIN.reset_counts()['HEAD head_object'], 4)
+
+    out, status = run('stat', bucket_name, '--prefix', 'b/', '--order', 'completion', '--max-keys', '1')
+    eq_(status, 0)
+    eq_(sorted(r['name'] for r in json_lines(out)), ['b/1', 'b/2'])
+
+
+LIFECYCLE_RULES = '''<?xml version="1.0" encoding="UTF-8"?>
+<LifecycleConfiguration xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
+  <Rule><ID>logs</ID><Filter><Prefix>logs/</Prefix></Filter><Status>Enabled</Status>
+    <Expiration><Days>30</Days></Expiration></Rule>
+  <Rule><ID>all</ID><Prefix></Prefix><Status>Disabled</Status>
+    <Transition><Days>1</Days><StorageClass>GLACIER</StorageClass></Transition></Rule>
+</LifecycleConfiguration>
+'''
+
+def days_from_now(days):
+    return time.strftime('%Y-%m-%d', time.gmtime(time.time() + days * 24 * 3600))
+
+def simulated(out):
+    return [(r['id'], r['action'], r['objects'], r['bytes']) for r in json.loads(out)]
+
+def test_lifecycle_simulate():
+    bucket_name = new_bucket()
+    for name, data in (('data/1', '1234567'), ('logs/1', '123'), ('logs/2', '12345'), ('logs/é', '')):
+        put(bucket_name, name, data)
+    rules = write_file('rules.xml', LIFECYCLE_RULES)
+    args = ('bucket', 'lifecycle', 'simulate', bucket_name, '--rules-from', rules, '--id', 'data',
+            '--prefix', 'data/', '--expiration-date', days_from_now(5), '--max-keys', '2')
+    out, status = run(*(args + ('--as-of', days_from_now(10))))
+    eq_(status, 0)
+    eq_(simulated(out), [('logs', 'expiration', 0, 0), ('all', 'transition', 4, 15), ('data', 'expiration', 1, 7)])
+    for parallel in ([], ['--parallel', '2', '--split-points', 'logs/2']):
+        out, status = run(*(args + ('--as-of', days_from_now(40))) + tuple(parallel))
+        eq_(simulated(out), [('logs', 'expiration', 3, 8), ('all', 'transition', 4, 15), ('data', 'expiration', 1, 7)])
+
+    # the rules of the bucket, and noncurrent versions
+    run('bucket', 'versioning', bucket_name, '--enable')
+    put(bucket_name, 'logs/1', 'again')
+    run('bucket', 'lifecycle', 'add', bucket_name, '--id', 'logs', '--prefix', 'logs/', '--enable',
+        '--expiration-days', '30')
+    out, status = run('bucket', 'lifecycle', 'simulate', bucket_name, '--id', 'old', '--noncurrent-expiration-days', '2',
+                      '--as-of', days_from_now(10))
+    eq_(status, 0)
+    eq_(simulated(out), [('logs', 'expiration', 0, 0), ('old', 'noncurrent_expiration', 1, 3)])
+
+    eq_(run('bucket', 'lifecycle', 'simulate', new_bucket())[1], 1)
+
+
+def run_main(*argv):
+    '''
+    Runs obo the way the obo script does, with its global options, on a
+    new OBO made from the environment. Returns what it wrote to stderr
+    and its exit status.
+    '''
+    env = { 'S3_ACCESS_KEY_ID': 'access', 'S3_SECRET_ACCESS_KEY': 'secret', 'S3_HOSTNAME': STANDIN.endpoint }
+    saved = (sys.argv, sys.stdout, sys.stderr)
+    sys.argv = ['obo'] + list(argv)
+    sys.stdout = StringIO()
+    sys.stderr = err = StringIO()
+    os.environ.update(env)
+    status = 0
+    try:
+        obo.main()
+    except SystemExit as e:
+        status = e.code
+    finally:
+        sys.argv, sys.stdout, sys.stderr = saved
+        for k in env:
+            del os.environ[k]
+        obo.STATS = None
+    return err.getvalue(), status
+
+def test_stats_export():
+    bucket_name = new_bucket()
+    put(bucket_name, 'a', 'data')
+    path = os.path.join(TMPDIR, 'stats.json')
+    eq_(run_main('--stats-file', path, 'list', bucket_name), ('', 0))
+    with open(path) as f:
+        d = json.load(f)
+    eq_(d['command'], 'list')
+    eq_([(r['op'], r['status'], r['count']) for r in d['requests']], [('GET bucket', 200, 1)])
+    eq_(d['latency']['count'], 1)
+    eq_((d['retries'], d['throttled']), (0, 0))
+    eq_([e['requests'] for e in d['endpoints']], [1])
+
+    prom = os.path.join(TMPDIR, 'stats.prom')
+    eq_(run_main('--stats-file', prom, 'get', bucket_name + '/a')[1], 0)
+    with open(prom) as f:
+        lines = f.read().splitlines()
+    assert 'obo_requests_total{command="get",op="GET object",status="200"} 1' in lines
+    assert 'obo_request_duration_seconds_bucket{command="get",le="+Inf"} 1' in lines
+    assert '# TYPE obo_request_duration_seconds histogram' in lines
+    eq_(os.listdir(TMPDIR).count('stats.prom'), 1)
+
+    # the file is written even if the command fails, next to a summary
+    keys = write_file('stats-keys', 'a\nmissing\n')
+    err, status = run_main('--stats', '--stats-file', path, '--stats-format', 'prometheus',
+                           'stat', bucket_name, '--keys-from', keys)
+    eq_(status, 1)
+    assert 'obo: 2 requests in' in err
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert 'obo_requests_total{command="stat",op="HEAD object",status="404"} 1' in lines
+    assert 'obo_requests_total{command="stat",op="HEAD object",status="200"} 1' in lines
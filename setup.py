@@ -23,6 +23,7 @@ setup(
     entry_points={
         'console_scripts': [
             'obo = obo.obo:main',
+            'obo-bench = obo.bench:main',
             ],
         },
 